@@ -0,0 +1,192 @@
+"""Single-file archive of the visits of a crawl.
+
+Each file of a visit directory is stored as a separate zlib stream, so
+any file can be read back without decompressing the rest. The archive is
+a pair of files:
+
+    crawl.tbca        the concatenated compressed members
+    crawl.tbca.index  one JSON line per member: visit key, file name,
+                      offset and length in the data file, size and CRC32
+
+Index lines are appended once the member data is flushed, so an
+interrupted writer leaves at most a tail of unindexed data, which is cut
+off when the archive is reopened for writing.
+"""
+import json
+import os
+import zlib
+from glob import glob
+from os.path import basename, getsize, isfile, join
+from shutil import rmtree
+
+import common as cm
+
+INDEX_EXT = '.index'
+ARCHIVE_PATTERN = "crawl*" + cm.ARCHIVE_EXT
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def read_index(index_path):
+    """Return the members of an archive index, skipping a partial line."""
+    members = []
+    if not isfile(index_path):
+        return members
+    with open(index_path) as f:
+        for line in f:
+            try:
+                members.append(json.loads(line))
+            except ValueError:
+                continue
+    return members
+
+
+class ArchiveWriter(object):
+    """Append visit directories to an archive."""
+
+    def __init__(self, path, level=cm.ARCHIVE_COMPRESSION_LEVEL,
+                 block_size=cm.ARCHIVE_BLOCK_SIZE):
+        self.path = path
+        self.level = level
+        self.block_size = block_size
+        members = read_index(path + INDEX_EXT)
+        end = max([m['offset'] + m['length'] for m in members] or [0])
+        self.fd = open(path, 'ab')
+        self.fd.truncate(end)  # drop the data of unindexed members
+        self.fd.seek(end)
+        self.index_fd = open(path + INDEX_EXT, 'a+')
+        self.index_fd.seek(0, os.SEEK_END)
+        if self.index_fd.tell():
+            self.index_fd.seek(-1, os.SEEK_END)
+            if self.index_fd.read(1) != "\n":  # partial last line
+                self.index_fd.write("\n")
+
+    def add_file(self, visit, src_path, name=None):
+        """Compress a file into the archive, reading it block by block."""
+        name = name or basename(src_path)
+        offset = self.fd.tell()
+        compressor = zlib.compressobj(self.level)
+        size = crc = 0
+        with open(src_path, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_size), b''):
+                size += len(block)
+                crc = zlib.crc32(block, crc)
+                self.fd.write(compressor.compress(block))
+        self.fd.write(compressor.flush())
+        self.fd.flush()
+        member = {'visit': visit, 'name': name, 'offset': offset,
+                  'length': self.fd.tell() - offset, 'size': size,
+                  'crc32': crc & 0xffffffff}
+        self.index_fd.write(json.dumps(member) + "\n")
+        self.index_fd.flush()
+        return member
+
+    def add_visit(self, visit_dir, remove=False):
+        """Add the files of a visit directory, keyed by the dir name.
+
+        With `remove`, the directory is deleted once it is archived.
+        """
+        visit = basename(visit_dir.rstrip(os.sep))
+        for name in sorted(os.listdir(visit_dir)):
+            path = join(visit_dir, name)
+            if isfile(path):
+                self.add_file(visit, path)
+        if remove:
+            rmtree(visit_dir)
+
+    def close(self):
+        for fd in (self.fd, self.index_fd):
+            if not fd.closed:
+                os.fsync(fd.fileno())
+                fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArchiveReader(object):
+    """Random access to the members of an archive."""
+
+    def __init__(self, path, block_size=cm.ARCHIVE_BLOCK_SIZE):
+        self.path = path
+        self.block_size = block_size
+        size = getsize(path)
+        self.members = [m for m in read_index(path + INDEX_EXT)
+                        if m['offset'] + m['length'] <= size]
+        self.index = dict(((m['visit'], m['name']), m) for m in self.members)
+        self.visit_names = {}
+        for member in self.members:
+            self.visit_names.setdefault(member['visit'], []).append(
+                member['name'])
+        self.fd = open(path, 'rb')
+
+    def visits(self):
+        """Return the visit keys in archive order."""
+        visits, seen = [], set()
+        for member in self.members:
+            if member['visit'] not in seen:
+                seen.add(member['visit'])
+                visits.append(member['visit'])
+        return visits
+
+    def names(self, visit):
+        return self.visit_names.get(visit, [])
+
+    def iter_blocks(self, visit, name):
+        """Iterate over the decompressed blocks of a member."""
+        try:
+            member = self.index[(visit, name)]
+        except KeyError:
+            raise ArchiveError("No %s in visit %s" % (name, visit))
+        decompressor = zlib.decompressobj()
+        offset, end = member['offset'], member['offset'] + member['length']
+        crc = 0
+        while offset < end:
+            self.fd.seek(offset)  # other members may be read in between
+            data = self.fd.read(min(self.block_size, end - offset))
+            if not data:
+                break
+            offset += len(data)
+            block = decompressor.decompress(data)
+            crc = zlib.crc32(block, crc)
+            yield block
+        block = decompressor.flush()
+        crc = zlib.crc32(block, crc)
+        yield block
+        if crc & 0xffffffff != member['crc32']:
+            raise ArchiveError("CRC mismatch for %s in visit %s"
+                               % (name, visit))
+
+    def read(self, visit, name):
+        """Return the content of a member."""
+        return b''.join(self.iter_blocks(visit, name))
+
+    def extract(self, visit, name, out_path):
+        with open(out_path, 'wb') as f:
+            for block in self.iter_blocks(visit, name):
+                f.write(block)
+
+    def __iter__(self):
+        """Iterate over (visit, name, content) for every member."""
+        for member in self.members:
+            yield (member['visit'], member['name'],
+                   self.read(member['visit'], member['name']))
+
+    def close(self):
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def find_archives(crawl_dir):
+    """Return the archives of a crawl, one per worker."""
+    return sorted(glob(join(crawl_dir, ARCHIVE_PATTERN)))
@@ -0,0 +1,79 @@
+"""Compare the streaming pcap filter against the former scapy-based one.
+
+Usage: python -m tbcrawler.bench.bench_pcap [n_packets ...]
+"""
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from tbcrawler import pcaputils as pu
+from tbcrawler.bench.synthetic import random_ips, write_synthetic_pcap
+
+DEFAULT_SIZES = [5000, 20000]
+N_GUARDS = 2000
+
+
+def scapy_filter_pcap(in_path, out_path, iplist):
+    """Reference implementation: the filter_pcap shipped before streaming."""
+    from scapy.all import PcapReader, wrpcap
+    pcap_filtered = []
+    with PcapReader(in_path) as preader:
+        for p in preader:
+            if 'TCP' in p:
+                ip = p.payload
+                if ip.dst in iplist or ip.src in iplist:
+                    pcap_filtered.append(p)
+    wrpcap(out_path, pcap_filtered)
+
+
+def _measure(func, args, queue):
+    start = time.time()
+    func(*args)
+    elapsed = time.time() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def measure(func, *args):
+    """Run `func` in a fresh process, return (seconds, peak RSS in KB)."""
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_measure, args=(func, args, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def bench_filter_pcap(n_packets, tmpdir):
+    guards = random_ips(N_GUARDS, seed=1)
+    others = random_ips(50, seed=2)
+    in_path = os.path.join(tmpdir, "in_%s.pcap" % n_packets)
+    write_synthetic_pcap(in_path, n_packets, guards[:3], others)
+    results = {}
+    for name, func in (("scapy", scapy_filter_pcap),
+                       ("streaming", pu.filter_pcap)):
+        out_path = os.path.join(tmpdir, "%s_%s.pcap" % (name, n_packets))
+        results[name] = measure(func, in_path, out_path, set(guards))
+    return os.path.getsize(in_path), results
+
+
+def main(sizes):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for n_packets in sizes:
+            size, results = bench_filter_pcap(n_packets, tmpdir)
+            print("%s packets (%.1f MB):" % (n_packets, size / 1e6))
+            for name, (elapsed, maxrss) in sorted(results.items()):
+                print("  %-10s %8.3f s  %8d KB peak RSS"
+                      % (name, elapsed, maxrss))
+            print("  speedup: %.1fx" % (results["scapy"][0] /
+                                        results["streaming"][0]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or DEFAULT_SIZES)
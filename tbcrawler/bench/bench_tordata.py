@@ -0,0 +1,55 @@
+"""Compare full copies of a Tor data dir against hard-linked clones.
+
+Usage: python -m tbcrawler.bench.bench_tordata [n_launches]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tbcrawler import utils as ut
+
+# roughly the layout of a Tor Browser data dir after bootstrap
+TOR_DATA_FILES = {"cached-microdescs": 12 * 10 ** 6,
+                  "cached-microdescs.new": 2 * 10 ** 6,
+                  "cached-microdesc-consensus": 2 * 10 ** 6,
+                  "cached-certs": 20 * 10 ** 3,
+                  "state": 2 * 10 ** 3,
+                  "geoip": 4 * 10 ** 6,
+                  "geoip6": 5 * 10 ** 6}
+
+
+def make_tor_data_dir():
+    tor_data_dir = tempfile.mkdtemp()
+    for name, size in TOR_DATA_FILES.items():
+        with open(os.path.join(tor_data_dir, name), 'wb') as f:
+            f.write(os.urandom(size))
+    return tor_data_dir
+
+
+def time_clones(clone, tor_data_dir, n_launches):
+    start = time.time()
+    for _ in range(n_launches):
+        shutil.rmtree(clone(tor_data_dir))
+    return (time.time() - start) / n_launches
+
+
+def main(n_launches):
+    tor_data_dir = make_tor_data_dir()
+    try:
+        start = time.time()
+        ut.get_dir_template(tor_data_dir)
+        print("template:    %8.4f s (once per crawl)" % (time.time() - start))
+        for name, clone in (("copy_tree", ut.clone_dir_temporary),
+                            ("linked", ut.clone_dir_linked)):
+            print("%-12s %8.4f s per launch"
+                  % (name + ":", time_clones(clone, tor_data_dir,
+                                             n_launches)))
+    finally:
+        ut.remove_dir_templates()
+        shutil.rmtree(tor_data_dir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
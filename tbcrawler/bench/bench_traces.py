@@ -0,0 +1,83 @@
+"""Compare loading visit traces against re-parsing the captures.
+
+Usage: python -m tbcrawler.bench.bench_traces [n_packets ...]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tbcrawler import traces as tr
+from tbcrawler.bench.synthetic import random_ips, write_synthetic_pcap
+
+DEFAULT_SIZES = [10000, 100000]
+N_REPEAT = 5
+
+
+def scapy_read_pcap(pcap_path, guard_ips):
+    """Reference: read timestamps and signed lengths with scapy."""
+    from scapy.all import PcapReader
+    times, lengths = [], []
+    with PcapReader(pcap_path) as preader:
+        for p in preader:
+            if 'TCP' not in p:
+                continue
+            ip = p.payload
+            payload_len = len(ip.payload.payload)
+            if payload_len == 0:
+                continue
+            if ip.src in guard_ips:
+                payload_len = -payload_len
+            elif ip.dst not in guard_ips:
+                continue
+            times.append(p.time)
+            lengths.append(payload_len)
+    return times, lengths
+
+
+def best_time(func, *args):
+    """Return the best wall clock time of `N_REPEAT` runs of `func`."""
+    best = float('inf')
+    for _ in xrange(N_REPEAT):
+        start = time.time()
+        func(*args)
+        best = min(best, time.time() - start)
+    return best
+
+
+def bench_traces(n_packets, tmpdir):
+    guards = random_ips(3, seed=1)
+    pcap_path = os.path.join(tmpdir, "capture_%s.pcap" % n_packets)
+    write_synthetic_pcap(pcap_path, n_packets, guards, random_ips(50, seed=2))
+    trace_path, tao_path = tr.trace_paths(pcap_path)
+    tr.pcap_to_trace(pcap_path, guards)
+    results = {
+        "scapy read": best_time(scapy_read_pcap, pcap_path, set(guards)),
+        "extract": best_time(tr.extract_trace, pcap_path, guards),
+        "load trace": best_time(tr.load_trace, trace_path),
+    }
+    sizes = {"pcap": os.path.getsize(pcap_path),
+             "trace": os.path.getsize(trace_path),
+             "tao": os.path.getsize(tao_path)}
+    return sizes, results
+
+
+def main(sizes):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for n_packets in sizes:
+            file_sizes, results = bench_traces(n_packets, tmpdir)
+            print("%s packets (%s):" % (n_packets, ", ".join(
+                "%s %.2f MB" % (name, size / 1e6)
+                for name, size in sorted(file_sizes.items()))))
+            for name, elapsed in sorted(results.items()):
+                print("  %-12s %8.4f s" % (name, elapsed))
+            print("  load vs extract: %.0fx" % (results["extract"] /
+                                                results["load trace"]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or DEFAULT_SIZES)
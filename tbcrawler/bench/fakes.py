@@ -0,0 +1,222 @@
+"""Stand-ins for Tor, the browser and dumpcap to run the crawler offline."""
+import os
+import random
+import stat
+import tempfile
+import time
+import unittest
+from collections import namedtuple
+from contextlib import contextmanager
+from shutil import rmtree
+
+from tbcrawler import common as cm
+from tbcrawler import dumputils
+from tbcrawler.bench.synthetic import random_ips
+from tbcrawler.torcontroller import TorController
+
+RouterStatus = namedtuple('RouterStatus', ['fingerprint', 'address', 'flags'])
+CircuitEvent = namedtuple('CircuitEvent', ['type', 'id', 'status', 'path',
+                                           'purpose', 'reason'])
+
+# writes an empty capture, reports it like dumpcap and waits to be killed
+FAKE_DUMPCAP = r"""#!/bin/sh
+while [ $# -gt 0 ]; do
+    [ "$1" = "-w" ] && out="$2"
+    shift
+done
+printf '\324\303\262\241\002\000\004\000\000\000\000\000\000\000\000\000\377\377\000\000\001\000\000\000' > "$out"
+echo "File: $out" >&2
+exec sleep 3600
+"""
+
+
+def synthetic_consensus(n_relays, guard_ratio=0.4, seed=0):
+    """Return the router statuses of a consensus of `n_relays` relays."""
+    rnd = random.Random(seed)
+    consensus = []
+    for ip in random_ips(n_relays, seed=seed):
+        fingerprint = "%040X" % rnd.getrandbits(160)
+        flags = ['Fast', 'Running', 'Valid']
+        if rnd.random() < guard_ratio:
+            flags.append('Guard')
+        consensus.append(RouterStatus(fingerprint, ip, flags))
+    return consensus
+
+
+def synthetic_circuits(consensus, n_circuits, n_unknown=0, seed=0):
+    """Return 3-hop circuits built over the guards of the consensus.
+
+    Circuits are CIRC events, as returned by stem's get_circuits.
+
+    The first `n_unknown` circuits go through guards missing from the
+    consensus, to exercise the fallback lookup.
+    """
+    rnd = random.Random(seed)
+    guards = [r for r in consensus if 'Guard' in r.flags]
+    circuits = []
+    for i in xrange(n_circuits):
+        path = [(r.fingerprint, 'relay') for r in rnd.sample(consensus, 2)]
+        if i < n_unknown:
+            guard_fp = "%040X" % rnd.getrandbits(160)
+        else:
+            guard_fp = rnd.choice(guards).fingerprint
+        circuits.append(CircuitEvent('CIRC', str(i + 1), 'BUILT',
+                                     [(guard_fp, 'guard')] + path,
+                                     'GENERAL', None))
+    return circuits
+
+
+class FakeController(object):
+    """Answer the stem Controller calls of TorController from memory."""
+
+    def __init__(self, consensus, circuits=()):
+        self.consensus = consensus
+        self.circuits = circuits
+        self.listeners = []
+        self.event_types = {}  # listener: event types
+        self.signals = []
+        self.closed_circuits = []
+        self.calls = []  # names of the consensus and circuit queries
+
+    def get_network_statuses(self):
+        self.calls.append('get_network_statuses')
+        return iter(self.consensus)
+
+    def get_network_status(self, fingerprint):
+        self.calls.append('get_network_status')
+        return RouterStatus(fingerprint, '10.255.255.1', [])
+
+    def get_circuits(self):
+        self.calls.append('get_circuits')
+        return self.circuits
+
+    def get_streams(self):
+        return []
+
+    def add_event_listener(self, listener, *events):
+        self.listeners.append(listener)
+        self.event_types[listener] = events
+
+    def remove_event_listener(self, listener):
+        self.listeners.remove(listener)
+        del self.event_types[listener]
+
+    def emit(self, event):
+        """Deliver an event to the listeners of its type."""
+        for listener in list(self.listeners):
+            if event.type in self.event_types[listener]:
+                listener(event)
+
+    def build_circuit(self):
+        path = self.circuits[0].path if self.circuits else [('0' * 40, 'r')]
+        self.emit(CircuitEvent('CIRC', str(len(self.signals) + 100),
+                               'BUILT', path, 'GENERAL', None))
+
+    def get_newnym_wait(self):
+        return 0.0
+
+    def signal(self, signal):
+        self.signals.append(signal)
+        self.build_circuit()
+
+    def close_circuit(self, circuit_id):
+        self.closed_circuits.append(circuit_id)
+        if len(self.closed_circuits) % len(self.circuits) == 0:
+            self.build_circuit()
+
+    def close(self):
+        pass
+
+
+class FakeTorController(TorController):
+    """TorController running on a FakeController instead of a Tor process."""
+    fail = False  # launches fail as if the Tor process died
+
+    def __init__(self, tor_dir, consensus, circuits=(), **kwargs):
+        tor_binary_path = os.path.join(tor_dir, 'tor')
+        open(tor_binary_path, 'a').close()
+        super(FakeTorController, self).__init__(
+            tor_binary_path=tor_binary_path, tor_data_path=tor_dir, **kwargs)
+        self.consensus = consensus
+        self.circuits = circuits
+
+    def new_standby(self):
+        return self.__class__(self.tor_data_path, self.consensus,
+                              self.circuits,
+                              torrc_dict=self.get_standby_torrc())
+
+    def launch_tor_service(self, timeout=None):
+        if self.fail:
+            raise OSError("Process terminated")
+        self.controller = FakeController(self.consensus, self.circuits)
+        self.add_event_listeners()
+        self.build_guard_index()
+        self.tor_process = self.socks_port  # stands in for the process
+        return self.tor_process
+
+    def is_tor_alive(self):
+        return self.tor_process is not None
+
+    def quit(self):
+        self.controller = None
+        self.tor_process = None
+
+
+class FakeDriver(object):
+    """Browser that takes `latency` seconds to load any page."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.visited = []
+
+    @contextmanager
+    def launch(self):
+        yield self
+
+    def set_tor_ports(self, socks_port, control_port):
+        pass
+
+    def set_page_load_timeout(self, seconds):
+        pass
+
+    def get(self, url):
+        time.sleep(self.latency)
+        self.visited.append(url)
+
+    def get_screenshot_as_file(self, path):
+        open(path, 'w').close()
+        return True
+
+    def quit(self):
+        pass
+
+    def start_prelaunch(self):
+        pass
+
+    def quit_prelaunched(self):
+        pass
+
+
+def install_fake_dumpcap(directory):
+    """Write the fake dumpcap to `directory` and return its path."""
+    path = os.path.join(directory, 'dumpcap')
+    with open(path, 'w') as f:
+        f.write(FAKE_DUMPCAP)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+
+class FakeCrawlTestCase(unittest.TestCase):
+    """Crawl into a temporary directory, capturing with the fake dumpcap."""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dumpcap_path, self.crawl_dir = (dumputils.DUMPCAP_PATH,
+                                             cm.CRAWL_DIR)
+        dumputils.DUMPCAP_PATH = install_fake_dumpcap(self.tempdir)
+        cm.CRAWL_DIR = os.path.join(self.tempdir, 'crawl')
+        os.mkdir(cm.CRAWL_DIR)
+
+    def tearDown(self):
+        dumputils.DUMPCAP_PATH, cm.CRAWL_DIR = (self.dumpcap_path,
+                                                self.crawl_dir)
+        rmtree(self.tempdir)
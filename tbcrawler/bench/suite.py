@@ -0,0 +1,276 @@
+"""Offline benchmark suite of the crawler hot paths.
+
+Tor, the browser and dumpcap are replaced by the stand-ins in
+tbcrawler.bench.fakes, so the suite runs without TBB or network access.
+Results are written as JSON and can be compared against a baseline:
+
+    python -m tbcrawler.bench.suite -o baseline.json
+    python -m tbcrawler.bench.suite -o new.json --compare baseline.json
+
+Each benchmark records the best and median of its runs; the comparison
+uses the best times and fails if any is slower than `--max-slowdown`.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import dirname, join
+
+import numpy as np
+
+from tbcrawler import common as cm
+from tbcrawler import dumputils
+from tbcrawler import pcaputils as pu
+from tbcrawler.bench.fakes import (FakeDriver, FakeTorController,
+                                   install_fake_dumpcap, synthetic_circuits,
+                                   synthetic_consensus)
+from tbcrawler.bench.synthetic import random_ips, write_synthetic_pcap
+from tbcrawler.crawler import CrawlerBase, CrawlJob
+from tbcrawler.timing import monotonic
+
+# roughly the size of the current Tor consensus
+DEFAULT_PARAMS = {'n_relays': 7000, 'n_circuits': 12, 'n_packets': 20000,
+                  'n_sites': 1000, 'n_visits': 4, 'n_batches': 10,
+                  'crawl_sites': 20, 'crawl_batches': 2, 'latency': 0.01,
+                  'repeat': 5}
+QUICK_PARAMS = {'n_relays': 500, 'n_circuits': 4, 'n_packets': 1000,
+                'n_sites': 50, 'n_visits': 2, 'n_batches': 2,
+                'crawl_sites': 3, 'crawl_batches': 2, 'latency': 0.0,
+                'repeat': 2}
+DEFAULT_MAX_SLOWDOWN = 1.25
+JOB_CONFIG = {'pause_between_batches': '0', 'pause_between_sites': '0',
+              'pause_between_visits': '0', 'pause_in_site': '0'}
+
+
+def run_timed(func, repeat, setup=None):
+    """Return the durations of `repeat` calls of `func`.
+
+    `setup` is called before each run, outside of the measurement.
+    """
+    durations = []
+    for _ in xrange(repeat):
+        if setup is not None:
+            setup()
+        start = monotonic()
+        func()
+        durations.append(monotonic() - start)
+    return durations
+
+
+def result(durations, n_items=1, **info):
+    """Summarize the durations of a benchmark, per run and per item."""
+    best = min(durations)
+    info.update(best=best, median=float(np.median(durations)),
+                runs=len(durations), items=n_items,
+                best_per_item=best / n_items)
+    return info
+
+
+def bench_filter_pcap(params, tmpdir):
+    consensus = synthetic_consensus(params['n_relays'])
+    guard_ips = set(r.address for r in consensus if 'Guard' in r.flags)
+    in_path = join(tmpdir, 'capture.pcap')
+    out_path = join(tmpdir, 'filtered.pcap')
+    write_synthetic_pcap(in_path, params['n_packets'], sorted(guard_ips)[:3],
+                         random_ips(50, seed=2))
+    durations = run_timed(lambda: pu.filter_pcap(in_path, out_path,
+                                                 guard_ips),
+                          params['repeat'])
+    return result(durations, params['n_packets'],
+                  bytes=os.path.getsize(in_path))
+
+
+def bench_guard_lookup(params, tmpdir):
+    consensus = synthetic_consensus(params['n_relays'])
+    circuits = synthetic_circuits(consensus, params['n_circuits'],
+                                  n_unknown=1)
+    controller = FakeTorController(tmpdir, consensus, circuits)
+    controller.launch_tor_service()
+    n_lookups = 1000
+    results = {}
+    results['guard_index'] = result(
+        run_timed(controller.build_guard_index, params['repeat']),
+        params['n_relays'])
+
+    def lookups(func):
+        def run():
+            for _ in xrange(n_lookups):
+                func()
+        return run
+    results['guard_ips'] = result(
+        run_timed(lookups(controller.get_guard_ips), params['repeat']),
+        n_lookups, circuits=params['n_circuits'])
+    results['all_guard_ips'] = result(
+        run_timed(lookups(controller.get_all_guard_ips), params['repeat']),
+        n_lookups)
+    return results
+
+
+def bench_job_paths(params, tmpdir):
+    urls = ["http://site%s.example" % i for i in xrange(params['n_sites'])]
+    job = CrawlJob({'visits': params['n_visits'],
+                    'batches': params['n_batches']}, urls)
+
+    def run():
+        for job.batch in xrange(job.batches):
+            for job.site in job.sites:
+                for job.visit in xrange(job.visits):
+                    job.path, job.pcap_file, job.png_file, job.url
+
+    n_paths = params['n_batches'] * params['n_sites'] * params['n_visits']
+    return result(run_timed(run, params['repeat']), n_paths)
+
+
+def bench_crawl(params, tmpdir):
+    """Time the crawl loop around fake page loads of `latency` seconds.
+
+    `overhead_per_visit` is the time per visit not spent loading pages.
+    """
+    dumpcap_path = dumputils.DUMPCAP_PATH
+    crawl_dir = cm.CRAWL_DIR
+    consensus = synthetic_consensus(params['n_relays'])
+    circuits = synthetic_circuits(consensus, params['n_circuits'])
+    urls = ["http://site%s.example" % i
+            for i in xrange(params['crawl_sites'])]
+    config = dict(JOB_CONFIG, visits=1, batches=params['crawl_batches'])
+    n_visits = params['crawl_sites'] * params['crawl_batches']
+    dumputils.DUMPCAP_PATH = install_fake_dumpcap(tmpdir)
+    cm.CRAWL_DIR = join(tmpdir, 'crawl')
+
+    def setup():
+        shutil.rmtree(cm.CRAWL_DIR, ignore_errors=True)
+        os.mkdir(cm.CRAWL_DIR)
+
+    def run():
+        controller = FakeTorController(tmpdir, consensus, circuits)
+        crawler = CrawlerBase(FakeDriver(params['latency']), controller,
+                              guard_filter=True)
+        crawler.crawl(CrawlJob(config, urls))
+    try:
+        durations = run_timed(run, params['repeat'], setup)
+    finally:
+        dumputils.DUMPCAP_PATH = dumpcap_path
+        cm.CRAWL_DIR = crawl_dir
+    info = result(durations, n_visits, latency=params['latency'])
+    info['overhead_per_visit'] = info['best_per_item'] - params['latency']
+    return info
+
+
+BENCHMARKS = [('filter_pcap', bench_filter_pcap),
+              ('guard_lookup', bench_guard_lookup),
+              ('job_paths', bench_job_paths),
+              ('crawl', bench_crawl)]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=dirname(__file__), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(params=None, names=None):
+    """Run the benchmarks and return the results document."""
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    results = {}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, bench in BENCHMARKS:
+            if names and name not in names:
+                continue
+            bench_dir = join(tmpdir, name)
+            os.mkdir(bench_dir)
+            outcome = bench(params, bench_dir)
+            if 'best' in outcome:
+                results[name] = outcome
+            else:  # a group of benchmarks
+                for sub_name, sub_outcome in outcome.items():
+                    results["%s.%s" % (name, sub_name)] = sub_outcome
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'meta': {'time': time.time(), 'revision': git_revision(),
+                     'python': platform.python_version(),
+                     'machine': platform.machine(),
+                     'node': platform.node()},
+            'params': params, 'results': results}
+
+
+def compare(new, baseline, max_slowdown=DEFAULT_MAX_SLOWDOWN):
+    """Return [(name, baseline best, new best, ratio, regressed)].
+
+    Only benchmarks run with the same parameters are comparable.
+    """
+    if new['params'] != baseline['params']:
+        raise ValueError("Results were obtained with different parameters")
+    rows = []
+    for name in sorted(new['results']):
+        if name not in baseline['results']:
+            continue
+        old_best = baseline['results'][name]['best']
+        new_best = new['results'][name]['best']
+        ratio = new_best / old_best if old_best else float('inf')
+        rows.append((name, old_best, new_best, ratio, ratio > max_slowdown))
+    return rows
+
+
+def format_results(results):
+    lines = []
+    for name, info in sorted(results['results'].items()):
+        lines.append("%-26s %10.4f s  %12.3f us/item  (%s items)"
+                     % (name, info['best'], 1e6 * info['best_per_item'],
+                        info['items']))
+    return "\n".join(lines)
+
+
+def format_comparison(rows):
+    lines = []
+    for name, old_best, new_best, ratio, regressed in rows:
+        lines.append("%-26s %10.4f s -> %10.4f s  %6.2fx%s"
+                     % (name, old_best, new_best, ratio,
+                        "  REGRESSION" if regressed else ""))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run the offline benchmark suite.')
+    parser.add_argument('-o', '--output', help='Write the results to a '
+                        'JSON file.')
+    parser.add_argument('-c', '--compare', help='Baseline results to '
+                        'compare with.')
+    parser.add_argument('--max-slowdown', type=float,
+                        default=DEFAULT_MAX_SLOWDOWN,
+                        help='Slowdown ratio reported as a regression '
+                             '(default: %(default)s).')
+    parser.add_argument('--quick', action='store_true',
+                        help='Small inputs, to check that the suite runs.')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run (default: all of %s).'
+                             % ", ".join(name for name, _ in BENCHMARKS))
+    args = parser.parse_args(argv)
+    results = run_suite(QUICK_PARAMS if args.quick else None,
+                        args.benchmarks)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, args.max_slowdown)
+        print("\nCompared with %s:" % args.compare)
+        print(format_comparison(rows))
+        if any(row[-1] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
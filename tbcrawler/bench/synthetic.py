@@ -0,0 +1,122 @@
+"""Synthetic inputs for tests and benchmarks."""
+import random
+import struct
+from socket import inet_aton
+
+from tbcrawler import pcaputils as pu
+
+LOCAL_IP = "10.0.2.15"
+ETH_HEADER = b'\x00\x16\x3e\x00\x00\x01' + b'\x00\x16\x3e\x00\x00\x02' \
+    + pu.ETHERTYPE_IPV4
+
+
+def random_ips(n, seed=0):
+    """Return `n` distinct random public-looking IPv4 addresses."""
+    rnd = random.Random(seed)
+    ips = set()
+    while len(ips) < n:
+        ips.add("%d.%d.%d.%d" % (rnd.randint(11, 223), rnd.randint(0, 255),
+                                 rnd.randint(0, 255), rnd.randint(1, 254)))
+    return sorted(ips)
+
+
+def tcp_frame(src, dst, payload_len, sport=40000, dport=443, seq=0):
+    """Return an Ethernet/IPv4/TCP frame with a zeroed payload."""
+    tcp = struct.pack('>HHIIBBHHH', sport, dport, seq, 0, 5 << 4, 0x18,
+                      65535, 0, 0)
+    ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + payload_len,
+                     0, 0x4000, 64, 6, 0, inet_aton(src), inet_aton(dst))
+    return ETH_HEADER + ip + tcp + b'\x00' * payload_len
+
+
+def write_pcap_header(f):
+    f.write(struct.pack('<IHHiIII', pu.PCAP_MAGIC_USEC, 2, 4, 0, 0, 65535,
+                        pu.LINKTYPE_ETHERNET))
+
+
+def write_frames(path, frames, start_ts=1400000000.0, interval=0.001):
+    """Write the given frames to a pcap, `interval` seconds apart."""
+    with open(path, 'wb') as f:
+        write_pcap_header(f)
+        for i, frame in enumerate(frames):
+            ts = start_ts + i * interval
+            ts_sec = int(ts)
+            f.write(struct.pack('<IIII', ts_sec, int((ts - ts_sec) * 1e6),
+                                len(frame), len(frame)))
+            f.write(frame)
+
+
+def write_synthetic_pcap(path, n_packets, guard_ips, other_ips,
+                         guard_ratio=0.8, start_ts=1400000000.0,
+                         seed=0):
+    """Write a pcap of TCP packets between LOCAL_IP and the given hosts.
+
+    Roughly `guard_ratio` of the packets are exchanged with `guard_ips`,
+    the rest with `other_ips`. Return the number of guard packets written.
+    """
+    rnd = random.Random(seed)
+    n_guard = 0
+    ts = start_ts
+    next_seq = {}
+    with open(path, 'wb') as f:
+        write_pcap_header(f)
+        for _ in xrange(n_packets):
+            if rnd.random() < guard_ratio:
+                remote = rnd.choice(guard_ips)
+                n_guard += 1
+            else:
+                remote = rnd.choice(other_ips)
+            payload_len = rnd.choice((0, 0, 543, 1086, 1448))
+            outgoing = rnd.random() < 0.5
+            seq = next_seq.get((remote, outgoing), 0)
+            next_seq[(remote, outgoing)] = seq + payload_len
+            if outgoing:
+                frame = tcp_frame(LOCAL_IP, remote, payload_len, seq=seq)
+            else:
+                frame = tcp_frame(remote, LOCAL_IP, payload_len,
+                                  sport=443, dport=40000, seq=seq)
+            ts += rnd.expovariate(1000.0)
+            ts_sec = int(ts)
+            f.write(struct.pack('<IIII', ts_sec, int((ts - ts_sec) * 1e6),
+                                len(frame), len(frame)))
+            f.write(frame)
+    return n_guard
+
+
+def tshark_line(ts, src, dst, payload_len, proto='6', info='443 > 40000'):
+    """Return a line of the tshark CSV field export read by the crawler."""
+    if proto != '6':
+        return "%.6f,%s,%s,53,53,%s,%d,20,,,,,,%d,%s\n" % (
+            ts, src, dst, proto, 28 + payload_len, 42 + payload_len, info)
+    return "%.6f,%s,%s,40000,443,6,%d,20,20,0,0,0x0018,%d,%d,%s\n" % (
+        ts, src, dst, 40 + payload_len, payload_len, 54 + payload_len, info)
+
+
+def write_synthetic_tshark(path, n_lines, guard_ips, other_ips,
+                           guard_ratio=0.8, retransmit_ratio=0.01,
+                           start_ts=1400000000.0, seed=0):
+    """Write a tshark CSV export with TCP, UDP and retransmitted packets.
+
+    Return the number of TCP lines with payload exchanged with a guard.
+    """
+    rnd = random.Random(seed)
+    n_guard = 0
+    ts = start_ts
+    with open(path, 'wb') as f:
+        for _ in xrange(n_lines):
+            ts += rnd.expovariate(1000.0)
+            guard = rnd.random() < guard_ratio
+            remote = rnd.choice(guard_ips if guard else other_ips)
+            src, dst = LOCAL_IP, remote
+            if rnd.random() < 0.5:
+                src, dst = dst, src
+            if rnd.random() < 0.02:
+                f.write(tshark_line(ts, src, dst, 40, proto='17'))
+                continue
+            payload_len = rnd.choice((0, 0, 543, 1086, 1448))
+            info = '443 > 40000 [ACK] Seq=1, Len=%d' % payload_len
+            if rnd.random() < retransmit_ratio:
+                info = '[TCP Retransmission] ' + info
+            f.write(tshark_line(ts, src, dst, payload_len, info=info))
+            n_guard += guard and payload_len > 0
+    return n_guard
@@ -8,6 +8,20 @@ NUM_BATCHES = 10
 NUM_INSTANCES = 4
 MAX_SITES_PER_TOR_PROCESS = 100  # reset tor process after crawling 100 sites
 
+# fsync the crawl journal every N visits
+JOURNAL_SYNC_EVERY = 10
+
+# max visits waiting for background post-processing
+POST_QUEUE_SIZE = 8
+# gzip the unfiltered capture of each visit, processed inline or not
+COMPRESS_ORIGINAL_CAPTURE = True
+
+# prefix of the temporary dirs, followed by the kind of dir and the pid
+TMP_DIR_PREFIX = "tbcrawler-"
+# Tor data dir files that Tor may modify in place (journals, lock) and
+# small ones; the rest, which Tor replaces with new files, are hard linked
+TOR_MUTABLE_FILES = ("*.new", "lock", "state")
+
 # max dumpcap size in KB
 MAX_DUMP_SIZE = 40000
 # max filename length
@@ -18,11 +32,60 @@ STREAM_CLOSE_TIMEOUT = 20  # wait 20 seconds before raising an alarm signal
 # timeouts
 SOFT_VISIT_TIMEOUT = 120     # timeout used by selenium and dumpcap
 # signal based hard timeout in case soft timeout fails
-HARD_VISIT_TIMEOUT = SOFT_VISIT_TIMEOUT + 10
+HARD_VISIT_MARGIN = 10
+HARD_VISIT_TIMEOUT = SOFT_VISIT_TIMEOUT + HARD_VISIT_MARGIN
+
+# adaptive timeouts (--adaptive-timeouts), see loadtimes.py: the soft
+# timeout of a site is FACTOR times the PERCENTILE of its load times plus
+# MARGIN seconds, between ADAPTIVE_TIMEOUT_MIN and SOFT_VISIT_TIMEOUT
+# use the global timeout until then, a percentile of fewer loads is
+# about their maximum, often all on the same circuit
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 5
+ADAPTIVE_TIMEOUT_PERCENTILE = 95
+ADAPTIVE_TIMEOUT_FACTOR = 1.5
+ADAPTIVE_TIMEOUT_MARGIN = 5
+ADAPTIVE_TIMEOUT_MIN = 15
+ADAPTIVE_TIMEOUT_BACKOFF = 2  # timed out visits count as twice the timeout
 
 DEFAULT_SOCKS_PORT = 9051
 
+# how visits get fresh circuits (job option `reset`): restart Tor for
+# every batch, or keep one Tor process and send NEWNYM or close all
+# circuits before every visit
+RESET_RESTART = 'restart'
+RESET_NEWNYM = 'newnym'
+RESET_CIRCUITS = 'circuits'
+RESET_STRATEGIES = [RESET_RESTART, RESET_NEWNYM, RESET_CIRCUITS]
+TOR_RESET_CIRCUIT_TIMEOUT = 2  # seconds to wait for a new circuit
+
+TOR_LAUNCH_TIMEOUT = 270  # seconds to wait for Tor to bootstrap
+# standby Tor processes alternate between the configured ports and these
+# ports plus the offset, keep it above workers * WORKER_PORT_STRIDE
+TOR_STANDBY_PORT_OFFSET = 1000
+
+# end visits on traffic quiescence (--quiescence), see quiescence.py;
+# the idle window and min/max visit durations are job options
+QUIESCENCE_IDLE = 5
+QUIESCENCE_MIN_VISIT = 3
+QUIESCENCE_MAX_VISIT = SOFT_VISIT_TIMEOUT
+QUIESCENCE_MIN_BYTES = 1024  # bytes per second below which Tor is idle
+QUIESCENCE_POLL_INTERVAL = 0.1
+# page loads return right away and the crawler decides when visits end
+FF_LOAD_STRATEGY_PREF = ('webdriver.load.strategy', 'unstable')
+
+# parallel crawls: worker N uses the configured Tor ports plus N * stride
+WORKER_PORT_STRIDE = 2
+WORKER_START_INTERVAL = 5  # seconds between two worker launches
+
+# per-visit traces extracted from the captures
+TRACE_EXT = '.trace'
+TAO_EXT = '.tao'
+TOR_CELL_SIZE = 512
+
 CRAWLER_TYPES = ['Base', 'WebFP', 'Multitab']
+CAPTURE_MODES = ['visit', 'batch']
+CAPTURE_FILTERS = ['guards', 'tcp']
+TOR_EVENTS_FILE = 'tor_events.jsonl'  # next to the capture of a visit
 
 # virtual display dimensions
 DEFAULT_XVFB_WIN_W = 1280
@@ -45,9 +108,37 @@ FFPREF_FILE = join(DEFAULT_CONFIG_DIR, 'ffprefs')
 SRC_DIR = join(BASE_DIR, 'tbcrawler')
 CRAWL_DIR = join(RESULTS_DIR, strftime('%y%m%d_%H%M%S'))
 LOGS_DIR = join(CRAWL_DIR, 'logs')
-DEFAULT_CRAWL_LOG = join(LOGS_DIR, 'crawl.log')
+DEFAULT_CRAWL_LOG = join(LOGS_DIR, 'crawl.log')  # JSON lines, see log.py
+LOG_BATCH_SIZE = 1000  # max records written at once by the log writer
 DEFAULT_TOR_LOG = join(LOGS_DIR, 'tor.log')
 DEFAULT_FF_LOG = join(LOGS_DIR, 'ff.log')
+DEFAULT_JOURNAL = join(LOGS_DIR, 'journal.jsonl')
+DEFAULT_TOR_BOOTSTRAPS = join(LOGS_DIR, 'tor_bootstraps.json')
+DEFAULT_TIMINGS = join(LOGS_DIR, 'timings.jsonl')
+TIMINGS_PATTERN = 'timings*.jsonl'
+DEFAULT_LOAD_TIMES = join(LOGS_DIR, 'load_times.jsonl')
+LOAD_TIMES_PATTERN = 'load_times*.jsonl'
+TIMING_PERCENTILES = (50, 90, 99)
+
+# archive of the visit directories
+ARCHIVE_EXT = '.tbca'
+DEFAULT_ARCHIVE = join(CRAWL_DIR, 'crawl' + ARCHIVE_EXT)
+ARCHIVE_COMPRESSION_LEVEL = 6
+ARCHIVE_BLOCK_SIZE = 1024 * 1024
+
+# distributed crawls: nodes lease visits from a coordinator
+COORDINATOR_PORT = 7600
+COORDINATOR_LEASE_TIME = 600  # unreported visits are handed out again after
+COORDINATOR_HEARTBEAT = 30  # seconds between two lease renewals of a node
+COORDINATOR_RETRIES = 5  # reconnections before a node gives up
+COORDINATOR_REPORT_INTERVAL = 60  # seconds between two progress reports
+DEFAULT_COORDINATOR_DB = join(RESULTS_DIR, 'coordinator.sqlite')
+
+# post-crawl sanity checks
+SANITY_REPORT = 'sanity.json'
+SANITY_OUTLIER_Z = 3.5  # robust z-score of the packet count within a site
+SANITY_CHUNK_SIZE = 64  # visits handed to a checker process at once
+
 TEST_DIR = join(SRC_DIR, 'test')
 TBB_DIR = join(BASE_DIR, 'tor-browser_en-US')
 # Top URLs localized (DE) to prevent the effect of localization
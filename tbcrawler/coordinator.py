@@ -0,0 +1,420 @@
+"""Coordinator of a crawl spread over several nodes.
+
+The coordinator owns the visit space of a CrawlJob, (batch, site,
+instance) units, and keeps their state in a local SQLite database. Nodes
+crawl the same URL list and ask the coordinator for a lease before each
+visit, so the visits are shared out as the nodes pull them and adding a
+node adds its throughput. Nodes renew their leases with heartbeats and
+report each finished visit; the leases of a node that stops responding
+expire and its visits are handed out again.
+
+Only units that were leased are stored. Requests and responses are JSON
+lines over TCP:
+
+    {"op": "claim", "node": "node1.0", "batch": 0, "site": 3,
+     "instance": 1}
+    {"result": true}
+"""
+import argparse
+import json
+import socket
+import sqlite3
+import SocketServer
+import threading
+import time
+from hashlib import md5
+
+import common as cm
+from log import wl_log
+
+LEASED = 'leased'
+DONE = 'done'
+THROUGHPUT_WINDOW = 3600  # seconds of completed visits in the throughput
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (spec TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS units (
+    batch INTEGER NOT NULL,
+    site INTEGER NOT NULL,
+    instance INTEGER NOT NULL,
+    node TEXT NOT NULL,
+    state TEXT NOT NULL,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    outcome TEXT,
+    done_at REAL,
+    PRIMARY KEY (batch, site, instance));
+CREATE INDEX IF NOT EXISTS units_node ON units (node, state);
+CREATE INDEX IF NOT EXISTS units_done_at ON units (done_at);
+CREATE TABLE IF NOT EXISTS nodes (
+    node TEXT PRIMARY KEY,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0);
+"""
+
+
+class CoordinatorError(Exception):
+    pass
+
+
+def job_spec(job):
+    """Describe the visit space of a job, to check nodes crawl the same."""
+    sites = [(site, job.urls[site]) for site in job.sites]
+    return {'batches': job.batches, 'visits': job.visits,
+            'sites': len(sites), 'digest': md5(json.dumps(sites)).hexdigest()}
+
+
+def parse_address(address):
+    """Parse "host:port", the port defaults to COORDINATOR_PORT."""
+    host, _, port = address.rpartition(':')
+    if not host:
+        return address, cm.COORDINATOR_PORT
+    return host, int(port)
+
+
+class CoordinatorStore(object):
+    """State of the visits and nodes of a crawl, in SQLite.
+
+    Methods take the current time as `now`, leases are valid until
+    `now + lease_time` unless renewed.
+    """
+    OPS = ('register', 'claim', 'complete', 'heartbeat', 'is_completed',
+           'batch_completed', 'status')
+
+    def __init__(self, path, lease_time=cm.COORDINATOR_LEASE_TIME):
+        self.lease_time = lease_time
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        row = self.db.execute("SELECT spec FROM job").fetchone()
+        self.spec = json.loads(row[0]) if row else None
+
+    def register(self, node, spec, now):
+        with self.lock, self.db:
+            if self.spec is None:
+                self.spec = spec
+                self.db.execute("INSERT INTO job VALUES (?)",
+                                (json.dumps(spec),))
+            elif spec != self.spec:
+                raise CoordinatorError("Node %s crawls another job: %s, "
+                                       "expected %s" % (node, spec,
+                                                        self.spec))
+            self.db.execute("INSERT OR IGNORE INTO nodes (node, first_seen, "
+                            "last_seen) VALUES (?, ?, ?)", (node, now, now))
+            self._seen(node, now)
+        return {'lease_time': self.lease_time}
+
+    def _seen(self, node, now):
+        self.db.execute("UPDATE nodes SET last_seen = ? WHERE node = ?",
+                        (now, node))
+
+    def _unit(self, batch, site, instance):
+        return self.db.execute(
+            "SELECT node, state, expires FROM units WHERE batch = ? AND "
+            "site = ? AND instance = ?", (batch, site, instance)).fetchone()
+
+    def claim(self, node, batch, site, instance, now):
+        """Lease a visit to `node`, return False if it is not available."""
+        with self.lock, self.db:
+            unit = self._unit(batch, site, instance)
+            if unit is None:
+                self.db.execute(
+                    "INSERT INTO units (batch, site, instance, node, state, "
+                    "expires) VALUES (?, ?, ?, ?, ?, ?)",
+                    (batch, site, instance, node, LEASED,
+                     now + self.lease_time))
+                return True
+            owner, state, expires = unit
+            if state == DONE or (owner != node and expires >= now):
+                return False
+            # renewed by its owner, or taken over from an expired lease
+            self.db.execute(
+                "UPDATE units SET node = ?, expires = ?, attempts = attempts "
+                "+ ? WHERE batch = ? AND site = ? AND instance = ?",
+                (node, now + self.lease_time, int(owner != node), batch,
+                 site, instance))
+            return True
+
+    def complete(self, node, batch, site, instance, outcome, now):
+        with self.lock, self.db:
+            unit = self._unit(batch, site, instance)
+            if unit is not None and unit[1] == DONE:
+                return False
+            self.db.execute(
+                "INSERT OR REPLACE INTO units (batch, site, instance, node, "
+                "state, attempts, outcome, done_at) VALUES (?, ?, ?, ?, ?, "
+                "COALESCE((SELECT attempts FROM units WHERE batch = ? AND "
+                "site = ? AND instance = ?), 1), ?, ?)",
+                (batch, site, instance, node, DONE, batch, site, instance,
+                 outcome, now))
+            self.db.execute("UPDATE nodes SET completed = completed + 1 "
+                            "WHERE node = ?", (node,))
+            self._seen(node, now)
+            return True
+
+    def heartbeat(self, node, now):
+        """Renew the leases of a node, return their number."""
+        with self.lock, self.db:
+            self._seen(node, now)
+            return self.db.execute(
+                "UPDATE units SET expires = ? WHERE node = ? AND state = ?",
+                (now + self.lease_time, node, LEASED)).rowcount
+
+    def is_completed(self, node, batch, site, instance, now):
+        """Return True if the visit is done or leased to a live node."""
+        with self.lock:
+            unit = self._unit(batch, site, instance)
+        if unit is None:
+            return False
+        owner, state, expires = unit
+        return state == DONE or (owner != node and expires >= now)
+
+    def batch_completed(self, node, batch, now):
+        """Return True if no visit of the batch is available to `node`."""
+        with self.lock:
+            unavailable = self.db.execute(
+                "SELECT COUNT(*) FROM units WHERE batch = ? AND (state = ? "
+                "OR (node != ? AND expires >= ?))",
+                (batch, DONE, node, now)).fetchone()[0]
+        return unavailable >= self.spec['sites'] * self.spec['visits']
+
+    def status(self, now, node=None):
+        """Return the progress of the crawl and the throughput per node."""
+        with self.lock:
+            done, leased, expired, requeued = self.db.execute(
+                "SELECT COALESCE(SUM(state = ?), 0), "
+                "COALESCE(SUM(state = ? AND expires >= ?), 0), "
+                "COALESCE(SUM(state = ? AND expires < ?), 0), "
+                "COALESCE(SUM(attempts - 1), 0) FROM units",
+                (DONE, LEASED, now, LEASED, now)).fetchone()
+            recent = self.db.execute(
+                "SELECT node, COUNT(*) FROM units WHERE done_at >= ? "
+                "GROUP BY node", (now - THROUGHPUT_WINDOW,)).fetchall()
+            nodes = self.db.execute(
+                "SELECT node, first_seen, last_seen, completed "
+                "FROM nodes").fetchall()
+        spec = self.spec or {'batches': 0, 'sites': 0, 'visits': 0}
+        total = spec['batches'] * spec['sites'] * spec['visits']
+        recent = dict(recent)
+        window = lambda first_seen: max(min(now - first_seen,
+                                            THROUGHPUT_WINDOW), 1)
+        node_stats = dict(
+            (name, {'completed': completed,
+                    'alive': now - last_seen <= self.lease_time,
+                    'visits_per_hour': 3600.0 * recent.get(name, 0) /
+                    window(first_seen)})
+            for name, first_seen, last_seen, completed in nodes)
+        return {'total': total, 'done': done, 'leased': leased,
+                'expired': expired, 'requeued': requeued,
+                'available': total - done - leased,
+                'finished': total > 0 and done >= total,
+                'visits_per_hour': sum(s['visits_per_hour']
+                                       for s in node_stats.values()),
+                'nodes': node_stats}
+
+    def close(self):
+        self.db.close()
+
+
+class CoordinatorHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        store = self.server.store
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+                op = request.pop('op', None)
+                if op not in store.OPS:
+                    raise CoordinatorError("Unknown operation: %s" % op)
+                params = dict((str(k), v) for k, v in request.items())
+                response = {'result': getattr(store, op)(now=time.time(),
+                                                         **params)}
+            except (ValueError, TypeError, CoordinatorError,
+                    sqlite3.Error) as e:
+                response = {'error': "%s: %s" % (e.__class__.__name__, e)}
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class CoordinatorServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, store):
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 CoordinatorHandler)
+        self.store = store
+
+
+class CoordinatorClient(object):
+    """Crawl journal backed by the coordinator, for one crawl process.
+
+    Visits are recorded in the local `journal` too, if given.
+    """
+
+    def __init__(self, address, node, job, journal=None,
+                 heartbeat=cm.COORDINATOR_HEARTBEAT,
+                 retries=cm.COORDINATOR_RETRIES):
+        self.address = address
+        self.node = node
+        self.journal = journal
+        self.heartbeat_interval = heartbeat
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.sock = self.rfile = None
+        self.call('register', spec=job_spec(job))
+        self.stopped = threading.Event()
+        self.heartbeat_thread = threading.Thread(target=self.send_heartbeats)
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+        self.sock = self.rfile = None
+
+    def call(self, op, **params):
+        """Send a request, reconnecting if needed, and return the result.
+
+        Requests are idempotent, so they are safe to send again.
+        """
+        request = json.dumps(dict(params, op=op, node=self.node)) + "\n"
+        error = None
+        with self.lock:
+            for attempt in xrange(self.retries):
+                try:
+                    if self.sock is None:
+                        self.sock = socket.create_connection(self.address)
+                        self.rfile = self.sock.makefile('rb')
+                    self.sock.sendall(request)
+                    line = self.rfile.readline()
+                    if line:
+                        break
+                    error = "connection closed"
+                except socket.error as e:
+                    error = e
+                self.disconnect()
+                time.sleep(min(2 ** attempt, self.heartbeat_interval))
+            else:
+                raise CoordinatorError("Cannot reach the coordinator at "
+                                       "%s:%s: %s" % (self.address + (error,)))
+        response = json.loads(line)
+        if 'error' in response:
+            raise CoordinatorError(response['error'])
+        return response['result']
+
+    def send_heartbeats(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                self.call('heartbeat')
+            except CoordinatorError as e:
+                wl_log.error("Heartbeat failed: %s", e)
+
+    def is_completed(self, batch, site, instance):
+        return self.call('is_completed', batch=batch, site=site,
+                         instance=instance)
+
+    def claim(self, batch, site, instance):
+        """Lease the visit, return False if another node has it."""
+        return self.call('claim', batch=batch, site=site, instance=instance)
+
+    def is_batch_completed(self, batch, sites, instances):
+        return self.call('batch_completed', batch=batch)
+
+    def record(self, batch, site, instance, url, outcome, end=None):
+        if self.journal:
+            self.journal.record(batch, site, instance, url, outcome, end)
+        self.call('complete', batch=batch, site=site, instance=instance,
+                  outcome=outcome)
+
+    def status(self):
+        return self.call('status')
+
+    def wait_for_work(self):
+        """Wait until visits are available again or the crawl is over.
+
+        Return False once all the visits are done. Visits leased to other
+        nodes become available if their leases expire.
+        """
+        while True:
+            status = self.status()
+            if status['finished']:
+                return False
+            if status['available'] > 0:
+                return True
+            wl_log.info("Waiting for %s visits leased to other nodes",
+                        status['leased'])
+            time.sleep(self.heartbeat_interval)
+
+    def close(self):
+        self.stopped.set()
+        if self.journal:
+            self.journal.close()
+        with self.lock:
+            self.disconnect()
+
+
+def format_status(status):
+    lines = ["%(done)s/%(total)s visits done, %(leased)s leased, "
+             "%(expired)s expired, %(requeued)s requeued, "
+             "%(visits_per_hour).1f visits/h" % status]
+    for node, stats in sorted(status['nodes'].items()):
+        lines.append("  %-24s %8d done %8.1f visits/h%s"
+                     % (node, stats['completed'], stats['visits_per_hour'],
+                        "" if stats['alive'] else "  (lost)"))
+    return "\n".join(lines)
+
+
+def report_progress(store, interval):
+    while True:
+        time.sleep(interval)
+        wl_log.info(format_status(store.status(time.time())))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Share out the visits of a crawl between nodes.')
+    parser.add_argument('-d', '--db', default=cm.DEFAULT_COORDINATOR_DB,
+                        help='SQLite database of the crawl state '
+                             '(default: %(default)s).')
+    parser.add_argument('-a', '--address', default='0.0.0.0:%s'
+                        % cm.COORDINATOR_PORT,
+                        help='Address to listen on (default: %(default)s).')
+    parser.add_argument('-l', '--lease-time', type=float,
+                        default=cm.COORDINATOR_LEASE_TIME,
+                        help='Seconds after which the visits of a silent '
+                             'node are handed out again (default: '
+                             '%(default)s).')
+    parser.add_argument('-r', '--report-interval', type=float,
+                        default=cm.COORDINATOR_REPORT_INTERVAL,
+                        help='Seconds between progress reports.')
+    parser.add_argument('--status', action='store_true',
+                        help='Print the progress of a running coordinator '
+                             'at --address and exit.')
+    args = parser.parse_args()
+    address = parse_address(args.address)
+    if args.status:
+        sock = socket.create_connection(address)
+        sock.sendall(json.dumps({'op': 'status'}) + "\n")
+        print(format_status(json.loads(sock.makefile().readline())['result']))
+        return
+    store = CoordinatorStore(args.db, args.lease_time)
+    server = CoordinatorServer(address, store)
+    reporter = threading.Thread(target=report_progress,
+                                args=(store, args.report_interval))
+    reporter.daemon = True
+    reporter.start()
+    wl_log.info("Coordinator listening on %s:%s", *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
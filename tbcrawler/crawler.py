@@ -1,20 +1,66 @@
-from os.path import join
+import os
+import socket
+from contextlib import contextmanager
+from functools import partial
+from os.path import dirname, join, splitext
 from pprint import pformat
-from time import sleep
+from threading import Lock
+from time import sleep, time
+from urllib2 import URLError
 
 from selenium.common.exceptions import TimeoutException, WebDriverException
 
 import common as cm
+import timing
 import utils as ut
-from dumputils import Sniffer
+from dumputils import Sniffer, build_guard_filter
 from log import wl_log
+from pcaputils import CaptureIndex, PcapFormatError
+from postprocess import log_result, process_visit
+from quiescence import END_MAX_DURATION, END_PAUSE
 
 
 class CrawlerBase(object):
-    def __init__(self, driver, controller, screenshots=True):
+    def __init__(self, driver, controller, screenshots=True,
+                 guard_filter=False, post_processor=None,
+                 capture_mode='visit', journal=None, archive=None,
+                 quiescence=None, load_times=None, event_recorder=None):
         self.driver = driver
         self.controller = controller
         self.screenshots = screenshots
+        # only capture traffic to the guards of our own Tor process, the
+        # filter is refreshed when circuits use other guards
+        self.guard_filter = guard_filter
+        self.capture_guard_ips = frozenset()  # guards in the capture filter
+        self.filter_stale = False
+        self.visit_filtered = False  # the capture only has guard traffic
+        if guard_filter:
+            controller.guard_listeners.append(self.guard_used)
+        # process visits in the background instead of in post_visit
+        self.post_processor = post_processor
+        # 'visit': one capture per visit, 'batch': one capture per batch
+        # (and Tor process), split into visits at the end of the batch
+        self.capture_mode = capture_mode
+        self.batch_captures = []  # (capture path, visit slices)
+        self.sniffer = None
+        # visits recorded in the journal are skipped
+        self.journal = journal
+        # visit directories are moved into the archive once processed
+        self.archive = archive
+        # end visits when the TrafficMonitor sees no more traffic,
+        # instead of after pause_in_site
+        self.quiescence = quiescence
+        self.end_reason = None  # why the current visit ended
+        # loadtimes.LoadTimeProfile to derive the timeout of each visit
+        self.load_times = load_times
+        self.visit_timeout = cm.SOFT_VISIT_TIMEOUT
+        # the hard deadline quit the browser of the current visit
+        self.driver_cancelled = False
+        # hard deadlines only cancel the page load they were set for
+        self.visit_token = 0
+        self.cancel_lock = Lock()
+        # events.EventRecorder, writes the Tor events of each visit
+        self.event_recorder = event_recorder
 
         self.job = None
 
@@ -23,13 +69,128 @@ class CrawlerBase(object):
         self.job = job
         wl_log.info("Starting new crawl")
         wl_log.info(pformat(self.job))
+        try:
+            with self.tor_session():
+                self.__do_batches()
+                # in a distributed crawl, visits of lost nodes are done
+                # again
+                while (self.journal is not None and
+                       self.journal.wait_for_work()):
+                    wl_log.info("Crawling the visits left by other nodes")
+                    self.__do_batches()
+        finally:
+            self.post_crawl()
+
+    @contextmanager
+    def tor_session(self):
+        """Run one Tor process for the whole crawl, unless Tor is
+        restarted for every batch (the `restart` reset strategy)."""
+        if self.controller.reset_strategy == cm.RESET_RESTART:
+            yield
+            return
+        with self.controller.launch():
+            self.driver.set_tor_ports(self.controller.socks_port,
+                                      self.controller.control_port)
+            yield
+
+    def __do_batches(self):
         for self.job.batch in xrange(self.job.batches):
+            if self.is_batch_completed():
+                wl_log.info("Skipping completed batch %s", self.job.batch)
+                continue
             wl_log.info("**** Starting batch %s ***" % self.job.batch)
-            self.__do_batch()
-            sleep(float(self.job.config['pause_between_batches']))
+            with timing.recorder.record('batch', batch=self.job.batch):
+                self.__do_batch()
+                with timing.phase('pause_between_batches'):
+                    sleep(float(self.job.config['pause_between_batches']))
+
+    def post_visit(self, on_done):
+        """Process the current visit, then call `on_done`."""
+        self.pack_visit(self.job.path)
+        on_done()
+
+    def post_crawl(self):
+        """Wait for the visits still being processed in the background."""
+        if self.post_processor:
+            self.post_processor.close()
+        if self.journal:
+            self.journal.close()
+        if self.archive:
+            self.archive.close()
+        if self.load_times:
+            self.load_times.close()
+
+    def pack_visit(self, visit_dir):
+        if self.archive:
+            self.archive.add_visit(visit_dir, remove=True)
+
+    def visit_done(self, outcome, end_reason=None):
+        """Post-process the current visit and mark it as completed.
+
+        Visits processed in the background are only marked completed
+        once processed, a resumed crawl does them again otherwise.
+        """
+        on_done = partial(self.record_visit, self.job.batch, self.job.site,
+                          self.job.instance, self.job.url, outcome,
+                          end_reason)
+        with timing.phase('post_visit'):
+            self.post_visit(on_done)
+
+    def record_visit(self, batch, site, instance, url, outcome, end_reason):
+        if self.journal:
+            self.journal.record(batch, site, instance, url, outcome,
+                                end=end_reason)
+
+    def is_visit_completed(self):
+        """Return True if the visit is done, or leased to another node."""
+        return self.journal is not None and not self.journal.claim(
+            self.job.batch, self.job.site, self.job.instance)
+
+    def is_batch_completed(self):
+        if self.journal is None:
+            return False
+        instances = [self.job.batch * self.job.visits + visit
+                     for visit in xrange(self.job.visits)]
+        return self.journal.is_batch_completed(self.job.batch,
+                                               self.job.sites, instances)
+
+    def get_capture_filter(self):
+        """Return the capture filter for the next visit."""
+        self.capture_guard_ips = frozenset()
+        if self.guard_filter:
+            self.filter_stale = False
+            guard_ips = self.controller.get_guard_ips()
+            if guard_ips:
+                self.capture_guard_ips = frozenset(guard_ips)
+                return build_guard_filter(guard_ips)
+            wl_log.warning("No circuits found, capturing all TCP traffic.")
+        return cm.DEFAULT_FILTER
+
+    def guard_used(self, ip):
+        """Mark the capture filter stale if a circuit uses a new guard.
 
-    def post_visit(self):
-        pass
+        Called by the controller, from the thread of the Tor events.
+        """
+        if ip is None or ip not in self.capture_guard_ips:
+            self.filter_stale = True
+
+    def capture_filtered(self):
+        """Return True if the capture has all the traffic to our guards
+        and nothing else, so post-filtering can be skipped."""
+        return bool(self.capture_guard_ips) and not self.filter_stale
+
+    def check_capture_filter(self, outcome):
+        """Return the outcome of a visit given the state of its filter.
+
+        A visit that used a guard missing from the capture filter has a
+        truncated capture, it is recorded as 'stale_filter'.
+        """
+        if outcome == 'ok' and self.capture_guard_ips and self.filter_stale:
+            wl_log.warning("A circuit used a new guard during the visit to "
+                           "%s, traffic to it was not captured.",
+                           self.job.url)
+            return 'stale_filter'
+        return outcome
 
     def __do_batch(self):
         """
@@ -37,55 +198,278 @@ class CrawlerBase(object):
         If the controller is configured to not pollute the profile, each
         restart forces to switch the entry guard.
         """
-        with self.controller.launch():
-            for self.job.site in xrange(len(self.job.urls)):
-                if len(self.job.url) > cm.MAX_FNAME_LENGTH:
-                    wl_log.warning("URL is too long: %s" % self.job.url)
-                    continue
-                self.__do_instance()
-                sleep(float(self.job.config['pause_between_sites']))
+        if self.controller.reset_strategy != cm.RESET_RESTART:
+            # the Tor process of the crawl is reset before every visit
+            self.__do_batch_sites()
+            return
+        last_batch = self.job.batch == self.job.batches - 1
+        with self.controller.launch(prepare_next=not last_batch):
+            # the Tor process may be a standby on other ports
+            self.driver.set_tor_ports(self.controller.socks_port,
+                                      self.controller.control_port)
+            self.__do_batch_sites()
+
+    def __do_batch_sites(self):
+        if self.capture_mode == 'batch':
+            try:
+                self.__do_sites()
+            finally:
+                self.stop_batch_capture()
+            for capture_path, visit_slices in self.batch_captures:
+                self.split_capture(capture_path, visit_slices)
+            self.batch_captures = []
+        else:
+            self.__do_sites()
+
+    def refresh_batch_capture(self):
+        """Start the batch capture, or a new one if its filter is stale.
+
+        The capture filter cannot be changed while dumpcap runs, so a
+        new ring capture is started when a circuit uses a guard that is
+        not in the filter.
+        """
+        if self.sniffer is not None and not self.filter_stale:
+            return
+        self.stop_batch_capture()
+        capture_path = self.job.batch_pcap_file
+        if self.batch_captures:
+            prefix, ext = splitext(capture_path)
+            capture_path = "%s.%s%s" % (prefix, len(self.batch_captures),
+                                        ext)
+            wl_log.info("Guards changed, restarting the batch capture")
+        ut.create_dir(dirname(capture_path))
+        self.sniffer = Sniffer(path=capture_path,
+                               filter=self.get_capture_filter(), ring=True)
+        self.sniffer.start_capture()
+        self.batch_captures.append((capture_path, []))
+
+    def stop_batch_capture(self):
+        if self.sniffer is not None:
+            self.sniffer.stop_capture()
+            self.sniffer = None
+
+    def __do_sites(self):
+        for self.job.site in self.job.sites:
+            self.__do_instance()
+            sleep(float(self.job.config['pause_between_sites']))
+
+    def split_capture(self, capture_path, visit_slices):
+        """Cut a batch capture into the captures of its visits.
+
+        Post-visit processing of the batch runs here, once the visit
+        captures are on disk. Visits of a capture that cannot be read,
+        e.g. dumpcap died, are recorded as errors.
+        """
+        index = CaptureIndex(capture_path)
+        for (self.job.site, self.job.visit, start, end, outcome,
+             end_reason, self.visit_filtered) in visit_slices:
+            try:
+                with timing.phase('split_capture'):
+                    n_packets = index.extract(start, end, self.job.pcap_file)
+            except (PcapFormatError, IOError, OSError) as exc:
+                wl_log.error("Cannot extract the visit to %s: %s",
+                             self.job.url, exc)
+                self.record_visit(self.job.batch, self.job.site,
+                                  self.job.instance, self.job.url, 'error',
+                                  end_reason)
+                continue
+            wl_log.info("Extracted %s packets to %s", n_packets,
+                        self.job.pcap_file)
+            self.visit_done(outcome, end_reason)
+        index.remove_files()
 
     def __do_instance(self):
         for self.job.visit in xrange(self.job.visits):
+            if self.is_visit_completed():
+                continue
             ut.create_dir(self.job.path)
             wl_log.info("*** Visit #%s to %s ***", self.job.visit, self.job.url)
-            with self.driver.launch():
+            with timing.recorder.record('visit', batch=self.job.batch,
+                                        site=self.job.site,
+                                        instance=self.job.instance) as rec:
+                self.controller.reset()
+                rec['outcome'] = self.__do_instance_visit()
+                rec['end'] = self.end_reason
+                rec['timeout'] = self.visit_timeout
+
+    def __do_instance_visit(self):
+        self.visit_timeout = self.get_visit_timeout()
+        self.driver_cancelled = False
+        with self.driver.launch():
+            try:
+                self.driver.set_page_load_timeout(self.visit_timeout)
+            except WebDriverException as seto_exc:
+                wl_log.error("Setting soft timeout %s", seto_exc)
+            outcome = self.__do_visit()
+            # there is no browser left to take a screenshot with
+            if self.screenshots and not self.driver_cancelled:
                 try:
-                    self.driver.set_page_load_timeout(cm.SOFT_VISIT_TIMEOUT)
-                except WebDriverException as seto_exc:
-                    wl_log.error("Setting soft timeout %s", seto_exc)
-                self.__do_visit()
-                if self.screenshots:
-                    try:
+                    with timing.phase('screenshot'):
                         self.driver.get_screenshot_as_file(self.job.png_file)
-                    except WebDriverException:
-                        wl_log.error("Cannot get screenshot.")
+                except (WebDriverException, URLError, socket.error):
+                    wl_log.error("Cannot get screenshot.")
+        with timing.phase('pause_between_visits'):
             sleep(float(self.job.config['pause_between_visits']))
-            self.post_visit()
+        if self.capture_mode != 'batch':
+            self.visit_done(outcome, self.end_reason)
+        return outcome
+
+    def load_page(self):
+        """Load the page, recording the Tor events of the visit."""
+        if self.event_recorder is None:
+            return self.__load_page()
+        # circuits built before the visit, preemptive ones included
+        self.event_recorder.start(self.controller.get_circuits())
+        try:
+            return self.__load_page()
+        finally:
+            events = self.event_recorder.stop()
+            with timing.phase('write_events'):
+                self.event_recorder.write(events, self.job.events_file)
 
     def __do_visit(self):
-        with Sniffer(path=self.job.pcap_file, filter=cm.DEFAULT_FILTER):
-            sleep(1)  # make sure dumpcap is running
-            try:
-                with ut.timeout(cm.HARD_VISIT_TIMEOUT):
-                    self.driver.get(self.job.url)
-                    sleep(float(self.job.config['pause_in_site']))
-            except (cm.HardTimeoutException, TimeoutException):
-                wl_log.error("Visit to %s has timed out!", self.job.url)
-            except Exception as exc:
-                wl_log.error("Unknown exception: %s", exc)
+        """Load the page and return the outcome of the visit."""
+        if self.capture_mode == 'batch':
+            self.refresh_batch_capture()
+            # pcap timestamps are wall-clock times
+            start = time()
+            outcome = self.check_capture_filter(self.load_page())
+            visit_slices = self.batch_captures[-1][1]
+            visit_slices.append((self.job.site, self.job.visit, start,
+                                 time(), outcome, self.end_reason,
+                                 self.capture_filtered()))
+        else:
+            with Sniffer(path=self.job.pcap_file,
+                         filter=self.get_capture_filter(),
+                         duration=self.get_visit_duration()):
+                outcome = self.load_page()
+            self.visit_filtered = self.capture_filtered()
+            outcome = self.check_capture_filter(outcome)
+        # the capture of the page is over, browser startup traffic is not
+        # part of the visit from here on
+        self.driver.start_prelaunch()
+        return outcome
+
+    def get_visit_timeout(self):
+        """Return the soft timeout of the current visit."""
+        if self.load_times is None:
+            return cm.SOFT_VISIT_TIMEOUT
+        timeout = self.load_times.timeout(self.job.url)
+        wl_log.debug("Timeout of the visit to %s: %.1f s", self.job.url,
+                     timeout)
+        return timeout
+
+    def get_quiescence_config(self):
+        """Return the idle window, min and max durations of visits."""
+        config = self.job.config
+        return (float(config.get('quiescence_idle', cm.QUIESCENCE_IDLE)),
+                float(config.get('quiescence_min', cm.QUIESCENCE_MIN_VISIT)),
+                float(config.get('quiescence_max', cm.QUIESCENCE_MAX_VISIT)))
+
+    def get_visit_duration(self):
+        """Return how long the page load and the wait in the site can take."""
+        if self.quiescence is None:
+            return self.visit_timeout + float(self.job.config['pause_in_site'])
+        idle, _, max_duration = self.get_quiescence_config()
+        return min(max_duration, self.visit_timeout + idle)
+
+    def wait_in_site(self, start):
+        """Wait for the page to finish loading, return why the visit ended.
+
+        Without a traffic monitor, wait `pause_in_site` seconds after the
+        page load. Otherwise wait until Tor has been idle for
+        `quiescence_idle` seconds, `start` being the start of the visit.
+        """
+        if self.quiescence is None:
+            with timing.phase('pause_in_site'):
+                sleep(float(self.job.config['pause_in_site']))
+            return END_PAUSE
+        idle, min_duration, _ = self.get_quiescence_config()
+        with timing.phase('wait_quiescence'):
+            return self.quiescence.wait(start, idle, min_duration,
+                                        self.get_visit_duration())
+
+    def add_load_time(self, load_time, timed_out=False):
+        if self.load_times is not None:
+            self.load_times.add(self.job.url, load_time, timed_out)
+
+    def cancel_visit(self, token):
+        """Quit the browser to unblock a hung page load.
+
+        Called by the hard deadline, from a thread of the scheduler that may
+        run late: nothing is done once the page load of `token` is over.
+        """
+        with self.cancel_lock:
+            if token != self.visit_token:
+                return
+            self.driver_cancelled = True
+            self.driver.quit()
+
+    def retire_visit_token(self):
+        with self.cancel_lock:
+            self.visit_token += 1
+
+    def hard_load(self, url):
+        """Load `url`, quitting the browser if the soft timeout fails.
+
+        Only the driver call is guarded: the deadline raises asynchronously
+        and must not land in the bookkeeping around it.
+        """
+        cancel = partial(self.cancel_visit, self.visit_token)
+        try:
+            # quitting the browser unblocks a hung page load
+            with ut.timeout(self.visit_timeout + cm.HARD_VISIT_MARGIN,
+                            on_expire=cancel):
+                self.driver.get(url)
+        finally:
+            self.retire_visit_token()
+
+    def __load_page(self):
+        self.end_reason = None
+        start = timing.monotonic()
+        if self.quiescence is not None:
+            self.quiescence.reset()
+        try:
+            with timing.phase('driver_get'):
+                self.hard_load(self.job.url)
+            load_time = timing.monotonic() - start
+            self.end_reason = self.wait_in_site(start)
+        except (cm.TimeoutException, cm.HardTimeoutException,
+                TimeoutException):
+            wl_log.error("Visit to %s has timed out!", self.job.url)
+            self.add_load_time(self.visit_timeout, timed_out=True)
+            return 'timeout'
+        except Exception as exc:
+            wl_log.error("Unknown exception: %s", exc)
+            return 'error'
+        if self.quiescence is not None:
+            # the page loads until the last traffic of the visit
+            load_time = self.quiescence.last_active - start
+        self.add_load_time(load_time, self.end_reason == END_MAX_DURATION)
+        return 'ok'
 
 
 class CrawlerWebFP(CrawlerBase):
-    def post_visit(self):
-        guard_ips = set([ip for ip in self.controller.get_all_guard_ips()])
+    def post_visit(self, on_done):
+        guard_ips = self.controller.get_all_guard_ips()
         wl_log.debug("Found %s guards in the consensus.", len(guard_ips))
-        wl_log.info("Filtering packets without a guard IP.")
-        try:
-            ut.filter_pcap(self.job.pcap_file, guard_ips)
-        except Exception as e:
-            wl_log.error("ERROR: filtering pcap file: %s.", e)
-            wl_log.error("Check pcap: %s", self.job.pcap_file)
+        # the capture filter already dropped the packets of other hosts
+        post_filter = not self.visit_filtered
+        if self.post_processor:
+            self.post_processor.submit(self.job.pcap_file, guard_ips,
+                                       on_done=partial(self.visit_processed,
+                                                       on_done),
+                                       post_filter=post_filter)
+        else:
+            log_result(process_visit(self.job.pcap_file, guard_ips,
+                                     post_filter=post_filter))
+            self.pack_visit(self.job.path)
+            on_done()
+
+    def visit_processed(self, on_done, pcap_file):
+        """Called from the thread of the post-processor results."""
+        self.pack_visit(dirname(pcap_file))
+        on_done()
 
 
 class CrawlerMultitab(CrawlerWebFP):
@@ -93,8 +477,18 @@ class CrawlerMultitab(CrawlerWebFP):
 
 
 class CrawlJob(object):
-    def __init__(self, config, urls):
+    def __init__(self, config, urls, sites=None):
         self.urls = urls
+        # indices of the urls to visit, all of them by default
+        sites = range(len(urls)) if sites is None else sites
+        # left out of the job, journals and the coordinator never wait
+        # for their visits
+        self.sites = []
+        for site in sites:
+            if len(urls[site]) > cm.MAX_FNAME_LENGTH:
+                wl_log.warning("URL is too long: %s", urls[site])
+                continue
+            self.sites.append(site)
         self.visits = int(config['visits'])
         self.batches = int(config['batches'])
         self.config = config
@@ -108,6 +502,16 @@ class CrawlJob(object):
     def pcap_file(self):
         return join(self.path, "capture.pcap")
 
+    @property
+    def batch_pcap_file(self):
+        """Capture of a whole batch, unique per crawling process."""
+        return join(cm.CRAWL_DIR, "captures",
+                    "batch_%s_%s.pcap" % (self.batch, os.getpid()))
+
+    @property
+    def events_file(self):
+        return join(self.path, cm.TOR_EVENTS_FILE)
+
     @property
     def png_file(self):
         return join(self.path, "screenshot.png")
@@ -127,6 +531,6 @@ class CrawlJob(object):
 
     def __repr__(self):
         return "Batches: %s, Sites: %s, Visits: %s" \
-               % (self.batches, len(self.urls), self.visits)
+               % (self.batches, len(self.sites), self.visits)
 
 
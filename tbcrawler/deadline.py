@@ -0,0 +1,155 @@
+"""Deadlines for blocks of code running in any thread.
+
+A single scheduler thread keeps the pending deadlines of the process in a
+heap. When a deadline expires, its exception is raised asynchronously in
+the thread running the guarded block and its `on_expire` callback is
+run, e.g. to quit a browser that is blocked in a page load. Asynchronous
+exceptions are only delivered while the thread runs Python code, so
+blocking calls are interrupted by the callback, not by the exception.
+
+Deadlines nest: each one raises its own subclass of DeadlineExpired, so
+an inner block never swallows the timeout of an outer one by mistake.
+"""
+import ctypes
+import heapq
+import itertools
+import os
+import select
+import threading
+
+from common import TimeoutException
+from log import wl_log
+from timing import monotonic
+
+_set_async_exc = ctypes.pythonapi.PyThreadState_SetAsyncExc
+
+
+class DeadlineExpired(TimeoutException):
+    """Raised in the thread of an expired deadline."""
+    deadline = None
+
+    def __init__(self, *args):
+        super(DeadlineExpired, self).__init__(*(args or ("Timed out!",)))
+
+
+class Deadline(object):
+    """Context manager raising DeadlineExpired after `seconds`."""
+
+    def __init__(self, scheduler, seconds, on_expire=None):
+        self.scheduler = scheduler
+        self.seconds = seconds
+        self.on_expire = on_expire
+        self.expires = None
+        self.thread_id = None
+        self.expired = False
+        self.done = False
+        self.exc_type = type('DeadlineExpired', (DeadlineExpired,),
+                             {'deadline': self})
+
+    def owns(self, exc):
+        """Return True if `exc` was raised by this deadline."""
+        return isinstance(exc, self.exc_type)
+
+    def __enter__(self):
+        self.thread_id = threading.current_thread().ident
+        self.expires = monotonic() + self.seconds
+        self.scheduler.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.scheduler.remove(self):
+            return False
+        # an exception still pending would be raised outside of the block
+        _set_async_exc(ctypes.c_long(self.thread_id), None)
+        if exc_type is not None and issubclass(exc_type, DeadlineExpired):
+            return False  # ours, or an outer deadline's
+        # the block swallowed the exception, or failed because on_expire
+        # cancelled its operation
+        raise self.exc_type()
+
+    def cancel_operation(self):
+        try:
+            self.on_expire()
+        except Exception as exc:
+            wl_log.error("Error cancelling timed out operation: %s", exc)
+
+
+class DeadlineScheduler(object):
+    """Expire the deadlines of all the threads from a single thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.counter = itertools.count()
+        self.thread = None
+        self.pid = None
+        self.wakeup_fds = None
+
+    def _start(self):
+        """Start the scheduler thread, again in forked children."""
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.heap = []
+        self.wakeup_fds = os.pipe()
+        self.thread = threading.Thread(target=self._run,
+                                       args=(self.wakeup_fds[0],))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def deadline(self, seconds, on_expire=None):
+        return Deadline(self, seconds, on_expire)
+
+    def add(self, deadline):
+        with self.lock:
+            self._start()
+            heapq.heappush(self.heap, (deadline.expires, next(self.counter),
+                                       deadline))
+            if self.heap[0][2] is deadline:  # the scheduler sleeps too long
+                os.write(self.wakeup_fds[1], b'x')
+
+    def remove(self, deadline):
+        """Retire a deadline, return True if it has expired."""
+        with self.lock:
+            deadline.done = True
+            return deadline.expired
+
+    def expire(self):
+        """Raise the exceptions of the expired deadlines.
+
+        Return the expired deadlines and the time to wait for the next.
+        """
+        expired = []
+        with self.lock:
+            now = monotonic()
+            while self.heap and self.heap[0][0] <= now:
+                deadline = heapq.heappop(self.heap)[2]
+                if deadline.done:
+                    continue
+                deadline.expired = True
+                _set_async_exc(ctypes.c_long(deadline.thread_id),
+                               ctypes.py_object(deadline.exc_type))
+                expired.append(deadline)
+            wait = self.heap[0][0] - now if self.heap else None
+        return expired, wait
+
+    def _run(self, wakeup_fd):
+        while True:
+            expired, wait = self.expire()
+            for deadline in expired:
+                if deadline.on_expire is not None:
+                    # may block, e.g. quitting a hung browser
+                    canceller = threading.Thread(
+                        target=deadline.cancel_operation)
+                    canceller.daemon = True
+                    canceller.start()
+            try:
+                readable, _, _ = select.select([wakeup_fd], [], [], wait)
+            except select.error:  # EINTR
+                continue
+            if readable:
+                os.read(wakeup_fd, 4096)
+
+
+# the scheduler of this process
+scheduler = DeadlineScheduler()
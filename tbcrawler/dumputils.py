@@ -1,23 +1,37 @@
+import math
 import os
+import select
 import subprocess
 import time
-import psutil
+from threading import Thread
 
 import common as cm
-import utils as ut
+import timing
 from log import wl_log
+from pcaputils import GLOBAL_HEADER_LEN
 
+DUMPCAP_PATH = "dumpcap"
 DUMPCAP_START_TIMEOUT = 10.0
+DUMPCAP_STOP_TIMEOUT = 5.0
+# dumpcap prints "Capturing on <iface>" before it opens the interface and
+# "File: <path>" once the interface is open and the pcap header is written
+DUMPCAP_READY_MSG = "File: "
 
 
 class Sniffer(object):
     """Capture network traffic using dumpcap."""
 
-    def __init__(self, path="/dev/null", filter=""):
+    def __init__(self, path="/dev/null", filter="", ring=False,
+                 duration=cm.SOFT_VISIT_TIMEOUT):
         self.pcap_file = path
         self.pcap_filter = filter
+        # write a ring of files instead of stopping at the size limit
+        self.ring = ring
+        # seconds after which dumpcap stops, unless writing a ring
+        self.duration = duration
         self.p0 = None
         self.is_recording = False
+        self.startup_time = None
 
     def set_pcap_path(self, pcap_filename):
         """Set filename and filter options for capture."""
@@ -35,44 +49,105 @@ class Sniffer(object):
         return self.pcap_filter
 
     def start_capture(self, pcap_path=None, pcap_filter=""):
-        """Start capture. Configure sniffer if arguments are given."""
+        """Start capture. Configure sniffer if arguments are given.
+
+        Return once dumpcap reports that it is capturing.
+        """
         if pcap_filter:
             self.set_capture_filter(pcap_filter)
         if pcap_path:
             self.set_pcap_path(pcap_path)
-        prefix = ""
-        command = '{}dumpcap -P -a duration:{} -a filesize:{} -i eth0 -s 0 -f \'{}\' -w {}'\
-            .format(prefix, cm.SOFT_VISIT_TIMEOUT, cm.MAX_DUMP_SIZE,
-                    self.pcap_filter, self.pcap_file)
-        wl_log.info(command)
-        self.p0 = subprocess.Popen(command, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE, shell=True)
-        timeout = DUMPCAP_START_TIMEOUT  # in seconds
-        while timeout > 0 and not self.is_dumpcap_running():
-            time.sleep(0.1)
-            timeout -= 0.1
-        if timeout < 0:
-            raise DumpcapTimeoutError()
+        command = [DUMPCAP_PATH, '-P']
+        if self.ring:
+            command += ['-b', 'filesize:%s' % cm.MAX_DUMP_SIZE]
         else:
-            wl_log.debug("dumpcap started in %s seconds" %
-                         (DUMPCAP_START_TIMEOUT - timeout))
-
+            command += ['-a', 'duration:%d' % math.ceil(self.duration),
+                        '-a', 'filesize:%s' % cm.MAX_DUMP_SIZE]
+        command += ['-i', 'eth0', '-s', '0',
+                    '-f', self.pcap_filter, '-w', self.pcap_file]
+        wl_log.info(" ".join(command))
+        # the capture of an interrupted visit would pass for our pcap header
+        self.remove_pcap_file()
+        start = time.time()
+        with timing.phase('dumpcap_start'):
+            self.p0 = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            try:
+                self.wait_until_ready(start + DUMPCAP_START_TIMEOUT)
+            except DumpcapError:
+                self.kill_dumpcap()
+                raise
+        self.startup_time = time.time() - start
+        wl_log.info("dumpcap started in %.3f seconds", self.startup_time)
+        # keep the pipe drained, dumpcap blocks if it fills up
+        drain = Thread(target=self.p0.stderr.read)
+        drain.daemon = True
+        drain.start()
         self.is_recording = True
 
+    def wait_until_ready(self, deadline):
+        """Block until dumpcap is capturing.
+
+        Readiness is signalled either by dumpcap's "File:" message or by
+        the pcap header appearing in the output file.
+        """
+        stderr_fd = self.p0.stderr.fileno()
+        output = ""
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DumpcapTimeoutError("dumpcap did not start in %s s"
+                                          % DUMPCAP_START_TIMEOUT)
+            readable, _, _ = select.select([stderr_fd], [], [],
+                                           min(remaining, 0.1))
+            if readable:
+                chunk = os.read(stderr_fd, 4096)
+                if not chunk:  # EOF: dumpcap exited
+                    self.p0.wait()
+                    raise DumpcapError("dumpcap exited with code %s: %s"
+                                       % (self.p0.returncode,
+                                          output.strip()))
+                output += chunk
+                if DUMPCAP_READY_MSG in output:
+                    return
+            if self.pcap_header_written():
+                return
+
+    def remove_pcap_file(self):
+        try:
+            os.remove(self.pcap_file)
+        except OSError:
+            pass
+
+    def pcap_header_written(self):
+        try:
+            return os.path.getsize(self.pcap_file) >= GLOBAL_HEADER_LEN
+        except OSError:
+            return False
+
     def is_dumpcap_running(self):
-        if "dumpcap" in psutil.Process(self.p0.pid).cmdline():
-            return self.p0.returncode is None
-        for proc in ut.gen_all_children_procs(self.p0.pid):
-            if "dumpcap" in proc.cmdline():
-                return True
-        return False
+        return self.p0 is not None and self.p0.poll() is None
+
+    def kill_dumpcap(self):
+        """Ask dumpcap to finish the capture file, kill it if it hangs."""
+        if not self.is_dumpcap_running():
+            return
+        self.p0.terminate()
+        deadline = time.time() + DUMPCAP_STOP_TIMEOUT
+        while self.is_dumpcap_running() and time.time() < deadline:
+            time.sleep(0.05)
+        if self.is_dumpcap_running():
+            self.p0.kill()
+            self.p0.wait()
 
     def stop_capture(self):
-        """Kill the dumpcap process."""
-        ut.kill_all_children(self.p0.pid)  # self.p0.pid is the shell pid
-        self.p0.kill()
+        """Stop the dumpcap process."""
+        with timing.phase('capture_stop'):
+            self.kill_dumpcap()
         self.is_recording = False
-        if os.path.isfile(self.pcap_file):
+        if self.ring:
+            wl_log.info('Dumpcap killed. Ring capture: %s' % self.pcap_file)
+        elif os.path.isfile(self.pcap_file):
             wl_log.info('Dumpcap killed. Capture size: %s Bytes %s' %
                         (os.path.getsize(self.pcap_file), self.pcap_file))
         else:
@@ -87,6 +162,16 @@ class Sniffer(object):
         self.stop_capture()
 
 
-class DumpcapTimeoutError(Exception):
+def build_guard_filter(guard_ips):
+    """Return a capture filter for TCP traffic to or from the given IPs."""
+    hosts = " or ".join("host %s" % ip for ip in guard_ips)
+    return "tcp and (%s)" % hosts
+
+
+class DumpcapError(Exception):
+    pass
+
+
+class DumpcapTimeoutError(DumpcapError):
     pass
 
@@ -0,0 +1,88 @@
+"""Record the Tor control events of each visit to a sidecar file.
+
+Circuit, stream, bandwidth and OR connection events are buffered in
+memory as they arrive, in the thread stem delivers events in, and only
+converted and written out at the end of the visit. The file gives the
+circuits and streams of a visit next to its capture. Circuits built
+before the visit, e.g. preemptive ones, start the file as CIRC records
+marked as a snapshot.
+"""
+import json
+from time import time
+
+from stem.control import EventType
+
+EVENT_TYPES = (EventType.CIRC, EventType.STREAM, EventType.BW,
+               EventType.ORCONN)
+# fields written for each event type
+EVENT_FIELDS = {
+    'CIRC': ('id', 'status', 'path', 'purpose', 'reason'),
+    'STREAM': ('id', 'status', 'circ_id', 'target', 'purpose', 'reason'),
+    'BW': ('read', 'written'),
+    'ORCONN': ('id', 'endpoint', 'status', 'reason', 'circ_count'),
+}
+
+
+class CircuitSnapshot(object):
+    """A circuit open when recording started, written as a CIRC event."""
+    type = 'CIRC'
+
+    def __init__(self, circuit):
+        self.circuit = circuit
+
+    def __getattr__(self, name):
+        return getattr(self.circuit, name)
+
+
+def event_to_dict(timestamp, event):
+    """Return the fields of an event that are set, with its time and type.
+
+    Circuit paths are reduced to the relay fingerprints.
+    """
+    record = {'time': timestamp, 'type': event.type}
+    if isinstance(event, CircuitSnapshot):
+        record['snapshot'] = True
+    for field in EVENT_FIELDS.get(event.type, ()):
+        value = getattr(event, field, None)
+        if value is None:
+            continue
+        if field == 'path':
+            value = [fingerprint for fingerprint, _ in value]
+        record[field] = value
+    return record
+
+
+class EventRecorder(object):
+    """Buffer the Tor events of a visit, see TorController.event_recorder.
+
+    Times are wall-clock times, as the timestamps of the capture.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.recording = False
+
+    def handler(self, event):
+        if self.recording:
+            self.events.append((time(), event))
+
+    def start(self, circuits=()):
+        """Start recording, `circuits` are the open circuits (stem CIRC
+        events, as returned by get_circuits)."""
+        now = time()
+        self.events = [(now, CircuitSnapshot(circuit)) for circuit in circuits]
+        self.recording = True
+
+    def stop(self):
+        """Stop recording and return the buffered (time, event) pairs."""
+        self.recording = False
+        events, self.events = self.events, []
+        return events
+
+    def write(self, events, path):
+        """Write events, one JSON object per line. Return the count."""
+        with open(path, 'w') as f:
+            for timestamp, event in events:
+                f.write(json.dumps(event_to_dict(timestamp, event),
+                                   separators=(',', ':')) + "\n")
+        return len(events)
@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+from glob import glob
+from os.path import dirname, join
+from time import time
+
+import common as cm
+
+JOURNAL_PATTERN = "journal*.jsonl"
+
+
+def read_journal(path):
+    """Iterate over the records of a journal file.
+
+    A partially written last line (the crawler died while writing it) is
+    skipped.
+    """
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def open_journal(path):
+    """Open a journal file for appending records.
+
+    A partially written last line is ended, so the next record starts on
+    a line of its own.
+    """
+    fd = open(path, 'a+')
+    fd.seek(0, os.SEEK_END)
+    if fd.tell():
+        fd.seek(-1, os.SEEK_END)
+        if fd.read(1) != "\n":  # partial last line
+            fd.write("\n")
+    return fd
+
+
+def load_completed(journal_dir):
+    """Return the (batch, site, instance) keys of all journals in a dir."""
+    completed = set()
+    for path in glob(join(journal_dir, JOURNAL_PATTERN)):
+        for record in read_journal(path):
+            completed.add((record['batch'], record['site'],
+                           record['instance']))
+    return completed
+
+
+def load_outcomes(journal_dir):
+    """Return the outcome of each visit, by (batch, site, instance) key.
+
+    The last record of a visit wins.
+    """
+    outcomes = {}
+    for path in glob(join(journal_dir, JOURNAL_PATTERN)):
+        for record in read_journal(path):
+            outcomes[(record['batch'], record['site'],
+                      record['instance'])] = record['outcome']
+    return outcomes
+
+
+class CrawlJournal(object):
+    """Append-only log of the visits a crawl has finished.
+
+    Records are fsync'ed every `sync_every` visits and on close, so a crash
+    loses at most the last `sync_every` visits. Visits recorded in any
+    journal of the same directory, e.g. the journals of other workers or
+    of previous runs, count as completed.
+    """
+
+    def __init__(self, path, sync_every=cm.JOURNAL_SYNC_EVERY):
+        self.path = path
+        self.sync_every = sync_every
+        self.completed = load_completed(dirname(path))
+        self.unsynced = 0
+        # background post-processing records visits from another thread
+        self.lock = threading.Lock()
+        self.fd = open_journal(path)
+
+    def is_completed(self, batch, site, instance):
+        return (batch, site, instance) in self.completed
+
+    def claim(self, batch, site, instance):
+        """Return True if the visit is left for this crawler to do."""
+        return not self.is_completed(batch, site, instance)
+
+    def is_batch_completed(self, batch, sites, instances):
+        return all(self.is_completed(batch, site, instance)
+                   for site in sites for instance in instances)
+
+    def wait_for_work(self):
+        """Return True if visits left by other crawlers are to be done."""
+        return False
+
+    def record(self, batch, site, instance, url, outcome, end=None):
+        record = {'batch': batch, 'site': site, 'instance': instance,
+                  'url': url, 'outcome': outcome, 'time': time()}
+        if end is not None:  # why the visit ended, see quiescence.py
+            record['end'] = end
+        with self.lock:
+            self.fd.write(json.dumps(record) + "\n")
+            self.completed.add((batch, site, instance))
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self.sync()
+
+    def sync(self):
+        self.fd.flush()
+        os.fsync(self.fd.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            if not self.fd.closed:
+                self.sync()
+                self.fd.close()
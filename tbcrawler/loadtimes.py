@@ -0,0 +1,69 @@
+"""Per-site visit timeouts learned from the load times of earlier visits.
+
+Every site is visited `visits` x `batches` times. The load time of each
+visit is logged, and the soft timeout of the next visits to the site is
+a high percentile of its load times plus a margin, within global bounds,
+instead of the global SOFT_VISIT_TIMEOUT.
+"""
+import json
+from glob import glob
+from os.path import dirname, join
+
+import numpy as np
+
+import common as cm
+from journal import open_journal, read_journal
+
+
+class LoadTimeProfile(object):
+    """Load times of the visits to each site, logged to a JSON lines file.
+
+    Load times logged by other workers or by previous runs in the same
+    directory are read at start, so a resumed crawl starts with the
+    profile of the interrupted one.
+    """
+
+    def __init__(self, path, percentile=cm.ADAPTIVE_TIMEOUT_PERCENTILE,
+                 min_samples=cm.ADAPTIVE_TIMEOUT_MIN_SAMPLES,
+                 min_timeout=cm.ADAPTIVE_TIMEOUT_MIN,
+                 max_timeout=cm.SOFT_VISIT_TIMEOUT):
+        self.path = path
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.load_times = {}  # url: [load times]
+        for profile_path in glob(join(dirname(path), cm.LOAD_TIMES_PATTERN)):
+            for record in read_journal(profile_path):
+                self.add_sample(record['url'], record['load_time'],
+                                record['timed_out'])
+        self.fd = open_journal(path)
+
+    def add_sample(self, url, load_time, timed_out):
+        if timed_out:
+            # the page took longer than that, back off
+            load_time *= cm.ADAPTIVE_TIMEOUT_BACKOFF
+        self.load_times.setdefault(url, []).append(load_time)
+
+    def add(self, url, load_time, timed_out=False):
+        """Log the load time of a visit.
+
+        For timed out visits, `load_time` is the timeout that expired.
+        """
+        self.add_sample(url, load_time, timed_out)
+        self.fd.write(json.dumps({'url': url, 'load_time': load_time,
+                                  'timed_out': timed_out}) + "\n")
+        self.fd.flush()
+
+    def timeout(self, url):
+        """Return the soft timeout of the next visit to `url`."""
+        load_times = self.load_times.get(url, ())
+        if len(load_times) < self.min_samples:
+            return self.max_timeout
+        timeout = (np.percentile(load_times, self.percentile) *
+                   cm.ADAPTIVE_TIMEOUT_FACTOR + cm.ADAPTIVE_TIMEOUT_MARGIN)
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def close(self):
+        if not self.fd.closed:
+            self.fd.close()
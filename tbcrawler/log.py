@@ -1,7 +1,19 @@
+import argparse
+import json
 import logging
 import os
+from os.path import isdir, join
+import threading
+from Queue import Empty, Queue
+
+import common as cm
+import timing
 
 LOG_PREFIX = 'webfp'
+# fields of the visit a record was logged in, see ContextFilter
+CONTEXT_FIELDS = ('worker', 'batch', 'site', 'instance', 'phase')
+# fields of the process, e.g. the worker number of parallel crawls
+log_context = {}
 
 
 def reset_logger(logger):
@@ -17,11 +29,119 @@ def reset_logger(logger):
         logger.removeHandler(handler)
 
 
+def flush_logger(logger):
+    """Wait until the handlers of a logger wrote the records so far."""
+    for handler in logger.handlers:
+        handler.flush()
+
+
 def add_log_file_handler(logger, filename):
-    fh = logging.FileHandler(filename)
-    frmt = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    """Log to `filename` as JSON lines, written by a background thread."""
+    handler = QueueHandler(filename)
+    handler.addFilter(ContextFilter())
     log_level = logger.getEffectiveLevel()  # get global log level
-    init_log_handler(fh, logger, log_level, frmt)
+    init_log_handler(handler, logger, log_level, JsonFormatter())
+
+
+def set_log_context(**fields):
+    """Add fields to all the records of this process."""
+    log_context.update(fields)
+
+
+class ContextFilter(logging.Filter):
+    """Add the worker, batch, site, instance and phase to records.
+
+    Batch, site, instance and phase come from the timing records open in
+    the crawling thread.
+    """
+
+    def filter(self, record):
+        context = dict(log_context, **timing.recorder.context())
+        for field in CONTEXT_FIELDS:
+            if field in context:
+                setattr(record, field, context[field])
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON objects with their context fields."""
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname,
+                 'logger': record.name, 'message': record.getMessage()}
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class QueueHandler(logging.Handler):
+    """Hand records to a writer thread that appends them to a file.
+
+    Logging a record only formats it and puts it in a queue. The writer
+    thread writes all the records queued at a time in one append, and
+    the file is opened in append mode so that the workers of a parallel
+    crawl can share it. Forked processes start their own writer.
+    """
+
+    def __init__(self, filename):
+        logging.Handler.__init__(self)
+        self.filename = filename
+        self.pid = None
+        self.queue = None
+        self.writer = None
+
+    def start_writer(self):
+        self.pid = os.getpid()
+        self.queue = Queue()
+        self.writer = threading.Thread(target=self.write_records,
+                                       args=(self.queue,))
+        self.writer.daemon = True
+        self.writer.start()
+
+    def emit(self, record):
+        try:
+            if self.pid != os.getpid():
+                self.start_writer()
+            self.queue.put(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+    def write_records(self, queue):
+        fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0644)
+        try:
+            while True:
+                lines = [queue.get()]
+                try:
+                    while len(lines) < cm.LOG_BATCH_SIZE:
+                        lines.append(queue.get_nowait())
+                except Empty:
+                    pass
+                done = None in lines
+                os.write(fd, "".join(line for line in lines if line))
+                if done:
+                    return
+        finally:
+            os.close(fd)
+
+    def flush(self):
+        """Wait until the records logged so far are written."""
+        with self.lock:
+            if self.writer is not None and self.pid == os.getpid():
+                self.queue.put(None)
+                self.writer.join()
+                self.writer = None
+                self.pid = None
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
 
 
 def init_log_handler(handler, logger, level, frmt):
@@ -69,4 +189,60 @@ def add_symlink(linkname, src_file):
         print "Cannot create symlink!"
 
 
+def read_log(path):
+    """Iterate over the records of a JSON lines log, see JsonFormatter."""
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue  # e.g. the last line of a killed crawler
+
+
+def query_log(records, min_level=None, **fields):
+    """Return the records with the given field values and at least
+    `min_level`."""
+    min_level = logging.getLevelName(min_level) if min_level else 0
+    return [record for record in records
+            if logging.getLevelName(record['level']) >= min_level and
+            all(record.get(field) == value
+                for field, value in fields.items())]
+
+
+def format_record(record):
+    context = " ".join("%s=%s" % (field, record[field])
+                       for field in CONTEXT_FIELDS if field in record)
+    return "%s %s [%s] %s" % (record['time'], record['level'], context,
+                              record['message'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Select records of the log of a crawl.')
+    parser.add_argument('log', help='Crawl directory or log file.')
+    parser.add_argument('-l', '--level', help='Minimum level, e.g. WARNING.')
+    parser.add_argument('-w', '--where', action='append', default=[],
+                        metavar='FIELD=VALUE',
+                        help='Only records with this value of a field, e.g. '
+                             'site=3. Can be repeated.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the records as JSON lines.')
+    args = parser.parse_args()
+    path = args.log
+    if isdir(path):
+        path = join(path, 'logs', 'crawl.log')
+    fields = {}
+    for condition in args.where:
+        field, _, value = condition.partition('=')
+        if field not in CONTEXT_FIELDS:
+            parser.error("Unknown field %s, use one of %s"
+                         % (field, ", ".join(CONTEXT_FIELDS)))
+        fields[field] = value if field == 'phase' else int(value)
+    for record in query_log(read_log(path), args.level, **fields):
+        print json.dumps(record) if args.json else format_record(record)
+
+
 wl_log = get_logger(LOG_PREFIX, logtype='c')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Streaming pcap helpers.
+
+Only the pcap record headers and the fixed-offset fields of the link, IPv4
+and TCP headers are decoded, so captures can be processed record by record
+in constant memory, without building scapy packets.
+"""
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from glob import glob
+from os import fstat, remove
+from os.path import splitext
+from socket import inet_aton
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+GLOBAL_HEADER_LEN = 24
+RECORD_HEADER_LEN = 16
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+
+ETHERTYPE_IPV4 = b'\x08\x00'
+ETHERTYPE_VLAN = b'\x81\x00'
+IPPROTO_TCP = b'\x06'
+
+
+class PcapFormatError(Exception):
+    pass
+
+
+class PcapReader(object):
+    """Iterate over the raw records of a pcap file.
+
+    Each record is yielded as a `(header, data)` tuple of byte strings,
+    where `header` is the 16-byte record header. A truncated last record
+    (e.g. dumpcap was killed while writing) is silently dropped.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.global_header = fileobj.read(GLOBAL_HEADER_LEN)
+        if len(self.global_header) < GLOBAL_HEADER_LEN:
+            raise PcapFormatError("Truncated pcap global header")
+        for byte_order in '<>':
+            magic, = struct.unpack(byte_order + 'I', self.global_header[:4])
+            if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+                break
+        else:
+            raise PcapFormatError("Not a pcap file (magic %r)"
+                                  % self.global_header[:4])
+        self.byte_order = byte_order
+        self.ts_resolution = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+        self.snaplen, self.linktype = struct.unpack(
+            byte_order + 'II', self.global_header[16:24])
+        self.record_struct = struct.Struct(byte_order + 'IIII')
+        self.ip_offset = link_ip_offset(self.linktype)
+
+    def __iter__(self):
+        read = self.fileobj.read
+        unpack = self.record_struct.unpack
+        while True:
+            header = read(RECORD_HEADER_LEN)
+            if len(header) < RECORD_HEADER_LEN:
+                return
+            caplen = unpack(header)[2]
+            data = read(caplen)
+            if len(data) < caplen:
+                return
+            yield header, data
+
+    def timestamp(self, header):
+        """Return the timestamp of a record header in seconds."""
+        ts_sec, ts_frac = self.record_struct.unpack(header)[:2]
+        return ts_sec + ts_frac * self.ts_resolution
+
+    def ipv4_tcp_addrs(self, data):
+        """Return the packed (src, dst) addresses of an IPv4/TCP packet.
+
+        Return None for any other packet.
+        """
+        off = self.ip_offset(data)
+        if off is None or data[off + 9:off + 10] != IPPROTO_TCP:
+            return None
+        return data[off + 12:off + 16], data[off + 16:off + 20]
+
+
+def _ethernet_ip_offset(data):
+    ethertype = data[12:14]
+    if ethertype == ETHERTYPE_IPV4:
+        return 14
+    if ethertype == ETHERTYPE_VLAN and data[16:18] == ETHERTYPE_IPV4:
+        return 18
+    return None
+
+
+def _sll_ip_offset(data):
+    return 16 if data[14:16] == ETHERTYPE_IPV4 else None
+
+
+def _raw_ip_offset(data):
+    return 0 if data[:1] and (ord(data[:1]) >> 4) == 4 else None
+
+
+def link_ip_offset(linktype):
+    """Return a function mapping link-layer frames to their IPv4 offset."""
+    try:
+        return {LINKTYPE_ETHERNET: _ethernet_ip_offset,
+                LINKTYPE_LINUX_SLL: _sll_ip_offset,
+                LINKTYPE_RAW: _raw_ip_offset}[linktype]
+    except KeyError:
+        raise PcapFormatError("Unsupported link type: %s" % linktype)
+
+
+def pack_ips(iplist):
+    """Return a set with the packed form of the given dotted-quad IPs."""
+    return set(inet_aton(ip) for ip in iplist)
+
+
+def filter_pcap(in_path, out_path, iplist):
+    """Copy the IPv4/TCP records to or from any IP in `iplist`.
+
+    Records are streamed straight from `in_path` to `out_path`. Return the
+    number of records kept and the total number of records.
+    """
+    packed_ips = pack_ips(iplist)
+    kept = total = 0
+    with open(in_path, 'rb') as fi, open(out_path, 'wb') as fo:
+        reader = PcapReader(fi)
+        fo.write(reader.global_header)
+        addrs = reader.ipv4_tcp_addrs
+        for header, data in reader:
+            total += 1
+            src_dst = addrs(data)
+            if src_dst is None:
+                continue
+            if src_dst[0] in packed_ips or src_dst[1] in packed_ips:
+                fo.write(header)
+                fo.write(data)
+                kept += 1
+    return kept, total
+
+
+class CaptureIndex(object):
+    """Timestamp index over the files of a ring buffer capture.
+
+    dumpcap's ring buffer mode writes `<prefix>_<n>_<date>.<ext>` files.
+    Only record headers are read to build the index, each file is scanned
+    once and later updates only look at the records appended since. Slices
+    are then cut out with one seek per record.
+    """
+
+    def __init__(self, capture_path):
+        prefix, ext = splitext(capture_path)
+        self.pattern = "%s_*%s" % (prefix, ext)
+        self.files = []
+        self.scanned = []  # offset of the first unindexed byte per file
+        self.global_header = None
+        self.record_struct = None
+        self.timestamps = array('d')
+        self.file_ids = array('H')
+        self.offsets = array('L')
+
+    def update(self):
+        """Index the files and records written since the last update."""
+        for path in sorted(glob(self.pattern))[len(self.files):]:
+            self.files.append(path)
+            self.scanned.append(GLOBAL_HEADER_LEN)
+        for file_id, path in enumerate(self.files):
+            self.scanned[file_id] = self._scan(file_id, path,
+                                               self.scanned[file_id])
+
+    def _scan(self, file_id, path, offset):
+        with open(path, 'rb') as f:
+            size = fstat(f.fileno()).st_size
+            if size < offset:
+                return offset
+            reader = PcapReader(f)
+            if self.global_header is None:
+                self.global_header = reader.global_header
+                self.record_struct = reader.record_struct
+            unpack = reader.record_struct.unpack
+            ts_resolution = reader.ts_resolution
+            f.seek(offset)
+            while offset + RECORD_HEADER_LEN <= size:
+                ts_sec, ts_frac, caplen, _ = unpack(f.read(RECORD_HEADER_LEN))
+                end = offset + RECORD_HEADER_LEN + caplen
+                if end > size:
+                    break  # record is still being written
+                self.timestamps.append(ts_sec + ts_frac * ts_resolution)
+                self.file_ids.append(file_id)
+                self.offsets.append(offset)
+                f.seek(end)
+                offset = end
+        return offset
+
+    def extract(self, start, end, out_path):
+        """Write the records captured between `start` and `end` to a pcap.
+
+        Return the number of records written.
+        """
+        self.update()
+        if self.global_header is None:
+            raise PcapFormatError("No capture files match %s" % self.pattern)
+        first = bisect_left(self.timestamps, start)
+        last = bisect_right(self.timestamps, end)
+        files = {}
+        try:
+            with open(out_path, 'wb') as fo:
+                fo.write(self.global_header)
+                for i in xrange(first, last):
+                    file_id = self.file_ids[i]
+                    if file_id not in files:
+                        files[file_id] = open(self.files[file_id], 'rb')
+                    fi = files[file_id]
+                    fi.seek(self.offsets[i])
+                    header = fi.read(RECORD_HEADER_LEN)
+                    fo.write(header)
+                    fo.write(fi.read(self.record_struct.unpack(header)[2]))
+        finally:
+            for f in files.values():
+                f.close()
+        return last - first
+
+    def remove_files(self):
+        """Delete the indexed capture files."""
+        for path in self.files:
+            remove(path)
@@ -0,0 +1,97 @@
+import gzip
+import os
+import signal
+import shutil
+from functools import partial
+from multiprocessing import Pool
+from threading import BoundedSemaphore
+
+import common as cm
+import utils as ut
+from log import wl_log
+from traces import pcap_to_trace
+
+
+def ignore_sigint():
+    """Leave keyboard interrupts to the crawler process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def gzip_file(path):
+    """Compress a file to `path`.gz and remove the original."""
+    with open(path, 'rb') as fi, gzip.open(path + '.gz', 'wb') as fo:
+        shutil.copyfileobj(fi, fo)
+    os.remove(path)
+
+
+def process_visit(pcap_file, guard_ips,
+                  compress=cm.COMPRESS_ORIGINAL_CAPTURE, post_filter=True):
+    """Filter the capture of a visit, extract its trace and optionally
+    compress the original capture.
+
+    Captures that only have guard traffic, see `post_filter`, are not
+    filtered and no original capture is kept.
+
+    Return the pcap path and an error message, or None if all went well.
+    """
+    try:
+        if post_filter:
+            wl_log.info("Filtering packets without a guard IP: %s",
+                        pcap_file)
+            ut.filter_pcap(pcap_file, guard_ips)
+        n_packets = pcap_to_trace(pcap_file, guard_ips)
+        wl_log.info("Extracted a trace of %s packets", n_packets)
+        if compress and post_filter:
+            gzip_file(pcap_file + ".original")
+    except Exception as e:
+        return pcap_file, str(e)
+    return pcap_file, None
+
+
+def log_result(result):
+    pcap_file, error = result
+    if error is not None:
+        wl_log.error("ERROR: filtering pcap file: %s.", error)
+        wl_log.error("Check pcap: %s", pcap_file)
+
+
+class PostProcessor(object):
+    """Process finished visits in a pool of processes.
+
+    At most `queue_size` visits wait for or are in processing at any time,
+    `submit` blocks when the queue is full. `close` waits for all the
+    submitted visits.
+    """
+
+    def __init__(self, processes, queue_size=cm.POST_QUEUE_SIZE,
+                 compress=cm.COMPRESS_ORIGINAL_CAPTURE):
+        self.pool = Pool(processes, initializer=ignore_sigint)
+        self.slots = BoundedSemaphore(queue_size)
+        self.compress = compress
+
+    def submit(self, pcap_file, guard_ips, on_done=None, post_filter=True):
+        """Queue a visit, `on_done` is called with its path once processed.
+        """
+        self.slots.acquire()
+        try:
+            self.pool.apply_async(process_visit,
+                                  (pcap_file, guard_ips, self.compress,
+                                   post_filter),
+                                  callback=partial(self.task_done, on_done))
+        except Exception:
+            self.slots.release()
+            raise
+
+    def task_done(self, on_done, result):
+        self.slots.release()
+        log_result(result)
+        if on_done is not None:
+            try:
+                on_done(result[0])
+            except Exception as e:
+                wl_log.error("Error after processing %s: %s", result[0], e)
+
+    def close(self):
+        wl_log.info("Waiting for post-processing to finish.")
+        self.pool.close()
+        self.pool.join()
@@ -1,14 +1,18 @@
 import argparse
 import ConfigParser
+import json
+import socket
 import sys
 import traceback
 from contextlib import contextmanager
 from logging import INFO, DEBUG
-from os import stat, chdir
-from os.path import isfile, join, basename
+from multiprocessing import Process
+from os import chdir
+from os.path import abspath, isfile, join, basename
 from shutil import copyfile
 from sys import maxsize, argv
-from urlparse import urlparse
+from threading import Lock, Thread
+from time import sleep
 
 from tbselenium.tbdriver import TorBrowserDriver
 from tbselenium.common import USE_RUNNING_TOR
@@ -16,66 +20,240 @@ from tbselenium.common import USE_RUNNING_TOR
 import common as cm
 import utils as ut
 import crawler as crawler_mod
-from log import add_log_file_handler
+import timing
+from archive import ArchiveWriter
+from coordinator import CoordinatorClient, parse_address
+from events import EventRecorder
+from journal import CrawlJournal
+from loadtimes import LoadTimeProfile
+from log import add_log_file_handler, flush_logger, set_log_context
 from log import wl_log, add_symlink
+from postprocess import PostProcessor
+from quiescence import TrafficMonitor
+from sanity import check_crawl
 from torcontroller import TorController
+from urls import SHARD_METHODS, load_shard, parse_shard
 
+CRAWL_ARGS_FILE = 'args.json'
 
-def run():
-    # build dirs
-    build_crawl_dirs()
 
+def run():
     # Parse arguments
     args, config = parse_arguments()
 
+    if args.resume:
+        # reuse the crawl dir and the options of the interrupted crawl
+        args, config = load_crawl_args(args.resume)
+    else:
+        # build dirs
+        build_crawl_dirs()
+        save_crawl_args(args)
+
     # Read URLs
-    url_list = parse_url_list(args.url_file, args.start, args.stop)
-    host_list = [urlparse(url).hostname for url in url_list]
+    url_list = parse_url_list(args.url_file, args.start, args.stop,
+                              getattr(args, 'shard', None),
+                              getattr(args, 'shard_by', 'hash'))
 
     # Configure logger
     add_log_file_handler(wl_log, cm.DEFAULT_CRAWL_LOG)
 
+    # Run the crawl
+    chdir(cm.CRAWL_DIR)
+    try:
+        if args.workers > 1:
+            crawl_in_parallel(args, config, url_list)
+        else:
+            crawl_worker(args, config, url_list)
+    except KeyboardInterrupt:
+        wl_log.warning("Keyboard interrupt! Quitting...")
+        sys.exit(-1)
+    finally:
+        # Post crawl
+        post_crawl(args)
+
+    # die
+    sys.exit(0)
+
+
+def crawl_in_parallel(args, config, url_list):
+    """Crawl with `args.workers` processes, each with its own Tor and browser.
+
+    Sites are dealt out to the workers round-robin, results keep the usual
+    batch/site/instance layout.
+    """
+    workers = [Process(target=crawl_worker, name="worker-%s" % worker,
+                       args=(args, config, url_list, worker))
+               for worker in xrange(args.workers)]
+    for worker in workers:
+        worker.start()
+        sleep(cm.WORKER_START_INTERVAL)  # don't bootstrap all Tors at once
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+        raise
+    for worker in workers:
+        if worker.exitcode:
+            wl_log.error("%s exited with code %s", worker.name,
+                         worker.exitcode)
+
+
+def get_worker_torrc(torrc_config, worker):
+    """Return a copy of the torrc config with the ports of a worker."""
+    torrc_config = dict(torrc_config)
+    for port in ('controlport', 'socksport'):
+        torrc_config[port] = str(int(torrc_config[port]) +
+                                 worker * cm.WORKER_PORT_STRIDE)
+    return torrc_config
+
+
+def crawl_worker(args, config, url_list, worker=0):
+    """Crawl every `args.workers`-th URL of the list from the `worker`-th."""
+    parallel = args.workers > 1
+    set_log_context(worker=worker)
+
     # Configure controller
-    torrc_config = ut.get_dict_subconfig(config, args.config, "torrc")
+    torrc_config = get_worker_torrc(
+        ut.get_dict_subconfig(config, args.config, "torrc"), worker)
+    # only capture the traffic to our guards, parallel captures would see
+    # the traffic of the other workers otherwise
+    guard_filter = (parallel or
+                    getattr(args, 'capture_filter', 'tcp') == 'guards')
+    if guard_filter and torrc_config.get('useentryguards') == '0':
+        if parallel:
+            wl_log.warning("Entry guards are disabled, visits that use a "
+                           "guard not used at capture start are recorded "
+                           "as stale_filter.")
+        else:
+            # every new circuit may use a new guard
+            wl_log.warning("Entry guards are disabled, capturing all TCP "
+                           "traffic.")
+            guard_filter = False
+    # end visits when Tor goes quiet instead of after pause_in_site
+    traffic_monitor = None
+    if getattr(args, 'quiescence', False):
+        traffic_monitor = TrafficMonitor()
+    # log the Tor events of each visit next to its capture
+    event_recorder = None
+    if getattr(args, 'tor_events', False):
+        event_recorder = EventRecorder()
+    # how visits get fresh circuits, a job option of the config section
+    reset_strategy = get_reset_strategy(config, args.config)
+    # parallel Tor processes cannot share the TBB data directory
     controller = TorController(cm.TBB_DIR,
                                torrc_dict=torrc_config,
-                               pollute=False)
+                               pollute=parallel,
+                               standby=args.tor_standby,
+                               traffic_monitor=traffic_monitor,
+                               event_recorder=event_recorder,
+                               reset_strategy=reset_strategy)
 
     # Configure browser
     ffprefs = ut.get_dict_subconfig(config, args.config, "ffpref")
+    if traffic_monitor is not None:
+        # return from driver.get right away, the traffic decides when the
+        # page is done
+        pref, value = cm.FF_LOAD_STRATEGY_PREF
+        ffprefs[pref] = value
+    ff_log = cm.DEFAULT_FF_LOG
+    if parallel:
+        ff_log = "%s.%s" % (cm.DEFAULT_FF_LOG, worker)
     driver = TorBrowserWrapper(cm.TBB_DIR,
-                               tbb_logfile_path=cm.DEFAULT_FF_LOG,
+                               tbb_logfile_path=ff_log,
                                tor_cfg=USE_RUNNING_TOR,
                                pref_dict=ffprefs,
-                               socks_port=int(torrc_config['socksport']))
-
-    # Instantiate crawler
-    crawl_type = getattr(crawler_mod, "Crawler" + args.type)
-    crawler = crawl_type(driver, controller, args.screenshots)
+                               socks_port=int(torrc_config['socksport']),
+                               control_port=int(torrc_config['controlport']),
+                               prelaunch=args.prelaunch_browser)
+
+    # Configure background post-processing
+    post_processor = None
+    if args.post_processes:
+        post_processor = PostProcessor(args.post_processes)
+
+    # Configure journal of completed visits
+    journal_file = cm.DEFAULT_JOURNAL
+    bootstraps_file = cm.DEFAULT_TOR_BOOTSTRAPS
+    if parallel:
+        journal_file = join(cm.LOGS_DIR, "journal.%s.jsonl" % worker)
+        bootstraps_file = join(cm.LOGS_DIR, "tor_bootstraps.%s.json" % worker)
+    journal = CrawlJournal(journal_file)
+    timings_file = cm.DEFAULT_TIMINGS
+    if parallel:
+        timings_file = join(cm.LOGS_DIR, "timings.%s.jsonl" % worker)
+    timing.recorder.open(timings_file)
+
+    # Configure per-site timeouts learned from the previous visits
+    load_times = None
+    if getattr(args, 'adaptive_timeouts', False):
+        load_times_file = cm.DEFAULT_LOAD_TIMES
+        if parallel:
+            load_times_file = join(cm.LOGS_DIR,
+                                   "load_times.%s.jsonl" % worker)
+        load_times = LoadTimeProfile(load_times_file)
+
+    # Configure archive of the visit directories
+    archive = None
+    if args.pack:
+        archive_file = cm.DEFAULT_ARCHIVE
+        if parallel:
+            archive_file = join(cm.CRAWL_DIR,
+                                "crawl.%s%s" % (worker, cm.ARCHIVE_EXT))
+        archive = ArchiveWriter(archive_file)
 
     # Configure crawl
     job_config = ut.get_dict_subconfig(config, args.config, "job")
-    job = crawler_mod.CrawlJob(job_config, url_list)
+    coordinator = getattr(args, 'coordinator', None)
+    if coordinator:
+        # the coordinator shares out the visits of the whole list
+        sites = list(url_list)
+    else:
+        sites = list(url_list)[worker::args.workers]
+    job = crawler_mod.CrawlJob(job_config, url_list, sites)
+    if coordinator:
+        journal = CoordinatorClient(parse_address(coordinator),
+                                    "%s.%s" % (args.node, worker), job,
+                                    journal)
+
+    # Instantiate crawler
+    crawl_type = getattr(crawler_mod, "Crawler" + args.type)
+    crawler = crawl_type(driver, controller, args.screenshots,
+                         guard_filter=guard_filter,
+                         post_processor=post_processor,
+                         capture_mode=args.capture_mode,
+                         journal=journal,
+                         archive=archive,
+                         quiescence=traffic_monitor,
+                         load_times=load_times,
+                         event_recorder=event_recorder)
 
     # Run display
     xvfb_display = setup_virtual_display(args.virtual_display)
-
-    # Run the crawl
-    chdir(cm.CRAWL_DIR)
     try:
         crawler.crawl(job)
-    except KeyboardInterrupt:
-        wl_log.warning("Keyboard interrupt! Quitting...")
-        sys.exit(-1)
     finally:
-        # Post crawl
-        post_crawl()
-
+        driver.quit_prelaunched()
+        controller.quit_standby()
+        save_bootstraps(controller.bootstraps, bootstraps_file)
         # Close display
         ut.stop_xvfb(xvfb_display)
+        ut.remove_dir_templates()
+        timing.recorder.close()
+        # worker processes exit without running the atexit handlers
+        flush_logger(wl_log)
+
+
+def save_bootstraps(bootstraps, path):
+    """Write the Tor bootstraps of a worker after those of the earlier
+    runs of the crawl (--resume)."""
+    if isfile(path):
+        with open(path) as f:
+            bootstraps = json.load(f) + bootstraps
+    with open(path, 'w') as f:
+        json.dump(bootstraps, f, indent=2)
 
-    # die
-    sys.exit(0)
 
 def setup_virtual_display(virt_display):
     """Start a virtual display with the given dimensions (if requested)."""
@@ -83,11 +261,50 @@ def setup_virtual_display(virt_display):
         w, h = (int(dim) for dim in virt_display.lower().split("x"))
         return ut.start_xvfb(w, h)
 
-def post_crawl():
+def post_crawl(args):
     """Operations after the crawl."""
-    # TODO: pack crawl
-    # TODO: sanity checks
-    pass
+    # visits are packed into the archive as they complete (--pack)
+    if args.sanity_check:
+        try:
+            check_crawl(cm.CRAWL_DIR, screenshots=args.screenshots)
+        except Exception as e:
+            wl_log.error("Sanity checks failed: %s", e)
+
+
+def set_crawl_dir(crawl_dir):
+    """Point the crawl dir and the paths under it to `crawl_dir`."""
+    # absolute, TorBrowserDriver changes the working directory
+    crawl_dir = abspath(crawl_dir)
+    cm.CRAWL_DIR = crawl_dir
+    cm.LOGS_DIR = join(crawl_dir, 'logs')
+    cm.DEFAULT_CRAWL_LOG = join(cm.LOGS_DIR, 'crawl.log')
+    cm.DEFAULT_TOR_LOG = join(cm.LOGS_DIR, 'tor.log')
+    cm.DEFAULT_FF_LOG = join(cm.LOGS_DIR, 'ff.log')
+    cm.DEFAULT_JOURNAL = join(cm.LOGS_DIR, 'journal.jsonl')
+    cm.DEFAULT_TOR_BOOTSTRAPS = join(cm.LOGS_DIR, 'tor_bootstraps.json')
+    cm.DEFAULT_TIMINGS = join(cm.LOGS_DIR, 'timings.jsonl')
+    cm.DEFAULT_LOAD_TIMES = join(cm.LOGS_DIR, 'load_times.jsonl')
+    cm.DEFAULT_ARCHIVE = join(crawl_dir, 'crawl' + cm.ARCHIVE_EXT)
+
+
+def save_crawl_args(args):
+    """Store the command line options to resume the crawl with."""
+    crawl_args = vars(args).copy()
+    crawl_args['url_file'] = abspath(args.url_file)
+    with open(join(cm.LOGS_DIR, CRAWL_ARGS_FILE), 'w') as f:
+        json.dump(crawl_args, f, indent=2)
+
+
+def load_crawl_args(crawl_dir):
+    """Return the options and the config of the crawl in `crawl_dir`."""
+    set_crawl_dir(crawl_dir)
+    with open(join(cm.LOGS_DIR, CRAWL_ARGS_FILE)) as f:
+        args = argparse.Namespace(**json.load(f))
+    args.resume = cm.CRAWL_DIR
+    config = ConfigParser.RawConfigParser()
+    config.read(join(cm.LOGS_DIR, 'config.ini'))
+    wl_log.info("Resuming crawl in %s", cm.CRAWL_DIR)
+    return args, config
 
 
 def build_crawl_dirs():
@@ -99,19 +316,31 @@ def build_crawl_dirs():
     add_symlink(join(cm.RESULTS_DIR, 'latest_crawl'), basename(cm.CRAWL_DIR))
 
 
-def parse_url_list(file_path, start, stop):
-    """Return list of urls from a file."""
-    url_list = []
+def parse_url_list(file_path, start, stop, shard=None, shard_by='hash'):
+    """Return {site index: url} for the URLs of our shard of a file."""
+    url_list = {}
     try:
-        with open(file_path) as f:
-            file_contents = f.read()
-            url_list = file_contents.splitlines()
-            url_list = url_list[start - 1:stop]
+        url_list = load_shard(file_path, tuple(shard or (1, 1)), shard_by,
+                              start, stop)
     except Exception as e:
         ut.die("ERROR: while parsing URL list: {} \n{}".format(e, traceback.format_exc()))
+    if shard:
+        wl_log.info("%s URLs in shard %s/%s", len(url_list), *shard)
     return url_list
 
 
+def get_reset_strategy(config, section):
+    job_config = ut.get_dict_subconfig(config, section, "job")
+    return job_config.get('reset', cm.RESET_RESTART)
+
+
+def shard_type(shard):
+    try:
+        return parse_shard(shard)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
 def parse_arguments():
     # Read configuration file
     config = ConfigParser.RawConfigParser()
@@ -121,9 +350,14 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='Crawl a list of URLs in multiple batches.')
 
     # List of urls to be crawled
-    parser.add_argument('-u', '--url-file', required=True,
+    parser.add_argument('-u', '--url-file',
                         help='Path to the file that contains the list of URLs to crawl.',
-                        default=cm.LOCALIZED_DATASET)
+                        default=None)
+    parser.add_argument('--resume', metavar='CRAWL_DIR',
+                        help='Resume an interrupted crawl, skipping the '
+                             'visits in its journal. Other options are '
+                             'taken from the original crawl.',
+                        default='')
     parser.add_argument('-t', '--type',
                         choices=cm.CRAWLER_TYPES,
                         help="Crawler type to use for this crawl.",
@@ -149,6 +383,69 @@ def parse_arguments():
     parser.add_argument('-s', '--screenshots', action='store_true',
                         help='Capture page screenshots',
                         default=False)
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Number of parallel Tor/browser instances.',
+                        default=1)
+    parser.add_argument('--capture-mode', choices=cm.CAPTURE_MODES,
+                        help="Run one capture per visit, or one per batch "
+                             "that is split into visits at the end of the "
+                             "batch (default: visit).",
+                        default='visit')
+    parser.add_argument('--capture-filter', choices=cm.CAPTURE_FILTERS,
+                        help="Capture only the traffic to the guards of "
+                             "the current circuits, or all TCP traffic. "
+                             "Guard captures are not filtered again after "
+                             "the visit, visits that use a new guard are "
+                             "recorded as stale_filter. Ignored when entry "
+                             "guards are disabled (default: tcp, always "
+                             "guards with several workers).",
+                        default='tcp')
+    parser.add_argument('--prelaunch-browser', action='store_true',
+                        help="Start the browser for the next visit once "
+                             "the capture of the current page is over, "
+                             "during the screenshot and the pause between "
+                             "visits (still one fresh browser per visit).",
+                        default=False)
+    parser.add_argument('--tor-standby', action='store_true',
+                        help="Bootstrap the Tor process of the next batch "
+                             "while the current batch is crawled. The "
+                             "standby always runs on a clone of the Tor "
+                             "data dir, even with a single worker, and its "
+                             "bootstrap traffic may show up in the "
+                             "captures.",
+                        default=False)
+    parser.add_argument('--pack', action='store_true',
+                        help="Move each visit directory into a compressed, "
+                             "indexed archive in the crawl dir once the "
+                             "visit is processed.",
+                        default=False)
+    parser.add_argument('--quiescence', action='store_true',
+                        help="End visits once Tor has carried no traffic "
+                             "for quiescence_idle seconds (see the job "
+                             "options in config.ini) instead of "
+                             "pause_in_site seconds after the page load.",
+                        default=False)
+    parser.add_argument('--adaptive-timeouts', action='store_true',
+                        help="Derive the timeout of each visit from the "
+                             "load times of the previous visits to the "
+                             "site, instead of %s s for all visits."
+                             % cm.SOFT_VISIT_TIMEOUT,
+                        default=False)
+    parser.add_argument('--tor-events', action='store_true',
+                        help="Write the circuit, stream, bandwidth and OR "
+                             "connection events of Tor during each visit "
+                             "to %s in the visit directory."
+                             % cm.TOR_EVENTS_FILE,
+                        default=False)
+    parser.add_argument('--sanity-check', action='store_true',
+                        help="Check the visits after the crawl and write a "
+                             "report to logs/%s." % cm.SANITY_REPORT,
+                        default=False)
+    parser.add_argument('-p', '--post-processes', type=int,
+                        help='Number of processes to filter and compress '
+                             'captures in the background (default: 0, '
+                             'process each visit right after it ends).',
+                        default=0)
 
     # Limit crawl
     parser.add_argument('--start', type=int,
@@ -157,16 +454,39 @@ def parse_arguments():
     parser.add_argument('--stop', type=int,
                         help='Select URLs after this line number: (default: EOF).',
                         default=maxsize)
+    parser.add_argument('--shard', type=shard_type, metavar='i/N',
+                        help='Crawl the i-th of N shards of the URL list, '
+                             'e.g. one per machine. Every machine computes '
+                             'the same partition from the same list.',
+                        default=None)
+    parser.add_argument('--shard-by', choices=SHARD_METHODS,
+                        help='Deal URLs to shards by hash, or give each '
+                             'shard a contiguous range (default: hash).',
+                        default='hash')
+
+    # Distributed crawl
+    parser.add_argument('--coordinator', metavar='HOST[:PORT]',
+                        help='Lease visits from the coordinator of a crawl '
+                             'run by several nodes (see bin/coordinator.py).',
+                        default=None)
+    parser.add_argument('--node', help='Name of this node for the '
+                        'coordinator (default: host name).',
+                        default=socket.gethostname())
 
     # Parse arguments
     args = parser.parse_args()
+    if not (args.url_file or args.resume):
+        parser.error("either --url-file or --resume is required")
+    if get_reset_strategy(config, args.config) not in cm.RESET_STRATEGIES:
+        parser.error("job reset must be one of %s in the config section %s"
+                     % (", ".join(cm.RESET_STRATEGIES), args.config))
 
     # Set verbose level
     wl_log.setLevel(DEBUG if args.verbose else INFO)
     del args.verbose
 
     # Change results dir if output
-    cm.CRAWL_DIR = args.output
+    set_crawl_dir(args.output)
     del args.output
 
     wl_log.debug("Command line parameters: %s" % argv)
@@ -183,9 +503,16 @@ class TorBrowserWrapper(object):
     to implement the contextmanager.
     """
     def __init__(self, *args, **kwargs):
+        # start the next browser while the current one is visiting a page
+        self.prelaunch = kwargs.pop('prelaunch', False)
         self.args = args
         self.kwargs = kwargs
         self.driver = None
+        self.driver_quit = False
+        self.quit_lock = Lock()
+        self.next_driver = None
+        self.prelaunch_thread = None
+        self.prelaunch_error = None
 
     def __getattr__(self, item):
         if self.driver is None:
@@ -194,12 +521,80 @@ class TorBrowserWrapper(object):
             return getattr(self, item)
         return getattr(self.driver, item)
 
+    def start_prelaunch(self):
+        """Start the browser for the next visit, if prelaunch is on.
+
+        Called by the crawler once the capture of the page has stopped,
+        the startup traffic of the browser would end up in it otherwise.
+        """
+        if not self.prelaunch or self.prelaunch_thread is not None:
+            return
+        self.prelaunch_thread = Thread(target=self.prelaunch_driver)
+        self.prelaunch_thread.daemon = True
+        self.prelaunch_thread.start()
+
+    def prelaunch_driver(self):
+        try:
+            self.next_driver = TorBrowserDriver(*self.args, **self.kwargs)
+        except Exception as e:
+            self.prelaunch_error = e
+
+    def get_new_driver(self):
+        """Return the prelaunched driver, or launch one if there is none.
+
+        Each driver is handed out only once, so every visit still gets a
+        fresh browser.
+        """
+        if self.prelaunch_thread is not None:
+            self.prelaunch_thread.join()
+            self.prelaunch_thread = None
+            driver, self.next_driver = self.next_driver, None
+            if driver is not None:
+                return driver
+            wl_log.error("Cannot prelaunch browser: %s", self.prelaunch_error)
+        return TorBrowserDriver(*self.args, **self.kwargs)
+
+    def set_tor_ports(self, socks_port, control_port):
+        """Point the next browsers to another Tor process."""
+        if (self.kwargs.get('socks_port') == socks_port and
+                self.kwargs.get('control_port') == control_port):
+            return
+        self.quit_prelaunched()
+        self.kwargs.update(socks_port=socks_port, control_port=control_port)
+
+    def quit_prelaunched(self):
+        """Quit the browser prelaunched for a visit that won't happen.
+
+        Runs during cleanup, possibly without Tor, so no browser is
+        launched here even if the prelaunch failed.
+        """
+        if self.prelaunch_thread is None:
+            return
+        self.prelaunch_thread.join()
+        self.prelaunch_thread = None
+        driver, self.next_driver = self.next_driver, None
+        if driver is not None:
+            driver.quit()
+
+    def quit(self):
+        """Quit the browser of the current visit, if not done yet.
+
+        The hard deadline of a visit may quit it from another thread.
+        """
+        with self.quit_lock:
+            if self.driver is None or self.driver_quit:
+                return
+            self.driver_quit = True
+        self.driver.quit()
+
     @contextmanager
     def launch(self):
-        self.driver = TorBrowserDriver(*self.args, **self.kwargs)
+        with timing.phase('browser_launch'):
+            self.driver = self.get_new_driver()
+            self.driver_quit = False
         yield self.driver
-        self.driver.quit()
-
+        with timing.phase('browser_quit'):
+            self.quit()
 
 if __name__ == '__main__':
     run()
@@ -0,0 +1,53 @@
+"""End visits once Tor traffic has gone quiet.
+
+Tor reports the bytes it read and wrote every second in BW events. A
+visit ends when no second carried more than `min_bytes` for `idle`
+seconds, within the min and max visit durations, instead of after a
+fixed pause.
+"""
+from time import sleep
+
+import common as cm
+from timing import monotonic
+
+# why a visit ended
+END_PAUSE = 'pause'  # fixed pause_in_site after the page load
+END_QUIESCENT = 'quiescent'
+END_MAX_DURATION = 'max_duration'
+
+
+class TrafficMonitor(object):
+    """Keep the time Tor last carried traffic, from its BW events."""
+
+    def __init__(self, min_bytes=cm.QUIESCENCE_MIN_BYTES,
+                 poll_interval=cm.QUIESCENCE_POLL_INTERVAL):
+        # cells of keepalives and padding are below min_bytes
+        self.min_bytes = min_bytes
+        self.poll_interval = poll_interval
+        self.last_active = monotonic()
+
+    def bw_handler(self, event):
+        if event.read + event.written > self.min_bytes:
+            self.last_active = monotonic()
+
+    def reset(self):
+        """Count idle time from now, e.g. at the start of a visit."""
+        self.last_active = monotonic()
+
+    def idle_time(self):
+        return monotonic() - self.last_active
+
+    def wait(self, start, idle, min_duration, max_duration):
+        """Wait for `idle` seconds without traffic, return the end reason.
+
+        Durations count from `start`, a timing.monotonic() time.
+        """
+        while True:
+            now = monotonic()
+            elapsed = now - start
+            if elapsed >= max_duration:
+                return END_MAX_DURATION
+            idle_time = now - self.last_active
+            if elapsed >= min_duration and idle_time >= idle:
+                return END_QUIESCENT
+            sleep(self.poll_interval)
@@ -0,0 +1,235 @@
+"""Post-crawl sanity checks.
+
+Every visit of a crawl, either still in its directory or packed in an
+archive, is summarized by a process pool: packets, bytes per direction,
+duration, share of the captured traffic that went to guards, screenshot
+presence and the outcome recorded in the journal. Suspicious visits are
+flagged and all the stats are written to a single JSON report.
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+from collections import Counter, defaultdict
+from io import BytesIO
+from multiprocessing import Pool, cpu_count
+from os.path import isdir, join
+
+import numpy as np
+
+import common as cm
+from archive import ArchiveReader, find_archives
+from journal import load_outcomes
+from log import wl_log
+from pcaputils import PcapReader
+
+VISIT_DIR_RE = re.compile(r'^\d+_\d+_\d+$')
+CAPTURE = "capture.pcap"
+ORIGINAL_CAPTURES = ("capture.pcap.original", "capture.pcap.original.gz")
+SCREENSHOT = "screenshot.png"
+
+# archives opened by the current worker process
+_archives = {}
+
+
+class VisitFiles(object):
+    """Open the files of a visit, in a directory or in an archive."""
+
+    def __init__(self, source, visit):
+        self.source = source
+        self.visit = visit
+        if isdir(source):
+            self.names = set(os.listdir(join(source, visit)))
+        else:
+            if source not in _archives:
+                _archives[source] = ArchiveReader(source)
+            self.archive = _archives[source]
+            self.names = set(self.archive.names(visit))
+
+    def open(self, name):
+        if isdir(self.source):
+            fileobj = open(join(self.source, self.visit, name), 'rb')
+        else:
+            fileobj = BytesIO(self.archive.read(self.visit, name))
+        if name.endswith('.gz'):
+            return gzip.GzipFile(fileobj=fileobj)
+        return fileobj
+
+
+def capture_stats(fileobj):
+    """Return packet count, bytes per direction and duration of a pcap.
+
+    The local address is the one taking part in the most packets.
+    """
+    with fileobj:
+        reader = PcapReader(fileobj)
+        addrs_of = reader.ipv4_tcp_addrs
+        n_packets = 0
+        first_header = header = None
+        addr_packets = {}
+        src_bytes = {}
+        for header, data in reader:
+            n_packets += 1
+            if first_header is None:
+                first_header = header
+            addrs = addrs_of(data)
+            if addrs is None:
+                continue
+            src, dst = addrs
+            addr_packets[src] = addr_packets.get(src, 0) + 1
+            addr_packets[dst] = addr_packets.get(dst, 0) + 1
+            src_bytes[src] = src_bytes.get(src, 0) + len(data)
+    if not n_packets:
+        return 0, 0, 0, 0.0
+    total = sum(src_bytes.values())
+    bytes_out = 0
+    if addr_packets:
+        local = max(addr_packets, key=addr_packets.get)
+        bytes_out = src_bytes.get(local, 0)
+    duration = reader.timestamp(header) - reader.timestamp(first_header)
+    return n_packets, bytes_out, total - bytes_out, duration
+
+
+def count_packets(fileobj):
+    with fileobj:
+        return sum(1 for _ in PcapReader(fileobj))
+
+
+def visit_stats(task):
+    """Compute the stats of a visit, `task` is (source, visit, outcome).
+
+    `packets` counts the filtered capture, `captured` the original one.
+    """
+    source, visit, outcome = task
+    batch, site, instance = map(int, visit.split('_'))
+    stats = {'visit': visit, 'batch': batch, 'site': site,
+             'instance': instance, 'outcome': outcome,
+             'timeout': outcome == 'timeout', 'packets': 0,
+             'bytes_out': 0, 'bytes_in': 0, 'duration': 0.0,
+             'captured': None, 'guard_share': None, 'error': None}
+    try:
+        files = VisitFiles(source, visit)
+        stats['screenshot'] = SCREENSHOT in files.names
+        if CAPTURE in files.names:
+            (stats['packets'], stats['bytes_out'], stats['bytes_in'],
+             stats['duration']) = capture_stats(files.open(CAPTURE))
+        for name in ORIGINAL_CAPTURES:
+            if name in files.names:
+                stats['captured'] = count_packets(files.open(name))
+                if stats['captured']:
+                    stats['guard_share'] = (stats['packets'] /
+                                            float(stats['captured']))
+                break
+    except Exception as e:
+        stats['error'] = str(e)
+    return stats
+
+
+def find_visits(crawl_dir):
+    """Return (source, visit) for the visits in dirs, then in archives."""
+    visits = [(crawl_dir, name) for name in sorted(os.listdir(crawl_dir))
+              if VISIT_DIR_RE.match(name) and isdir(join(crawl_dir, name))]
+    seen = set(visit for _, visit in visits)
+    for archive_path in find_archives(crawl_dir):
+        with ArchiveReader(archive_path) as reader:
+            for visit in reader.visits():
+                if visit not in seen:
+                    seen.add(visit)
+                    visits.append((archive_path, visit))
+    return visits
+
+
+def flag_visits(visits, screenshots=True, max_z=cm.SANITY_OUTLIER_Z):
+    """Add the list of issues found to the stats of each visit.
+
+    Besides empty captures, failed loads, missing screenshots and captures
+    without guard traffic, a visit is an outlier if its packet count is
+    more than `max_z` robust z-scores away from the other visits to the
+    same site.
+    """
+    by_site = defaultdict(list)
+    for stats in visits:
+        stats['flags'] = flags = []
+        if stats['error']:
+            flags.append('error')
+        if stats['outcome'] not in ('ok', None):
+            flags.append(stats['outcome'])
+        if not (stats['captured'] or stats['packets']):
+            flags.append('empty_capture')
+        elif not stats['packets']:
+            flags.append('no_guard_traffic')
+        if screenshots and not stats.get('screenshot'):
+            flags.append('no_screenshot')
+        if stats['packets']:
+            by_site[stats['site']].append(stats)
+    for site_visits in by_site.values():
+        if len(site_visits) < 3:
+            continue
+        packets = np.log([s['packets'] for s in site_visits])
+        median = np.median(packets)
+        mad = np.median(np.abs(packets - median)) * 1.4826
+        if mad == 0:
+            continue
+        for stats, z in zip(site_visits, np.abs(packets - median) / mad):
+            if z > max_z:
+                stats['flags'].append('outlier')
+    return visits
+
+
+def check_crawl(crawl_dir, processes=None, report_path=None,
+                screenshots=True):
+    """Check all the visits of a crawl and write the report.
+
+    Return the report.
+    """
+    crawl_dir = crawl_dir.rstrip(os.sep)
+    outcomes = load_outcomes(join(crawl_dir, 'logs'))
+    tasks = [(source, visit,
+              outcomes.get(tuple(int(i) for i in visit.split('_'))))
+             for source, visit in find_visits(crawl_dir)]
+    wl_log.info("Checking %s visits in %s", len(tasks), crawl_dir)
+    pool = Pool(processes or cpu_count())
+    try:
+        visits = pool.map(visit_stats, tasks,
+                          chunksize=cm.SANITY_CHUNK_SIZE)
+    finally:
+        pool.close()
+        pool.join()
+    flag_visits(visits, screenshots)
+    flag_counts = Counter(flag for stats in visits
+                          for flag in stats['flags'])
+    report = {'crawl_dir': crawl_dir,
+              'summary': {'visits': len(visits),
+                          'flagged': sum(1 for s in visits if s['flags']),
+                          'flags': dict(flag_counts)},
+              'visits': visits}
+    report_path = report_path or join(crawl_dir, 'logs', cm.SANITY_REPORT)
+    with open(report_path, 'w') as f:
+        json.dump(report, f)
+    wl_log.info("Sanity report written to %s: %s", report_path,
+                report['summary'])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check a finished crawl.')
+    parser.add_argument('crawl_dir', help='Crawl directory.')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Number of processes (default: one per CPU).')
+    parser.add_argument('--no-screenshots', action='store_false',
+                        dest='screenshots',
+                        help='The crawl did not take screenshots.')
+    parser.add_argument('-o', '--output',
+                        help='Report path (default: logs/%s in the crawl '
+                             'dir).' % cm.SANITY_REPORT)
+    args = parser.parse_args()
+    if not isdir(args.crawl_dir):
+        parser.error("%s is not a directory" % args.crawl_dir)
+    report = check_crawl(args.crawl_dir, args.processes, args.output,
+                         args.screenshots)
+    print(json.dumps(report['summary'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import os
+import tempfile
+import unittest
+from os.path import isdir, join
+from shutil import rmtree
+
+from tbcrawler import archive as ar
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.archive_path = join(self.tempdir, "crawl.tbca")
+        self.visits = {}
+        for visit in ("0_0_0", "0_1_0", "1_0_1"):
+            self.visits[visit] = {
+                "capture.pcap": os.urandom(3000) + b'\x00' * 100000,
+                "screenshot.png": visit * 1000}
+            self.make_visit_dir(visit)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def make_visit_dir(self, visit):
+        visit_dir = join(self.tempdir, visit)
+        os.mkdir(visit_dir)
+        for name, content in self.visits[visit].items():
+            with open(join(visit_dir, name), 'wb') as f:
+                f.write(content)
+        return visit_dir
+
+    def write_archive(self, visits=None, **kwargs):
+        with ar.ArchiveWriter(self.archive_path, **kwargs) as writer:
+            for visit in visits or sorted(self.visits):
+                writer.add_visit(join(self.tempdir, visit), remove=True)
+
+    def test_round_trip(self):
+        self.write_archive(block_size=4096)
+        with ar.ArchiveReader(self.archive_path, block_size=4096) as reader:
+            self.assertEqual(reader.visits(), sorted(self.visits))
+            self.assertEqual(reader.names("0_1_0"),
+                             ["capture.pcap", "screenshot.png"])
+            for visit, name, content in reader:
+                self.assertEqual(content, self.visits[visit][name])
+
+    def test_random_access(self):
+        self.write_archive()
+        with ar.ArchiveReader(self.archive_path) as reader:
+            self.assertEqual(reader.read("1_0_1", "screenshot.png"),
+                             self.visits["1_0_1"]["screenshot.png"])
+            out_path = join(self.tempdir, "capture.pcap")
+            reader.extract("0_1_0", "capture.pcap", out_path)
+            with open(out_path, 'rb') as f:
+                self.assertEqual(f.read(),
+                                 self.visits["0_1_0"]["capture.pcap"])
+            self.assertRaises(ar.ArchiveError, reader.read, "9_9_9",
+                              "capture.pcap")
+
+    def test_compressed(self):
+        self.write_archive()
+        raw_size = sum(len(content) for files in self.visits.values()
+                       for content in files.values())
+        self.assertLess(os.path.getsize(self.archive_path), raw_size / 5)
+
+    def test_visit_dirs_are_removed(self):
+        self.write_archive()
+        for visit in self.visits:
+            self.assertFalse(isdir(join(self.tempdir, visit)))
+
+    def test_resume_after_interrupted_write(self):
+        self.write_archive(["0_0_0", "0_1_0"])
+        # simulate a crash while writing: unindexed data and a partial line
+        with open(self.archive_path, 'ab') as f:
+            f.write(b'garbage')
+        with open(self.archive_path + ar.INDEX_EXT, 'a') as f:
+            f.write('{"visit": "0_1')
+        self.write_archive(["1_0_1"])
+        with ar.ArchiveReader(self.archive_path) as reader:
+            self.assertEqual(reader.visits(), sorted(self.visits))
+            for visit, name, content in reader:
+                self.assertEqual(content, self.visits[visit][name])
+
+    def test_corrupted_member(self):
+        self.write_archive(["0_0_0"])
+        with ar.ArchiveReader(self.archive_path) as reader:
+            member = reader.index[("0_0_0", "screenshot.png")]
+        with open(self.archive_path, 'rb+') as f:
+            f.seek(member['offset'] + member['length'] // 2)
+            f.write(b'\xff\xff\xff')
+        with ar.ArchiveReader(self.archive_path) as reader:
+            self.assertRaises(Exception, reader.read, "0_0_0",
+                              "screenshot.png")
+            self.assertEqual(reader.read("0_0_0", "capture.pcap"),
+                             self.visits["0_0_0"]["capture.pcap"])
+
+    def test_find_archives(self):
+        self.write_archive()
+        open(join(self.tempdir, "crawl.1.tbca"), 'w').close()
+        self.assertEqual(ar.find_archives(self.tempdir),
+                         [join(self.tempdir, "crawl.1.tbca"),
+                          self.archive_path])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import copy
+import json
+import os
+import unittest
+from os.path import isfile, join
+
+from tbcrawler.bench import suite
+from tbcrawler.bench.fakes import (FakeCrawlTestCase, FakeDriver,
+                                   FakeTorController, synthetic_circuits,
+                                   synthetic_consensus)
+from tbcrawler.crawler import CrawlerBase, CrawlJob
+
+
+class FakesTest(FakeCrawlTestCase):
+    def setUp(self):
+        super(FakesTest, self).setUp()
+        self.consensus = synthetic_consensus(200)
+        self.circuits = synthetic_circuits(self.consensus, 4, n_unknown=1)
+
+    def test_guard_lookup(self):
+        controller = FakeTorController(self.tempdir, self.consensus,
+                                       self.circuits)
+        with controller.launch():
+            guard_ips = controller.get_guard_ips()
+            all_guards = controller.get_all_guard_ips()
+        self.assertEqual(guard_ips[0], '10.255.255.1')  # unknown guard
+        self.assertTrue(set(guard_ips[1:]) <= all_guards)
+        self.assertEqual(len(all_guards),
+                         sum('Guard' in r.flags for r in self.consensus))
+
+    def test_offline_crawl(self):
+        driver = FakeDriver()
+        crawler = CrawlerBase(
+            driver, FakeTorController(self.tempdir, self.consensus,
+                                      self.circuits),
+            guard_filter=True)
+        config = dict(suite.JOB_CONFIG, visits=2, batches=1)
+        crawler.crawl(CrawlJob(config, ['http://a.example',
+                                        'http://b.example']))
+        self.assertEqual(len(driver.visited), 4)
+        self.assertEqual(sorted(os.listdir(join(self.tempdir, 'crawl'))),
+                         ['0_0_0', '0_0_1', '0_1_0', '0_1_1'])
+        visit_dir = join(self.tempdir, 'crawl', '0_1_1')
+        self.assertTrue(isfile(join(visit_dir, 'capture.pcap')))
+        self.assertTrue(isfile(join(visit_dir, 'screenshot.png')))
+
+
+class SuiteTest(unittest.TestCase):
+    def test_quick_suite(self):
+        results = suite.run_suite(suite.QUICK_PARAMS)
+        self.assertEqual(sorted(results['results']),
+                         ['crawl', 'filter_pcap',
+                          'guard_lookup.all_guard_ips',
+                          'guard_lookup.guard_index',
+                          'guard_lookup.guard_ips', 'job_paths'])
+        self.assertEqual(results['results']['crawl']['items'], 6)
+        # the results document is JSON serializable
+        json.loads(json.dumps(results))
+
+    def test_compare(self):
+        baseline = {'params': {'repeat': 1},
+                    'results': {'a': {'best': 1.0}, 'b': {'best': 2.0}}}
+        new = copy.deepcopy(baseline)
+        new['results']['a']['best'] = 1.5
+        new['results']['c'] = {'best': 1.0}
+        rows = suite.compare(new, baseline, max_slowdown=1.25)
+        self.assertEqual([(name, regressed)
+                          for name, _, _, _, regressed in rows],
+                         [('a', True), ('b', False)])
+        new['params']['repeat'] = 2
+        self.assertRaises(ValueError, suite.compare, new, baseline)
+
+
+if __name__ == "__main__":
+    unittest.main()
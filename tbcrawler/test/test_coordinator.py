@@ -0,0 +1,145 @@
+import os
+import tempfile
+import threading
+import unittest
+from os.path import join
+from shutil import rmtree
+
+from tbcrawler import coordinator as co
+from tbcrawler.bench.fakes import (FakeCrawlTestCase, FakeDriver,
+                                   FakeTorController, synthetic_consensus)
+from tbcrawler.crawler import CrawlerBase, CrawlJob
+
+JOB_CONFIG = {'visits': '2', 'batches': '2', 'pause_between_batches': '0',
+              'pause_between_sites': '0', 'pause_between_visits': '0',
+              'pause_in_site': '0'}
+URLS = ['http://site%s.example' % i for i in xrange(5)]
+SPEC = co.job_spec(CrawlJob(JOB_CONFIG, URLS))
+
+
+class CoordinatorStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.db_path = join(self.tempdir, 'coordinator.sqlite')
+        self.store = co.CoordinatorStore(self.db_path, lease_time=10)
+        self.store.register('a', SPEC, now=0)
+        self.store.register('b', SPEC, now=0)
+
+    def tearDown(self):
+        self.store.close()
+        rmtree(self.tempdir)
+
+    def test_claim(self):
+        self.assertTrue(self.store.claim('a', 0, 1, 0, now=1))
+        self.assertTrue(self.store.claim('a', 0, 1, 0, now=2))  # renewed
+        self.assertFalse(self.store.claim('b', 0, 1, 0, now=2))
+        self.assertTrue(self.store.is_completed('b', 0, 1, 0, now=2))
+        self.assertFalse(self.store.is_completed('a', 0, 1, 0, now=2))
+        self.store.complete('a', 0, 1, 0, 'ok', now=3)
+        self.assertFalse(self.store.claim('a', 0, 1, 0, now=4))
+        self.assertTrue(self.store.is_completed('a', 0, 1, 0, now=4))
+
+    def test_expired_lease_is_requeued(self):
+        self.store.claim('a', 0, 1, 0, now=1)
+        self.assertEqual(self.store.heartbeat('a', now=5), 1)
+        self.assertFalse(self.store.claim('b', 0, 1, 0, now=14))
+        self.assertTrue(self.store.claim('b', 0, 1, 0, now=16))
+        status = self.store.status(now=16)
+        self.assertEqual((status['leased'], status['requeued']), (1, 1))
+        # the lost node cannot take it back
+        self.assertFalse(self.store.claim('a', 0, 1, 0, now=17))
+
+    def test_batch_completed(self):
+        for site in xrange(5):
+            for instance in (0, 1):
+                self.store.claim('a', 0, site, instance, now=1)
+        self.assertTrue(self.store.batch_completed('b', 0, now=2))
+        self.assertFalse(self.store.batch_completed('a', 0, now=2))
+        self.assertFalse(self.store.batch_completed('b', 1, now=2))
+        self.assertFalse(self.store.batch_completed('b', 0, now=12))
+
+    def test_status(self):
+        for site in xrange(3):
+            self.store.claim('a', 0, site, 0, now=1)
+            self.store.complete('a', 0, site, 0, 'ok', now=2)
+        self.store.claim('b', 0, 4, 0, now=2)
+        status = self.store.status(now=4)
+        self.assertEqual(status['total'], 20)
+        self.assertEqual((status['done'], status['leased'],
+                          status['available']), (3, 1, 16))
+        self.assertFalse(status['finished'])
+        self.assertEqual(status['nodes']['a']['completed'], 3)
+        self.assertAlmostEqual(status['nodes']['a']['visits_per_hour'],
+                               3600 * 3 / 4.0)
+        self.assertIn('3/20 visits done', co.format_status(status))
+
+    def test_other_job_is_rejected(self):
+        urls = URLS + ['http://other.example']
+        spec = co.job_spec(CrawlJob(JOB_CONFIG, urls))
+        self.assertRaises(co.CoordinatorError, self.store.register, 'c',
+                          spec, now=0)
+
+    def test_state_is_persistent(self):
+        self.store.claim('a', 1, 2, 3, now=1)
+        self.store.complete('a', 1, 2, 3, 'timeout', now=2)
+        self.store.close()
+        self.store = co.CoordinatorStore(self.db_path, lease_time=10)
+        self.assertEqual(self.store.spec, SPEC)
+        self.assertTrue(self.store.is_completed('b', 1, 2, 3, now=3))
+
+
+class DistributedCrawlTest(FakeCrawlTestCase):
+    def setUp(self):
+        super(DistributedCrawlTest, self).setUp()
+        self.store = co.CoordinatorStore(join(self.tempdir, 'co.sqlite'))
+        self.server = co.CoordinatorServer(('127.0.0.1', 0), self.store)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.store.close()
+        super(DistributedCrawlTest, self).tearDown()
+
+    def client(self, node):
+        return co.CoordinatorClient(self.server.server_address, node,
+                                    CrawlJob(JOB_CONFIG, URLS), heartbeat=1)
+
+    def test_unknown_operation(self):
+        client = self.client('a')
+        self.assertRaises(co.CoordinatorError, client.call, 'drop_table')
+        client.close()
+
+    def test_nodes_share_the_crawl(self):
+        consensus = synthetic_consensus(50)
+        drivers = []
+
+        def crawl(node):
+            driver = FakeDriver(latency=0.02)
+            drivers.append(driver)
+            tor_dir = join(self.tempdir, node)
+            os.mkdir(tor_dir)
+            crawler = CrawlerBase(driver,
+                                  FakeTorController(tor_dir, consensus),
+                                  journal=self.client(node))
+            crawler.crawl(CrawlJob(JOB_CONFIG, URLS))
+
+        nodes = [threading.Thread(target=crawl, args=(node,))
+                 for node in ('a', 'b')]
+        for node in nodes:
+            node.start()
+        for node in nodes:
+            node.join()
+        status = self.store.status(now=0)
+        self.assertTrue(status['finished'])
+        self.assertEqual(status['done'], 20)
+        # every visit was done once, by either node
+        self.assertEqual(sum(len(driver.visited) for driver in drivers), 20)
+        self.assertTrue(all(stats['completed'] > 0
+                            for stats in status['nodes'].values()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,17 @@
 import os
 import shutil
+import socket
+import time
 import unittest
-from os.path import isfile, isdir
+from os.path import basename, isfile, isdir, join
 
 from tbcrawler import common as cm
-from tbcrawler.crawler import CrawlerBase
+from tbcrawler import dumputils
+from tbcrawler.bench.fakes import (CircuitEvent, FakeCrawlTestCase, FakeDriver,
+                                   FakeTorController, synthetic_circuits,
+                                   synthetic_consensus)
+from tbcrawler.crawler import CrawlerBase, CrawlerWebFP, CrawlJob
+from tbcrawler.journal import CrawlJournal, load_completed, load_outcomes
 
 TEST_URL_LIST = ['https://www.google.de',
                  'https://torproject.org',
@@ -36,5 +43,216 @@ class CrawlerTest(unittest.TestCase):
         os.remove(tar_gz_crawl_data)
 
 
+TEST_JOB_CONFIG = {'visits': '2', 'batches': '3'}
+TEST_CRAWL_CONFIG = {'visits': '1', 'batches': '1',
+                     'pause_between_batches': '0', 'pause_between_sites': '0',
+                     'pause_between_visits': '0', 'pause_in_site': '0'}
+
+
+class CrawlJobTest(unittest.TestCase):
+    def test_default_sites(self):
+        job = CrawlJob(TEST_JOB_CONFIG, TEST_URL_LIST)
+        self.assertEqual(job.sites, [0, 1, 2])
+
+    def test_long_urls_are_left_out(self):
+        urls = TEST_URL_LIST + ['http://example.com/' +
+                                'a' * cm.MAX_FNAME_LENGTH]
+        job = CrawlJob(TEST_JOB_CONFIG, urls)
+        self.assertEqual(job.sites, [0, 1, 2])
+
+    def test_sharded_sites_keep_layout(self):
+        job = CrawlJob(TEST_JOB_CONFIG, TEST_URL_LIST, sites=xrange(1, 3, 2))
+        self.assertEqual(job.sites, [1])
+        job.site, job.batch, job.visit = 1, 2, 1
+        self.assertEqual(job.url, TEST_URL_LIST[1])
+        self.assertEqual(os.path.basename(job.path), "2_1_5")
+
+
+class BatchCaptureCrawler(CrawlerBase):
+    """Keep the batch captures instead of splitting them."""
+
+    def __init__(self, *args, **kwargs):
+        super(BatchCaptureCrawler, self).__init__(*args, **kwargs)
+        self.captures = []
+
+    def split_capture(self, capture_path, visit_slices):
+        self.captures.append((basename(capture_path),
+                              [visit_slice[-1] for visit_slice in
+                               visit_slices]))
+
+
+class NewGuardDriver(FakeDriver):
+    """Build a circuit through an unknown guard while loading `url`."""
+
+    def __init__(self, controller, url):
+        super(NewGuardDriver, self).__init__()
+        self.controller = controller
+        self.url = url
+
+    def get(self, url):
+        super(NewGuardDriver, self).get(url)
+        if url == self.url:
+            self.controller.circuit_handler(
+                CircuitEvent('CIRC', '99', 'BUILT', [('F' * 40, 'new')],
+                             'GENERAL', None))
+
+
+class GuardFilterTest(FakeCrawlTestCase):
+    def setUp(self):
+        super(GuardFilterTest, self).setUp()
+        consensus = synthetic_consensus(20)
+        self.controller = FakeTorController(
+            self.tempdir, consensus, synthetic_circuits(consensus, 3))
+
+    def test_batch_capture_restarts_on_new_guard(self):
+        driver = NewGuardDriver(self.controller, TEST_URL_LIST[1])
+        crawler = BatchCaptureCrawler(driver, self.controller,
+                                      guard_filter=True,
+                                      capture_mode='batch')
+        crawler.crawl(CrawlJob(TEST_CRAWL_CONFIG, TEST_URL_LIST))
+        pid = os.getpid()
+        # the capture of the second visit missed the new guard
+        self.assertEqual(crawler.captures,
+                         [('batch_0_%s.pcap' % pid, [True, False]),
+                          ('batch_0_%s.1.pcap' % pid, [True])])
+
+    def test_prelaunch_after_capture(self):
+        calls = []
+
+        class PrelaunchDriver(FakeDriver):
+            def start_prelaunch(self):
+                calls.append('prelaunch')
+
+        stop_capture = dumputils.Sniffer.stop_capture
+
+        def record_stop(sniffer):
+            calls.append('stop_capture')
+            stop_capture(sniffer)
+
+        dumputils.Sniffer.stop_capture = record_stop
+        try:
+            crawler = CrawlerBase(PrelaunchDriver(), self.controller)
+            crawler.crawl(CrawlJob(TEST_CRAWL_CONFIG, TEST_URL_LIST[:1]))
+        finally:
+            dumputils.Sniffer.stop_capture = stop_capture
+        self.assertEqual(calls, ['stop_capture', 'prelaunch'])
+
+    def test_visits_recorded_once_processed(self):
+        pending = []
+
+        class PendingPostProcessor(object):
+            """Never gets to process the visits, as in a crash."""
+
+            def submit(self, pcap_file, guard_ips, on_done=None,
+                       post_filter=True):
+                pending.append(on_done)
+
+            def close(self):
+                pass
+
+        journal = CrawlJournal(join(self.tempdir, 'journal.jsonl'))
+        crawler = CrawlerWebFP(FakeDriver(), self.controller,
+                               post_processor=PendingPostProcessor(),
+                               journal=journal)
+        crawler.crawl(CrawlJob(TEST_CRAWL_CONFIG, TEST_URL_LIST[:1]))
+        self.assertEqual(len(pending), 1)
+        # a resumed crawl does the visit again
+        self.assertEqual(load_completed(self.tempdir), set())
+
+    def test_unreadable_batch_capture(self):
+        # the fake dumpcap writes no ring buffer files
+        journal = CrawlJournal(join(self.tempdir, 'journal.jsonl'))
+        crawler = CrawlerBase(FakeDriver(), self.controller,
+                              capture_mode='batch', journal=journal)
+        crawler.crawl(CrawlJob(TEST_CRAWL_CONFIG, TEST_URL_LIST))
+        outcomes = load_outcomes(self.tempdir)
+        self.assertEqual([outcomes[(0, site, 0)] for site in xrange(3)],
+                         ['error'] * 3)
+
+    def test_stale_filter_marks_visit_invalid(self):
+        driver = NewGuardDriver(self.controller, TEST_URL_LIST[1])
+        journal = CrawlJournal(join(self.tempdir, 'journal.jsonl'))
+        crawler = CrawlerBase(driver, self.controller, guard_filter=True,
+                              journal=journal)
+        crawler.crawl(CrawlJob(TEST_CRAWL_CONFIG, TEST_URL_LIST))
+        journal.close()
+        outcomes = load_outcomes(self.tempdir)
+        self.assertEqual([outcomes[(0, site, 0)] for site in xrange(3)],
+                         ['ok', 'stale_filter', 'ok'])
+
+
+class HungDriver(FakeDriver):
+    """Browser that hangs on every page until it is quit."""
+
+    def __init__(self):
+        super(HungDriver, self).__init__()
+        self.quits = 0
+
+    def launch(self):
+        # a new browser for every visit
+        self.quits = 0
+        return super(HungDriver, self).launch()
+
+    def get(self, url):
+        while not self.quits:
+            # short sleeps, the hard timeout can only interrupt in between
+            time.sleep(0.01)
+
+    def get_screenshot_as_file(self, path):
+        if self.quits:
+            # what selenium raises once the browser is gone
+            raise socket.error(111, "Connection refused")
+        return super(HungDriver, self).get_screenshot_as_file(path)
+
+    def quit(self):
+        self.quits += 1
+
+
+class OutcomeCrawler(CrawlerBase):
+    def __init__(self, *args, **kwargs):
+        super(OutcomeCrawler, self).__init__(*args, **kwargs)
+        self.outcomes = []
+
+    def visit_done(self, outcome, end_reason=None):
+        self.outcomes.append(outcome)
+        super(OutcomeCrawler, self).visit_done(outcome, end_reason)
+
+
+class HardTimeoutTest(FakeCrawlTestCase):
+    def setUp(self):
+        super(HardTimeoutTest, self).setUp()
+        self.timeouts = cm.SOFT_VISIT_TIMEOUT, cm.HARD_VISIT_MARGIN
+        cm.SOFT_VISIT_TIMEOUT, cm.HARD_VISIT_MARGIN = 0.2, 0.1
+
+    def tearDown(self):
+        cm.SOFT_VISIT_TIMEOUT, cm.HARD_VISIT_MARGIN = self.timeouts
+        super(HardTimeoutTest, self).tearDown()
+
+    def test_hard_timeout_with_screenshots(self):
+        driver = HungDriver()
+        controller = FakeTorController(self.tempdir, synthetic_consensus(10))
+        crawler = OutcomeCrawler(driver, controller, screenshots=True)
+        config = {'visits': '2', 'batches': '1', 'pause_between_batches': '0',
+                  'pause_between_sites': '0', 'pause_between_visits': '0',
+                  'pause_in_site': '0'}
+        crawler.crawl(CrawlJob(config, TEST_URL_LIST[:1]))
+        self.assertEqual(crawler.outcomes, ['timeout', 'timeout'])
+        self.assertTrue(crawler.driver_cancelled)
+
+    def test_late_cancel_spares_later_visits(self):
+        driver = HungDriver()
+        controller = FakeTorController(self.tempdir, synthetic_consensus(10))
+        crawler = OutcomeCrawler(driver, controller)
+        config = {'visits': '1', 'batches': '1', 'pause_between_batches': '0',
+                  'pause_between_sites': '0', 'pause_between_visits': '0',
+                  'pause_in_site': '0'}
+        stale_token = crawler.visit_token
+        crawler.crawl(CrawlJob(config, TEST_URL_LIST[:1]))
+        driver.quits, crawler.driver_cancelled = 0, False
+        crawler.cancel_visit(stale_token)  # the canceller of the first visit
+        self.assertEqual(driver.quits, 0)
+        self.assertFalse(crawler.driver_cancelled)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,87 @@
+import threading
+import time
+import unittest
+
+from tbcrawler import utils as ut
+from tbcrawler.deadline import DeadlineExpired, scheduler
+
+
+def busy_wait(seconds):
+    """Run Python code for `seconds`, async exceptions land in between."""
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class DeadlineTest(unittest.TestCase):
+    def test_fractional_timeout(self):
+        start = time.time()
+        with self.assertRaises(ut.TimeoutException):
+            with ut.timeout(0.2):
+                busy_wait(2)
+        self.assertLess(time.time() - start, 0.6)
+
+    def test_no_timeout(self):
+        with ut.timeout(0.2):
+            busy_wait(0.05)
+        busy_wait(0.3)  # nothing is raised once the block is done
+
+    def test_inner_timeout(self):
+        with ut.timeout(2) as outer:
+            with self.assertRaises(DeadlineExpired) as cm:
+                with ut.timeout(0.1) as inner:
+                    busy_wait(1)
+            self.assertTrue(inner.owns(cm.exception))
+            busy_wait(0.1)
+        self.assertFalse(outer.expired)
+
+    def test_outer_timeout_is_not_swallowed(self):
+        with self.assertRaises(DeadlineExpired) as cm:
+            with ut.timeout(0.1) as outer:
+                try:
+                    with ut.timeout(5):
+                        busy_wait(1)
+                except ut.TimeoutException:
+                    pass  # swallowed, the outer block still times out
+                busy_wait(0.1)
+        self.assertTrue(outer.owns(cm.exception))
+
+    def test_threads(self):
+        errors = {}
+
+        def visit(name, seconds):
+            try:
+                with ut.timeout(seconds):
+                    busy_wait(0.5)
+            except ut.TimeoutException as exc:
+                errors[name] = exc
+
+        threads = [threading.Thread(target=visit, args=("fast", 0.1)),
+                   threading.Thread(target=visit, args=("slow", 5))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(errors), ["fast"])
+
+    def test_on_expire_cancels_blocked_operation(self):
+        cancelled = threading.Event()
+        start = time.time()
+        with self.assertRaises(ut.TimeoutException):
+            with ut.timeout(0.1, on_expire=cancelled.set):
+                # stands for a blocking call failing once cancelled
+                if cancelled.wait(5):
+                    raise IOError("Connection closed")
+        self.assertLess(time.time() - start, 1)
+
+    def test_finished_deadline_does_not_expire(self):
+        with ut.timeout(0.01) as deadline:
+            pass
+        busy_wait(0.1)
+        self.assertTrue(deadline.done)
+        self.assertFalse(deadline.expired)
+        self.assertTrue(scheduler.thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
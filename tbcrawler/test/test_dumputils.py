@@ -1,11 +1,14 @@
 import os
 import pytest
+import stat
 import time
 import unittest
 import tempfile
+from shutil import rmtree
 from urllib2 import urlopen
 
-from tbcrawler.dumputils import Sniffer
+from tbcrawler import dumputils
+from tbcrawler.dumputils import Sniffer, build_guard_filter
 
 TEST_CAP_FILTER = 'host 255.255.255.255'
 TEST_PCAP_FILE = tempfile.NamedTemporaryFile()
@@ -63,5 +66,78 @@ class SnifferTest(unittest.TestCase):
         self.assertGreater(os.path.getsize(TEST_PCAP_PATH), 0)
         os.remove(TEST_PCAP_PATH)
 
+
+FAKE_DUMPCAP = """#!/bin/sh
+%s
+exec sleep 30
+"""
+
+
+class SnifferReadinessTest(unittest.TestCase):
+    """Run the sniffer against a shell script that mimics dumpcap."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dumpcap_path = dumputils.DUMPCAP_PATH
+        self.start_timeout = dumputils.DUMPCAP_START_TIMEOUT
+        dumputils.DUMPCAP_PATH = os.path.join(self.tempdir, "dumpcap")
+        self.snf = Sniffer(path=os.path.join(self.tempdir, "capture.pcap"))
+
+    def tearDown(self):
+        dumputils.DUMPCAP_PATH = self.dumpcap_path
+        dumputils.DUMPCAP_START_TIMEOUT = self.start_timeout
+        rmtree(self.tempdir)
+
+    def write_fake_dumpcap(self, startup_cmd):
+        with open(dumputils.DUMPCAP_PATH, 'w') as f:
+            f.write(FAKE_DUMPCAP % startup_cmd)
+        os.chmod(dumputils.DUMPCAP_PATH, stat.S_IRWXU)
+
+    def test_ready_on_stderr_message(self):
+        self.write_fake_dumpcap("echo \"Capturing on 'eth0'\" >&2; "
+                                "sleep 0.2; echo 'File: x.pcap' >&2")
+        self.snf.start_capture()
+        self.assertTrue(self.snf.is_dumpcap_running())
+        self.assertGreaterEqual(self.snf.startup_time, 0.2)
+        self.assertLess(self.snf.startup_time, 2)
+        self.snf.stop_capture()
+        self.assertFalse(self.snf.is_dumpcap_running())
+
+    def test_ready_on_pcap_header(self):
+        self.write_fake_dumpcap("sleep 0.2; head -c 24 /dev/zero > %s"
+                                % self.snf.get_pcap_path())
+        self.snf.start_capture()
+        self.assertTrue(self.snf.is_recording)
+        self.snf.stop_capture()
+
+    def test_old_capture_is_not_ready(self):
+        dumputils.DUMPCAP_START_TIMEOUT = 0.3
+        # left by an interrupted visit
+        with open(self.snf.get_pcap_path(), 'w') as f:
+            f.write("\0" * 100)
+        self.write_fake_dumpcap("true")
+        self.assertRaises(dumputils.DumpcapTimeoutError,
+                          self.snf.start_capture)
+
+    def test_start_timeout(self):
+        dumputils.DUMPCAP_START_TIMEOUT = 0.3
+        self.write_fake_dumpcap("true")
+        self.assertRaises(dumputils.DumpcapTimeoutError,
+                          self.snf.start_capture)
+        self.assertFalse(self.snf.is_dumpcap_running())
+
+    def test_dumpcap_exits(self):
+        with open(dumputils.DUMPCAP_PATH, 'w') as f:
+            f.write("#!/bin/sh\necho 'permission denied' >&2\nexit 1\n")
+        os.chmod(dumputils.DUMPCAP_PATH, stat.S_IRWXU)
+        self.assertRaises(dumputils.DumpcapError, self.snf.start_capture)
+
+
+class GuardFilterTest(unittest.TestCase):
+    def test_build_guard_filter(self):
+        self.assertEqual(build_guard_filter(['1.1.1.1', '2.2.2.2']),
+                         'tcp and (host 1.1.1.1 or host 2.2.2.2)')
+
+
 if __name__ == "__main__":
     unittest.main()
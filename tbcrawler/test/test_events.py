@@ -0,0 +1,98 @@
+import json
+import tempfile
+import unittest
+from collections import namedtuple
+from os.path import join
+from shutil import rmtree
+
+from tbcrawler import common as cm
+from tbcrawler import events
+from tbcrawler.bench.fakes import (CircuitEvent, FakeCrawlTestCase, FakeDriver,
+                                   FakeTorController, synthetic_circuits,
+                                   synthetic_consensus)
+from tbcrawler.crawler import CrawlerBase, CrawlJob
+
+BwEvent = namedtuple('BwEvent', 'type read written')
+
+CIRC_BUILT = CircuitEvent('CIRC', '7', 'BUILT',
+                          [('A' * 40, 'a'), ('B' * 40, 'b')], 'GENERAL', None)
+
+
+def read_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class EventRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.recorder = events.EventRecorder()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_event_to_dict(self):
+        record = events.event_to_dict(1.5, CIRC_BUILT)
+        self.assertEqual(record, {'time': 1.5, 'type': 'CIRC', 'id': '7',
+                                  'status': 'BUILT', 'purpose': 'GENERAL',
+                                  'path': ['A' * 40, 'B' * 40]})
+
+    def test_only_records_during_visits(self):
+        self.recorder.handler(BwEvent('BW', 1, 2))
+        self.recorder.start()
+        self.recorder.handler(CIRC_BUILT)
+        self.recorder.handler(BwEvent('BW', 3, 4))
+        recorded = self.recorder.stop()
+        self.recorder.handler(BwEvent('BW', 5, 6))
+        path = join(self.tempdir, cm.TOR_EVENTS_FILE)
+        self.assertEqual(self.recorder.write(recorded, path), 2)
+        self.assertEqual([(e['type'], e.get('read')) for e in
+                          read_events(path)], [('CIRC', None), ('BW', 3)])
+
+    def test_circuits_open_at_start(self):
+        self.recorder.start([CIRC_BUILT])
+        recorded = self.recorder.stop()
+        path = join(self.tempdir, cm.TOR_EVENTS_FILE)
+        self.recorder.write(recorded, path)
+        record, = read_events(path)
+        self.assertTrue(record['snapshot'])
+        self.assertEqual((record['type'], record['id'], record['path']),
+                         ('CIRC', '7', ['A' * 40, 'B' * 40]))
+
+
+class EventRecorderCrawlTest(FakeCrawlTestCase):
+    def test_events_file_per_visit(self):
+        recorder = events.EventRecorder()
+        consensus = synthetic_consensus(10)
+        circuits = synthetic_circuits(consensus, 2)
+        controller = FakeTorController(self.tempdir, consensus, circuits,
+                                       event_recorder=recorder)
+
+        class EventDriver(FakeDriver):
+            def get(self, url):
+                super(EventDriver, self).get(url)
+                listeners = controller.controller.listeners
+                assert recorder.handler in listeners
+                recorder.handler(BwEvent('BW', len(url), 0))
+
+        crawler = CrawlerBase(EventDriver(), controller,
+                              event_recorder=recorder)
+        config = {'visits': '2', 'batches': '1', 'pause_between_batches': '0',
+                  'pause_between_sites': '0', 'pause_between_visits': '0',
+                  'pause_in_site': '0'}
+        urls = ['http://a.example', 'http://bb.example']
+        job = CrawlJob(config, urls)
+        crawler.crawl(job)
+        for job.site in xrange(2):
+            for job.visit in xrange(2):
+                records = read_events(job.events_file)
+                # the circuits open before the visit come first
+                self.assertEqual([(e['type'], e['id'], e.get('snapshot'))
+                                  for e in records[:2]],
+                                 [('CIRC', '1', True), ('CIRC', '2', True)])
+                self.assertEqual([e['read'] for e in records[2:]],
+                                 [len(job.url)])
+
+
+if __name__ == "__main__":
+    unittest.main()
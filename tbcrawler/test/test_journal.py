@@ -0,0 +1,75 @@
+import tempfile
+import unittest
+from os.path import join
+from shutil import rmtree
+
+from tbcrawler.journal import CrawlJournal, load_completed, read_journal
+
+TEST_URL = 'http://www.example.com'
+
+
+class CrawlJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.journal_path = join(self.tempdir, 'journal.jsonl')
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_record(self):
+        journal = CrawlJournal(self.journal_path)
+        journal.record(0, 1, 2, TEST_URL, 'ok')
+        self.assertTrue(journal.is_completed(0, 1, 2))
+        self.assertFalse(journal.is_completed(0, 1, 3))
+        journal.close()
+        records = list(read_journal(self.journal_path))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['outcome'], 'ok')
+        self.assertEqual(records[0]['url'], TEST_URL)
+
+    def test_sync_every(self):
+        journal = CrawlJournal(self.journal_path, sync_every=2)
+        journal.record(0, 0, 0, TEST_URL, 'ok')
+        self.assertEqual(journal.unsynced, 1)
+        self.assertEqual(list(read_journal(self.journal_path)), [])
+        journal.record(0, 1, 0, TEST_URL, 'timeout')
+        self.assertEqual(journal.unsynced, 0)
+        self.assertEqual(len(list(read_journal(self.journal_path))), 2)
+        journal.close()
+
+    def test_reload(self):
+        journal = CrawlJournal(self.journal_path)
+        journal.record(1, 2, 4, TEST_URL, 'error')
+        journal.close()
+        journal = CrawlJournal(self.journal_path)
+        self.assertTrue(journal.is_completed(1, 2, 4))
+        journal.close()
+
+    def test_load_all_journals_in_dir(self):
+        for worker in range(2):
+            journal = CrawlJournal(join(self.tempdir,
+                                        'journal.%s.jsonl' % worker))
+            journal.record(0, worker, 0, TEST_URL, 'ok')
+            journal.close()
+        self.assertEqual(load_completed(self.tempdir),
+                         set([(0, 0, 0), (0, 1, 0)]))
+
+    def test_partial_last_line(self):
+        journal = CrawlJournal(self.journal_path)
+        journal.record(0, 0, 0, TEST_URL, 'ok')
+        journal.close()
+        with open(self.journal_path, 'a') as f:
+            f.write('{"batch": 0, "si')
+        self.assertEqual(load_completed(self.tempdir), set([(0, 0, 0)]))
+
+    def test_record_after_partial_last_line(self):
+        with open(self.journal_path, 'w') as f:
+            f.write('{"batch": 0, "si')
+        journal = CrawlJournal(self.journal_path)
+        journal.record(0, 1, 0, TEST_URL, 'ok')
+        journal.close()
+        self.assertEqual(load_completed(self.tempdir), set([(0, 1, 0)]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import json
+import tempfile
+import unittest
+from os.path import join
+from shutil import rmtree
+
+from tbcrawler import common as cm
+from tbcrawler.bench.fakes import (FakeCrawlTestCase, FakeDriver,
+                                   FakeTorController, synthetic_consensus)
+from tbcrawler.crawler import CrawlerBase, CrawlJob
+from tbcrawler.loadtimes import LoadTimeProfile
+
+TEST_URL = 'http://example.com'
+
+
+class LoadTimeProfileTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = join(self.tempdir, 'load_times.jsonl')
+        self.profile = LoadTimeProfile(self.path, min_samples=2)
+
+    def tearDown(self):
+        self.profile.close()
+        rmtree(self.tempdir)
+
+    def test_global_timeout_until_enough_samples(self):
+        self.assertEqual(self.profile.timeout(TEST_URL),
+                         cm.SOFT_VISIT_TIMEOUT)
+        self.profile.add(TEST_URL, 20)
+        self.assertEqual(self.profile.timeout(TEST_URL),
+                         cm.SOFT_VISIT_TIMEOUT)
+        self.profile.add(TEST_URL, 20)
+        self.assertEqual(self.profile.timeout(TEST_URL),
+                         20 * cm.ADAPTIVE_TIMEOUT_FACTOR +
+                         cm.ADAPTIVE_TIMEOUT_MARGIN)
+
+    def test_default_min_samples(self):
+        profile = LoadTimeProfile(join(self.tempdir, 'load_times.1.jsonl'))
+        for _ in xrange(cm.ADAPTIVE_TIMEOUT_MIN_SAMPLES - 1):
+            profile.add('http://fast.example', 1)
+        self.assertEqual(profile.timeout('http://fast.example'),
+                         cm.SOFT_VISIT_TIMEOUT)
+        profile.add('http://fast.example', 1)
+        self.assertEqual(profile.timeout('http://fast.example'),
+                         cm.ADAPTIVE_TIMEOUT_MIN)
+        profile.close()
+
+    def test_bounds(self):
+        for _ in xrange(3):
+            self.profile.add(TEST_URL, 0.5)
+            self.profile.add('http://slow.example', 500)
+        self.assertEqual(self.profile.timeout(TEST_URL),
+                         cm.ADAPTIVE_TIMEOUT_MIN)
+        self.assertEqual(self.profile.timeout('http://slow.example'),
+                         cm.SOFT_VISIT_TIMEOUT)
+
+    def test_timeouts_back_off(self):
+        self.profile.add(TEST_URL, 10)
+        self.profile.add(TEST_URL, 10)
+        timeout = self.profile.timeout(TEST_URL)
+        self.profile.add(TEST_URL, timeout, timed_out=True)
+        self.assertGreater(self.profile.timeout(TEST_URL), timeout)
+
+    def test_profile_is_persistent(self):
+        self.profile.add(TEST_URL, 10)
+        self.profile.add(TEST_URL, 10, timed_out=True)
+        self.profile.close()
+        # e.g. the profile of another worker
+        other = LoadTimeProfile(join(self.tempdir, 'load_times.1.jsonl'))
+        self.assertEqual(other.load_times[TEST_URL],
+                         [10, 10 * cm.ADAPTIVE_TIMEOUT_BACKOFF])
+        other.close()
+
+
+class AdaptiveTimeoutCrawlTest(FakeCrawlTestCase):
+    def test_timeouts_follow_load_times(self):
+        path = join(self.tempdir, 'load_times.jsonl')
+        driver = FakeDriver(latency=0.01)
+        timeouts = []
+        set_page_load_timeout = driver.set_page_load_timeout
+
+        def record_timeout(timeout):
+            timeouts.append(timeout)
+            set_page_load_timeout(timeout)
+
+        driver.set_page_load_timeout = record_timeout
+        crawler = CrawlerBase(driver,
+                              FakeTorController(self.tempdir,
+                                                synthetic_consensus(10)),
+                              load_times=LoadTimeProfile(path))
+        config = {'visits': '2', 'batches': '3', 'pause_between_batches': '0',
+                  'pause_between_sites': '0', 'pause_between_visits': '0',
+                  'pause_in_site': '0'}
+        crawler.crawl(CrawlJob(config, [TEST_URL]))
+        min_samples = cm.ADAPTIVE_TIMEOUT_MIN_SAMPLES
+        self.assertEqual(timeouts[:min_samples],
+                         [cm.SOFT_VISIT_TIMEOUT] * min_samples)
+        self.assertEqual(timeouts[min_samples:],
+                         [cm.ADAPTIVE_TIMEOUT_MIN] * (6 - min_samples))
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 6)
+        self.assertFalse(any(record['timed_out'] for record in records))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import logging
+import tempfile
+import unittest
+from multiprocessing import Process
+from os.path import join
+from shutil import rmtree
+
+from tbcrawler import log
+from tbcrawler import timing
+
+
+class QueueHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = join(self.tempdir, 'crawl.log')
+        self.logger = logging.getLogger('test_log_%s' % id(self))
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        log.add_log_file_handler(self.logger, self.path)
+
+    def tearDown(self):
+        log.reset_logger(self.logger)
+        log.log_context.clear()
+        rmtree(self.tempdir)
+
+    def read_records(self):
+        log.flush_logger(self.logger)
+        return list(log.read_log(self.path))
+
+    def test_context_fields(self):
+        log.set_log_context(worker=2)
+        self.logger.info("before the visit")
+        with timing.recorder.record('visit', batch=0, site=3, instance=1):
+            with timing.phase('driver_get'):
+                self.logger.warning("loading %s", "http://example.com")
+        before, visit = self.read_records()
+        self.assertEqual(before['message'], "before the visit")
+        self.assertEqual(before['worker'], 2)
+        self.assertNotIn('site', before)
+        self.assertEqual(visit['message'], "loading http://example.com")
+        self.assertEqual(visit['level'], 'WARNING')
+        self.assertEqual((visit['batch'], visit['site'], visit['instance'],
+                          visit['phase']), (0, 3, 1, 'driver_get'))
+
+    def test_exception(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            self.logger.exception("failed")
+        record, = self.read_records()
+        self.assertIn("ValueError: boom", record['exception'])
+
+    def test_logging_after_flush(self):
+        self.logger.info("first")
+        log.flush_logger(self.logger)
+        self.logger.info("second")
+        self.assertEqual([r['message'] for r in self.read_records()],
+                         ["first", "second"])
+
+    def test_forked_processes_share_the_log(self):
+        self.logger.info("parent")
+
+        def child(worker):
+            log.set_log_context(worker=worker)
+            for i in xrange(100):
+                self.logger.info("child %s", i)
+            log.flush_logger(self.logger)
+
+        workers = [Process(target=child, args=(w,)) for w in (1, 2)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        records = self.read_records()
+        self.assertEqual(len(records), 201)
+        self.assertEqual(len(log.query_log(records, worker=2)), 100)
+
+    def test_query_log(self):
+        records = [{'level': 'INFO', 'site': 1}, {'level': 'ERROR', 'site': 1},
+                   {'level': 'ERROR', 'site': 2}]
+        self.assertEqual(log.query_log(records, 'WARNING', site=1),
+                         [records[1]])
+        self.assertEqual(len(log.query_log(records)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
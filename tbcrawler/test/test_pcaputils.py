@@ -0,0 +1,170 @@
+import os
+import struct
+import tempfile
+import unittest
+from os.path import isfile, join
+from shutil import rmtree
+
+from tbcrawler import pcaputils as pu
+from tbcrawler import utils as ut
+from tbcrawler.bench.synthetic import (LOCAL_IP, random_ips, tcp_frame,
+                                       write_synthetic_pcap)
+
+GUARD_IPS = random_ips(3, seed=1)
+OTHER_IPS = random_ips(5, seed=2)
+
+
+def count_records(pcap_path):
+    with open(pcap_path, 'rb') as f:
+        return sum(1 for _ in pu.PcapReader(f))
+
+
+def read_timestamps(pcap_path):
+    with open(pcap_path, 'rb') as f:
+        reader = pu.PcapReader(f)
+        return [reader.timestamp(header) for header, _ in reader]
+
+
+class PcapReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pcap_path = join(self.tempdir, "capture.pcap")
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_read_records(self):
+        write_synthetic_pcap(self.pcap_path, 100, GUARD_IPS, OTHER_IPS)
+        self.assertEqual(count_records(self.pcap_path), 100)
+
+    def test_truncated_last_record(self):
+        write_synthetic_pcap(self.pcap_path, 10, GUARD_IPS, OTHER_IPS)
+        with open(self.pcap_path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.pcap_path) - 5)
+        self.assertEqual(count_records(self.pcap_path), 9)
+
+    def test_not_a_pcap(self):
+        with open(self.pcap_path, 'wb') as f:
+            f.write(b'\x00' * 100)
+        with open(self.pcap_path, 'rb') as f:
+            self.assertRaises(pu.PcapFormatError, pu.PcapReader, f)
+
+    def test_ipv4_tcp_addrs(self):
+        write_synthetic_pcap(self.pcap_path, 1, GUARD_IPS, OTHER_IPS,
+                             guard_ratio=1)
+        with open(self.pcap_path, 'rb') as f:
+            reader = pu.PcapReader(f)
+            _, data = next(iter(reader))
+            addrs = reader.ipv4_tcp_addrs(data)
+        self.assertIn(pu.pack_ips([LOCAL_IP]).pop(), addrs)
+
+    def test_non_tcp_packet(self):
+        frame = tcp_frame(LOCAL_IP, GUARD_IPS[0], 0)
+        udp_frame = frame[:23] + b'\x11' + frame[24:]
+        write_synthetic_pcap(self.pcap_path, 0, GUARD_IPS, OTHER_IPS)
+        with open(self.pcap_path, 'rb') as f:
+            reader = pu.PcapReader(f)
+            self.assertIsNone(reader.ipv4_tcp_addrs(udp_frame))
+            self.assertIsNotNone(reader.ipv4_tcp_addrs(frame))
+
+    def test_timestamp(self):
+        write_synthetic_pcap(self.pcap_path, 1, GUARD_IPS, OTHER_IPS,
+                             start_ts=1400000000.0)
+        with open(self.pcap_path, 'rb') as f:
+            reader = pu.PcapReader(f)
+            header, _ = next(iter(reader))
+            self.assertAlmostEqual(reader.timestamp(header), 1400000000.0,
+                                   places=0)
+
+
+class FilterPcapTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pcap_path = join(self.tempdir, "capture.pcap")
+        self.n_guard = write_synthetic_pcap(self.pcap_path, 500, GUARD_IPS,
+                                            OTHER_IPS, seed=3)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_filter_pcap(self):
+        out_path = join(self.tempdir, "filtered.pcap")
+        kept, total = pu.filter_pcap(self.pcap_path, out_path, GUARD_IPS)
+        self.assertEqual(total, 500)
+        self.assertEqual(kept, self.n_guard)
+        self.assertEqual(count_records(out_path), self.n_guard)
+
+    def test_filter_pcap_keeps_global_header(self):
+        out_path = join(self.tempdir, "filtered.pcap")
+        pu.filter_pcap(self.pcap_path, out_path, [])
+        self.assertEqual(os.path.getsize(out_path), pu.GLOBAL_HEADER_LEN)
+        with open(out_path, 'rb') as f:
+            magic, = struct.unpack('<I', f.read(4))
+        self.assertEqual(magic, pu.PCAP_MAGIC_USEC)
+
+    def test_utils_filter_pcap_keeps_original(self):
+        size = os.path.getsize(self.pcap_path)
+        ut.filter_pcap(self.pcap_path, set(GUARD_IPS))
+        orig_pcap = self.pcap_path + ".original"
+        self.assertTrue(isfile(orig_pcap))
+        self.assertEqual(os.path.getsize(orig_pcap), size)
+        self.assertEqual(count_records(self.pcap_path), self.n_guard)
+
+
+class CaptureIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.capture_path = join(self.tempdir, "batch.pcap")
+        self.ring_files = [join(self.tempdir, "batch_%05d_2016.pcap" % i)
+                           for i in (1, 2)]
+        write_synthetic_pcap(self.ring_files[0], 300, GUARD_IPS, OTHER_IPS,
+                             start_ts=1000.0)
+        self.timestamps = read_timestamps(self.ring_files[0])
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_extract(self):
+        index = pu.CaptureIndex(self.capture_path)
+        start, end = self.timestamps[100], self.timestamps[199]
+        out_path = join(self.tempdir, "visit.pcap")
+        self.assertEqual(index.extract(start, end, out_path), 100)
+        self.assertEqual(read_timestamps(out_path), self.timestamps[100:200])
+
+    def test_extract_across_files(self):
+        write_synthetic_pcap(self.ring_files[1], 300, GUARD_IPS, OTHER_IPS,
+                             start_ts=self.timestamps[-1] + 1, seed=1)
+        timestamps = self.timestamps + read_timestamps(self.ring_files[1])
+        index = pu.CaptureIndex(self.capture_path)
+        out_path = join(self.tempdir, "visit.pcap")
+        start, end = timestamps[250], timestamps[349]
+        self.assertEqual(index.extract(start, end, out_path), 100)
+        self.assertEqual(read_timestamps(out_path), timestamps[250:350])
+
+    def test_incremental_update(self):
+        index = pu.CaptureIndex(self.capture_path)
+        index.update()
+        self.assertEqual(len(index.timestamps), 300)
+        write_synthetic_pcap(self.ring_files[1], 50, GUARD_IPS, OTHER_IPS,
+                             start_ts=self.timestamps[-1] + 1)
+        index.update()
+        self.assertEqual(len(index.timestamps), 350)
+        self.assertEqual(index.scanned[0],
+                         os.path.getsize(self.ring_files[0]))
+
+    def test_partial_record_is_not_indexed(self):
+        with open(self.ring_files[0], 'rb+') as f:
+            f.truncate(os.path.getsize(self.ring_files[0]) - 5)
+        index = pu.CaptureIndex(self.capture_path)
+        index.update()
+        self.assertEqual(len(index.timestamps), 299)
+
+    def test_remove_files(self):
+        index = pu.CaptureIndex(self.capture_path)
+        index.update()
+        index.remove_files()
+        self.assertFalse(isfile(self.ring_files[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
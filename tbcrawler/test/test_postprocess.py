@@ -0,0 +1,81 @@
+import gzip
+import tempfile
+import unittest
+from os.path import isfile, join
+from shutil import rmtree
+
+from tbcrawler import postprocess as pp
+from tbcrawler.bench.synthetic import random_ips, write_synthetic_pcap
+from tbcrawler.test.test_pcaputils import count_records
+from tbcrawler.traces import trace_paths
+
+GUARD_IPS = random_ips(3, seed=1)
+OTHER_IPS = random_ips(5, seed=2)
+
+
+class ProcessVisitTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pcap_path = join(self.tempdir, "capture.pcap")
+        self.n_guard = write_synthetic_pcap(self.pcap_path, 200, GUARD_IPS,
+                                            OTHER_IPS)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_process_visit(self):
+        result = pp.process_visit(self.pcap_path, GUARD_IPS, compress=False)
+        self.assertEqual(result, (self.pcap_path, None))
+        self.assertEqual(count_records(self.pcap_path), self.n_guard)
+        self.assertTrue(isfile(self.pcap_path + ".original"))
+
+    def test_process_visit_compress(self):
+        pp.process_visit(self.pcap_path, GUARD_IPS, compress=True)
+        self.assertFalse(isfile(self.pcap_path + ".original"))
+        with gzip.open(self.pcap_path + ".original.gz") as f:
+            self.assertGreater(len(f.read()), 0)
+
+    def test_process_visit_without_post_filter(self):
+        pp.process_visit(self.pcap_path, GUARD_IPS, compress=True,
+                         post_filter=False)
+        self.assertEqual(count_records(self.pcap_path), 200)
+        self.assertFalse(isfile(self.pcap_path + ".original.gz"))
+        self.assertTrue(isfile(trace_paths(self.pcap_path)[0]))
+
+    def test_process_visit_compresses_by_default(self):
+        # as the background post-processing, see PostProcessorTest
+        pp.process_visit(self.pcap_path, GUARD_IPS)
+        self.assertTrue(isfile(self.pcap_path + ".original.gz"))
+
+    def test_process_visit_error(self):
+        missing = join(self.tempdir, "missing.pcap")
+        pcap_file, error = pp.process_visit(missing, GUARD_IPS)
+        self.assertEqual(pcap_file, missing)
+        self.assertTrue(error)
+
+
+class PostProcessorTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_submit_and_close(self):
+        post_processor = pp.PostProcessor(2, queue_size=1)
+        pcaps = {}
+        done = []
+        for i in range(4):
+            pcap_path = join(self.tempdir, "%s.pcap" % i)
+            pcaps[pcap_path] = write_synthetic_pcap(pcap_path, 100, GUARD_IPS,
+                                                    OTHER_IPS, seed=i)
+            post_processor.submit(pcap_path, GUARD_IPS, on_done=done.append)
+        post_processor.close()
+        self.assertEqual(sorted(done), sorted(pcaps))
+        for pcap_path, n_guard in pcaps.items():
+            self.assertEqual(count_records(pcap_path), n_guard)
+            self.assertTrue(isfile(pcap_path + ".original.gz"))
+
+
+if __name__ == "__main__":
+    unittest.main()
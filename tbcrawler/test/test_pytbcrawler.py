@@ -0,0 +1,108 @@
+import json
+import tempfile
+import unittest
+from os.path import join
+from shutil import rmtree
+
+from selenium.common.exceptions import WebDriverException
+
+from tbcrawler import pytbcrawler
+
+
+class FakeTorBrowserDriver(object):
+    launched = []
+    fail = False  # e.g. Tor is gone
+
+    def __init__(self, *args, **kwargs):
+        if FakeTorBrowserDriver.fail:
+            raise WebDriverException("Cannot connect to Tor")
+        self.quit_called = False
+        self.urls = []
+        FakeTorBrowserDriver.launched.append(self)
+
+    def get(self, url):
+        self.urls.append(url)
+
+    def quit(self):
+        self.quit_called = True
+
+
+class TorBrowserWrapperTest(unittest.TestCase):
+    def setUp(self):
+        self.tbdriver = pytbcrawler.TorBrowserDriver
+        pytbcrawler.TorBrowserDriver = FakeTorBrowserDriver
+        FakeTorBrowserDriver.launched = []
+
+    def tearDown(self):
+        pytbcrawler.TorBrowserDriver = self.tbdriver
+        FakeTorBrowserDriver.fail = False
+
+    def visit(self, wrapper, url):
+        with wrapper.launch() as driver:
+            wrapper.get(url)
+            # as the crawler does once the capture has stopped
+            wrapper.start_prelaunch()
+        return driver
+
+    def test_launch(self):
+        wrapper = pytbcrawler.TorBrowserWrapper()
+        driver = self.visit(wrapper, "http://example.com")
+        self.assertEqual(driver.urls, ["http://example.com"])
+        self.assertTrue(driver.quit_called)
+        self.assertEqual(len(FakeTorBrowserDriver.launched), 1)
+
+    def test_prelaunch(self):
+        wrapper = pytbcrawler.TorBrowserWrapper(prelaunch=True)
+        first = self.visit(wrapper, "http://example.com")
+        # the next browser was started during the first visit
+        wrapper.prelaunch_thread.join()
+        self.assertEqual(len(FakeTorBrowserDriver.launched), 2)
+        second = self.visit(wrapper, "http://example.org")
+        self.assertIsNot(first, second)
+        self.assertIs(second, FakeTorBrowserDriver.launched[1])
+        self.assertEqual(second.urls, ["http://example.org"])
+        self.assertTrue(first.quit_called and second.quit_called)
+        wrapper.quit_prelaunched()
+
+    def test_no_prelaunch_during_page_load(self):
+        wrapper = pytbcrawler.TorBrowserWrapper(prelaunch=True)
+        with wrapper.launch():
+            wrapper.get("http://example.com")
+            self.assertIsNone(wrapper.prelaunch_thread)
+        self.assertEqual(len(FakeTorBrowserDriver.launched), 1)
+
+    def test_quit_prelaunched(self):
+        wrapper = pytbcrawler.TorBrowserWrapper(prelaunch=True)
+        self.visit(wrapper, "http://example.com")
+        wrapper.quit_prelaunched()
+        self.assertTrue(all(driver.quit_called
+                            for driver in FakeTorBrowserDriver.launched))
+
+    def test_quit_failed_prelaunch(self):
+        wrapper = pytbcrawler.TorBrowserWrapper(prelaunch=True)
+        with wrapper.launch():
+            FakeTorBrowserDriver.fail = True
+            wrapper.start_prelaunch()
+        # no browser is launched just to be quit
+        wrapper.quit_prelaunched()
+        self.assertEqual(len(FakeTorBrowserDriver.launched), 1)
+        self.assertIsNone(wrapper.prelaunch_thread)
+
+
+class SaveBootstrapsTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_resumed_runs_append(self):
+        path = join(self.tempdir, 'tor_bootstraps.json')
+        pytbcrawler.save_bootstraps([{'duration': 1}], path)
+        pytbcrawler.save_bootstraps([{'duration': 2}], path)
+        with open(path) as f:
+            self.assertEqual([b['duration'] for b in json.load(f)], [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
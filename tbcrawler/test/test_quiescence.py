@@ -0,0 +1,104 @@
+import json
+import unittest
+from collections import namedtuple
+from os.path import join
+from threading import Thread
+from time import sleep
+
+from tbcrawler import quiescence
+from tbcrawler import timing
+from tbcrawler.bench.fakes import (FakeCrawlTestCase, FakeDriver,
+                                   FakeTorController, synthetic_consensus)
+from tbcrawler.crawler import CrawlerBase, CrawlJob
+from tbcrawler.journal import CrawlJournal
+
+BwEvent = namedtuple('BwEvent', 'read written')
+
+
+class TrafficMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.monitor = quiescence.TrafficMonitor(min_bytes=1000,
+                                                 poll_interval=0.01)
+
+    def feed(self, duration, read=5000, interval=0.02):
+        """Send BW events with traffic for `duration` seconds."""
+        def send():
+            for _ in xrange(int(duration / interval)):
+                self.monitor.bw_handler(BwEvent(read, 0))
+                sleep(interval)
+        thread = Thread(target=send)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_quiescent(self):
+        start = timing.monotonic()
+        self.feed(0.3).join()
+        reason = self.monitor.wait(start, 0.1, 0, 5)
+        self.assertEqual(reason, quiescence.END_QUIESCENT)
+        self.assertLess(timing.monotonic() - start, 1)
+
+    def test_waits_for_the_traffic_to_stop(self):
+        start = timing.monotonic()
+        feeder = self.feed(0.4)
+        self.assertEqual(self.monitor.wait(start, 0.1, 0, 5),
+                         quiescence.END_QUIESCENT)
+        self.assertGreaterEqual(timing.monotonic() - start, 0.4)
+        feeder.join()
+
+    def test_keepalives_are_idle(self):
+        start = timing.monotonic()
+        feeder = self.feed(0.5, read=543)
+        self.assertEqual(self.monitor.wait(start, 0.1, 0, 5),
+                         quiescence.END_QUIESCENT)
+        self.assertLess(timing.monotonic() - start, 0.4)
+        feeder.join()
+
+    def test_min_duration(self):
+        start = timing.monotonic()
+        self.assertEqual(self.monitor.wait(start, 0, 0.2, 5),
+                         quiescence.END_QUIESCENT)
+        self.assertGreaterEqual(timing.monotonic() - start, 0.2)
+
+    def test_max_duration(self):
+        start = timing.monotonic()
+        feeder = self.feed(1)
+        self.assertEqual(self.monitor.wait(start, 0.1, 0, 0.3),
+                         quiescence.END_MAX_DURATION)
+        self.assertLess(timing.monotonic() - start, 0.6)
+        feeder.join()
+
+
+class QuiescenceCrawlTest(FakeCrawlTestCase):
+    def test_visits_end_on_quiescence(self):
+        monitor = quiescence.TrafficMonitor(poll_interval=0.01)
+        controller = FakeTorController(self.tempdir, synthetic_consensus(10),
+                                       traffic_monitor=monitor)
+        journal_path = join(self.tempdir, 'journal.jsonl')
+        crawler = CrawlerBase(FakeDriver(), controller,
+                              journal=CrawlJournal(journal_path),
+                              quiescence=monitor)
+        config = {'visits': '1', 'batches': '1', 'pause_between_batches': '0',
+                  'pause_between_sites': '0', 'pause_between_visits': '0',
+                  'pause_in_site': '10', 'quiescence_idle': '0.05',
+                  'quiescence_min': '0.1', 'quiescence_max': '5'}
+        urls = ['http://site%s.example' % i for i in xrange(2)]
+        crawler.crawl(CrawlJob(config, urls))
+        with open(journal_path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record['end'] for record in records],
+                         [quiescence.END_QUIESCENT] * 2)
+
+    def test_bw_listener(self):
+        monitor = quiescence.TrafficMonitor()
+        controller = FakeTorController(self.tempdir, synthetic_consensus(10),
+                                       traffic_monitor=monitor)
+        with controller.launch():
+            listeners = controller.controller.listeners
+            self.assertIn(monitor.bw_handler, listeners)
+            controller.remove_event_listeners()
+            self.assertEqual(listeners, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+import unittest
+from os.path import join
+from shutil import rmtree
+
+from tbcrawler import sanity
+from tbcrawler import utils as ut
+from tbcrawler.archive import ArchiveWriter
+from tbcrawler.bench.synthetic import random_ips, write_synthetic_pcap
+from tbcrawler.journal import CrawlJournal
+
+GUARD_IPS = random_ips(3, seed=1)
+OTHER_IPS = random_ips(5, seed=2)
+
+
+class CheckCrawlTest(unittest.TestCase):
+    def setUp(self):
+        self.crawl_dir = tempfile.mkdtemp()
+        os.mkdir(join(self.crawl_dir, 'logs'))
+        self.journal = CrawlJournal(join(self.crawl_dir, 'logs',
+                                         'journal.jsonl'))
+
+    def tearDown(self):
+        rmtree(self.crawl_dir)
+
+    def make_visit(self, visit, n_packets=200, outcome='ok',
+                   screenshot=True, guard_ratio=0.8):
+        visit_dir = join(self.crawl_dir, visit)
+        os.mkdir(visit_dir)
+        pcap_path = join(visit_dir, 'capture.pcap')
+        write_synthetic_pcap(pcap_path, n_packets, GUARD_IPS, OTHER_IPS,
+                             guard_ratio=guard_ratio)
+        ut.filter_pcap(pcap_path, GUARD_IPS)
+        if screenshot:
+            open(join(visit_dir, 'screenshot.png'), 'w').close()
+        batch, site, instance = map(int, visit.split('_'))
+        self.journal.record(batch, site, instance, 'http://%s' % site,
+                            outcome)
+        return visit_dir
+
+    def check(self):
+        self.journal.close()
+        report = sanity.check_crawl(self.crawl_dir, processes=2)
+        return report, dict((s['visit'], s) for s in report['visits'])
+
+    def test_visit_stats(self):
+        self.make_visit('0_0_0')
+        report, visits = self.check()
+        stats = visits['0_0_0']
+        self.assertEqual(stats['flags'], [])
+        self.assertGreater(stats['packets'], 0)
+        self.assertGreater(stats['bytes_out'], 0)
+        self.assertGreater(stats['bytes_in'], 0)
+        self.assertGreater(stats['duration'], 0)
+        self.assertTrue(0.5 < stats['guard_share'] < 1)
+        self.assertFalse(stats['timeout'])
+        with open(join(self.crawl_dir, 'logs', 'sanity.json')) as f:
+            self.assertEqual(json.load(f)['summary'], report['summary'])
+
+    def test_flags(self):
+        self.make_visit('0_0_0', outcome='timeout')
+        self.make_visit('0_1_0', screenshot=False)
+        self.make_visit('0_2_0', guard_ratio=0)
+        self.make_visit('0_3_0', n_packets=0)
+        _, visits = self.check()
+        self.assertTrue(visits['0_0_0']['timeout'])
+        self.assertEqual(visits['0_0_0']['flags'], ['timeout'])
+        self.assertEqual(visits['0_1_0']['flags'], ['no_screenshot'])
+        self.assertEqual(visits['0_2_0']['flags'], ['no_guard_traffic'])
+        self.assertEqual(visits['0_3_0']['flags'], ['empty_capture'])
+
+    def test_archived_visits(self):
+        with ArchiveWriter(join(self.crawl_dir, 'crawl.tbca')) as writer:
+            writer.add_visit(self.make_visit('0_0_0'), remove=True)
+        self.make_visit('0_1_0')
+        report, visits = self.check()
+        self.assertEqual(report['summary']['visits'], 2)
+        self.assertEqual(visits['0_0_0']['flags'], [])
+        self.assertGreater(visits['0_0_0']['packets'], 0)
+
+
+class FlagVisitsTest(unittest.TestCase):
+    def stats(self, site, packets):
+        return {'site': site, 'packets': packets, 'captured': packets,
+                'error': None,
+                'outcome': 'ok', 'guard_share': 1.0, 'screenshot': True}
+
+    def test_outliers(self):
+        visits = [self.stats(0, n) for n in (1000, 1100, 900, 1050, 20)]
+        visits.append(self.stats(1, 20))
+        sanity.flag_visits(visits)
+        self.assertEqual([v['flags'] for v in visits],
+                         [[], [], [], [], ['outlier'], []])
+
+
+if __name__ == "__main__":
+    unittest.main()
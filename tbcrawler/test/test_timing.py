@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+import unittest
+from os.path import join
+from shutil import rmtree
+from threading import Thread
+
+from tbcrawler import timing
+
+
+class TimingRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.crawl_dir = tempfile.mkdtemp()
+        os.mkdir(join(self.crawl_dir, 'logs'))
+        self.path = join(self.crawl_dir, 'logs', 'timings.jsonl')
+        self.recorder = timing.TimingRecorder()
+        self.recorder.open(self.path)
+
+    def tearDown(self):
+        self.recorder.close()
+        rmtree(self.crawl_dir)
+
+    def read_records(self):
+        self.recorder.close()
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_monotonic(self):
+        times = [timing.monotonic() for _ in xrange(1000)]
+        self.assertEqual(times, sorted(times))
+
+    def test_nested_records(self):
+        with self.recorder.record('batch', batch=0):
+            with self.recorder.record('visit', batch=0, site=1,
+                                      instance=2) as rec:
+                with self.recorder.phase('driver_get'):
+                    pass
+                self.recorder.add('driver_get', 1.0)
+                rec['outcome'] = 'ok'
+            self.recorder.add('pause_between_batches', 2.0)
+        visit, batch = self.read_records()
+        self.assertEqual(visit['type'], 'visit')
+        self.assertEqual((visit['site'], visit['instance']), (1, 2))
+        self.assertEqual(visit['outcome'], 'ok')
+        self.assertGreaterEqual(visit['phases']['driver_get'], 1.0)
+        self.assertEqual(batch['phases'], {'pause_between_batches': 2.0})
+        self.assertGreaterEqual(batch['total'], visit['total'])
+
+    def test_record_closed_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.recorder.record('visit'):
+                raise ValueError
+        self.assertEqual(self.recorder.records, [])
+        self.assertEqual(len(self.read_records()), 1)
+
+    def test_other_threads_are_ignored(self):
+        def background():
+            with self.recorder.record('visit'):
+                self.recorder.add('tor_launch', 5.0)
+
+        with self.recorder.record('batch'):
+            thread = Thread(target=background)
+            thread.start()
+            thread.join()
+        records = self.read_records()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['phases'], {})
+
+    def test_phase_without_record(self):
+        with self.recorder.phase('browser_launch'):
+            pass
+        self.assertEqual(self.read_records(), [])
+
+
+class SummaryTest(unittest.TestCase):
+    def test_summarize(self):
+        records = [{'type': 'visit', 'total': 10.0,
+                    'phases': {'driver_get': float(i), 'screenshot': 1.0}}
+                   for i in xrange(1, 11)]
+        summary = timing.summarize(records, percentiles=(50, 90))
+        driver_get = summary['visit']['driver_get']
+        self.assertEqual(driver_get['count'], 10)
+        self.assertAlmostEqual(driver_get['mean'], 5.5)
+        self.assertAlmostEqual(driver_get['p50'], 5.5)
+        self.assertAlmostEqual(driver_get['p90'], 9.1)
+        self.assertAlmostEqual(driver_get['share'], 0.55)
+        self.assertAlmostEqual(summary['visit']['screenshot']['share'], 0.1)
+        text = timing.format_summary(summary, percentiles=(50, 90))
+        lines = text.splitlines()
+        self.assertTrue(lines[0].startswith('visit'))
+        # most expensive phase first, the total last
+        self.assertTrue(lines[1].strip().startswith('driver_get'))
+        self.assertTrue(lines[-1].strip().startswith('total'))
+
+    def test_load_records(self):
+        crawl_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(join(crawl_dir, 'logs'))
+            for worker in xrange(2):
+                recorder = timing.TimingRecorder()
+                recorder.open(join(crawl_dir, 'logs',
+                                   'timings.%s.jsonl' % worker))
+                with recorder.record('visit', site=worker):
+                    pass
+                recorder.close()
+            with open(join(crawl_dir, 'logs', 'timings.1.jsonl'), 'a') as f:
+                f.write('{"type": "vis')  # interrupted write
+            records = timing.load_records(crawl_dir)
+            self.assertEqual([r['site'] for r in records], [0, 1])
+        finally:
+            rmtree(crawl_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
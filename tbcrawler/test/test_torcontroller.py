@@ -1,9 +1,15 @@
+import os
+import tempfile
 import time
 import unittest
+from collections import namedtuple
+from shutil import rmtree
 
 from tbselenium.tbdriver import TorBrowserDriver
 
 from tbcrawler import common as cm
+from tbcrawler.bench import fakes
+from tbcrawler.crawler import CrawlerBase, CrawlJob
 from tbcrawler.torcontroller import TorController
 
 
@@ -51,5 +57,198 @@ class TorControllerTest(unittest.TestCase):
         cls.tor_controller.quit()
 
 
+NewConsensusEvent = namedtuple('NewConsensusEvent', ['desc'])
+
+CONSENSUS = [fakes.RouterStatus('A' * 40, '1.1.1.1', ['Guard', 'Running']),
+             fakes.RouterStatus('B' * 40, '2.2.2.2', ['Running']),
+             fakes.RouterStatus('C' * 40, '3.3.3.3', ['Guard', 'Exit'])]
+# the IP the fake controller gives relays missing from the consensus
+UNKNOWN_RELAY_IP = '10.255.255.1'
+
+
+def circuit(circ_id, path, status='BUILT'):
+    return fakes.CircuitEvent('CIRC', circ_id, status, path, 'GENERAL', None)
+
+
+class GuardIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        tor_binary_path = os.path.join(self.tempdir, 'tor')
+        open(tor_binary_path, 'w').close()
+        self.tor_controller = TorController(tor_binary_path=tor_binary_path,
+                                            tor_data_path=self.tempdir)
+        circuits = [circuit('1', [('A' * 40, 'a'), ('B' * 40, 'b')]),
+                    circuit('2', []),
+                    circuit('3', [('D' * 40, 'd'), ('B' * 40, 'b')])]
+        self.tor_controller.controller = fakes.FakeController(CONSENSUS,
+                                                              circuits)
+        self.tor_controller.build_guard_index()
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_get_all_guard_ips(self):
+        self.assertEqual(self.tor_controller.get_all_guard_ips(),
+                         set(['1.1.1.1', '3.3.3.3']))
+
+    def test_get_all_guard_ips_uses_index(self):
+        fake_controller = self.tor_controller.controller
+        fake_controller.calls = []
+        for _ in range(10):
+            self.tor_controller.get_all_guard_ips()
+        self.assertEqual(fake_controller.calls, [])
+
+    def test_new_consensus_refreshes_index(self):
+        new_consensus = [fakes.RouterStatus('E' * 40, '5.5.5.5', ['Guard'])]
+        self.tor_controller.new_consensus_handler(
+            NewConsensusEvent(new_consensus))
+        self.assertEqual(self.tor_controller.get_all_guard_ips(),
+                         set(['5.5.5.5']))
+
+    def test_get_guard_ips(self):
+        fake_controller = self.tor_controller.controller
+        fake_controller.calls = []
+        # D is not in the consensus index and needs a lookup
+        self.assertEqual(self.tor_controller.get_guard_ips(),
+                         ['1.1.1.1', UNKNOWN_RELAY_IP])
+        self.assertEqual(fake_controller.calls,
+                         ['get_circuits', 'get_network_status'])
+
+    def test_circuit_events(self):
+        guards = []
+        self.tor_controller.guard_listeners.append(guards.append)
+        for status, guard in (('LAUNCHED', 'A'), ('BUILT', 'A'),
+                              ('BUILT', 'D'), ('CLOSED', 'C')):
+            self.tor_controller.circuit_handler(
+                circuit('1', [(guard * 40, guard.lower())], status))
+        self.tor_controller.circuit_handler(circuit('2', []))
+        self.assertEqual(guards, ['1.1.1.1', None])
+
+
+class StandbyTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.tor_controller = fakes.FakeTorController(
+            self.tempdir, CONSENSUS,
+            torrc_dict={'controlport': '9051', 'socksport': '9050'},
+            standby=True)
+
+    def tearDown(self):
+        fakes.FakeTorController.fail = False
+        rmtree(self.tempdir)
+
+    def test_standby_ports_alternate(self):
+        offset = cm.TOR_STANDBY_PORT_OFFSET
+        ports = []
+        for prepare_next in (True, True, False):
+            with self.tor_controller.launch(prepare_next=prepare_next):
+                ports.append(self.tor_controller.socks_port)
+        self.assertEqual(ports, [9050, 9050 + offset, 9050])
+        self.assertIsNone(self.tor_controller.standby_controller)
+
+    def test_adopt_standby(self):
+        with self.tor_controller.launch(prepare_next=True):
+            standby = self.tor_controller.standby_controller
+        with self.tor_controller.launch():
+            self.assertIs(self.tor_controller.controller, standby.controller)
+            self.assertEqual(self.tor_controller.tor_process,
+                             9050 + cm.TOR_STANDBY_PORT_OFFSET)
+            # NEWCONSENSUS events now update the adopting controller
+            self.assertIn(self.tor_controller.new_consensus_handler,
+                          standby.controller.listeners)
+        self.assertEqual([b['standby'] for b in self.tor_controller.bootstraps],
+                         [False, True])
+
+    def test_dead_standby(self):
+        with self.tor_controller.launch(prepare_next=True):
+            standby = self.tor_controller.standby_controller
+        self.tor_controller.standby_thread.join()
+        standby.tor_process = None  # died with its controller attached
+        with self.tor_controller.launch():
+            self.assertIsNot(self.tor_controller.controller,
+                             standby.controller)
+            self.assertEqual(self.tor_controller.tor_process, 9050)
+        self.assertIsNone(standby.controller)
+        self.assertEqual([b['standby'] for b in self.tor_controller.bootstraps],
+                         [False, True, False])
+
+    def test_failed_standby(self):
+        with self.tor_controller.launch():
+            pass
+        # start the standby once the failure is set, not racing with it
+        fakes.FakeTorController.fail = True
+        self.tor_controller.start_standby()
+        self.assertRaises(OSError, self.tor_controller.launch().__enter__)
+        errors = [b['error'] for b in self.tor_controller.bootstraps]
+        self.assertEqual(errors[0], None)
+        self.assertEqual(errors[1:], ["Process terminated"] * 2)
+
+    def test_no_standby(self):
+        self.tor_controller.standby = False
+        with self.tor_controller.launch(prepare_next=True):
+            self.assertIsNone(self.tor_controller.standby_thread)
+
+
+class ResetTest(fakes.FakeCrawlTestCase):
+    def setUp(self):
+        super(ResetTest, self).setUp()
+        consensus = fakes.synthetic_consensus(20)
+        self.circuits = fakes.synthetic_circuits(consensus, 3)
+        self.tor_controller = fakes.FakeTorController(
+            self.tempdir, consensus, self.circuits)
+
+    def reset(self, strategy):
+        self.tor_controller.reset_strategy = strategy
+        with self.tor_controller.launch():
+            fake_controller = self.tor_controller.controller
+            start = time.time()
+            self.tor_controller.reset()
+            # the reset waits for the new circuit, not for the timeout
+            self.assertLess(time.time() - start, 1)
+        return fake_controller
+
+    def test_newnym(self):
+        fake_controller = self.reset(cm.RESET_NEWNYM)
+        self.assertEqual(fake_controller.signals, ['NEWNYM'])
+        self.assertEqual(fake_controller.closed_circuits, [])
+        self.assertTrue(self.tor_controller.circuit_built.is_set())
+
+    def test_close_circuits(self):
+        fake_controller = self.reset(cm.RESET_CIRCUITS)
+        self.assertEqual(fake_controller.closed_circuits, ['1', '2', '3'])
+        self.assertEqual(fake_controller.signals, [])
+        self.assertTrue(self.tor_controller.circuit_built.is_set())
+
+    def test_no_new_circuit(self):
+        reset_timeout = cm.TOR_RESET_CIRCUIT_TIMEOUT
+        cm.TOR_RESET_CIRCUIT_TIMEOUT = 0.1
+        self.tor_controller.reset_strategy = cm.RESET_NEWNYM
+        try:
+            with self.tor_controller.launch():
+                self.tor_controller.controller.build_circuit = lambda: None
+                start = time.time()
+                self.tor_controller.reset()
+                self.assertLess(time.time() - start, 1)
+        finally:
+            cm.TOR_RESET_CIRCUIT_TIMEOUT = reset_timeout
+        self.assertFalse(self.tor_controller.circuit_built.is_set())
+
+    def test_restart_does_nothing(self):
+        fake_controller = self.reset(cm.RESET_RESTART)
+        self.assertEqual(fake_controller.signals, [])
+        self.assertFalse(self.tor_controller.circuit_built.is_set())
+
+    def test_one_tor_process_per_crawl(self):
+        self.tor_controller.reset_strategy = cm.RESET_NEWNYM
+        crawler = CrawlerBase(fakes.FakeDriver(), self.tor_controller)
+        config = {'visits': '2', 'batches': '3',
+                  'pause_between_batches': '0',
+                  'pause_between_sites': '0',
+                  'pause_between_visits': '0', 'pause_in_site': '0'}
+        crawler.crawl(CrawlJob(config, ['http://example.com']))
+        self.assertEqual(len(self.tor_controller.bootstraps), 1)
+        self.assertEqual(len(crawler.driver.visited), 6)
+
+
 if __name__ == "__main__":
     unittest.main()
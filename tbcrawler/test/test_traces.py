@@ -0,0 +1,173 @@
+import tempfile
+import unittest
+from os.path import isfile, join
+from shutil import rmtree
+
+from tbcrawler import common as cm
+from tbcrawler import traces as tr
+from tbcrawler import utils as ut
+from tbcrawler.bench.bench_tshark import loop_filter_tshark
+from tbcrawler.bench.synthetic import (LOCAL_IP, random_ips, tcp_frame,
+                                       tshark_line, write_frames,
+                                       write_synthetic_pcap,
+                                       write_synthetic_tshark)
+
+GUARD_IPS = random_ips(3, seed=1)
+OTHER_IPS = random_ips(5, seed=2)
+GUARD = GUARD_IPS[0]
+
+
+def outgoing(payload_len, seq):
+    return tcp_frame(LOCAL_IP, GUARD, payload_len, seq=seq)
+
+
+def incoming(payload_len, seq):
+    return tcp_frame(GUARD, LOCAL_IP, payload_len, sport=443, dport=40000,
+                     seq=seq)
+
+
+class ExtractTraceTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pcap_path = join(self.tempdir, "capture.pcap")
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def extract(self, frames):
+        write_frames(self.pcap_path, frames)
+        return tr.extract_trace(self.pcap_path, GUARD_IPS)
+
+    def test_direction_and_cells(self):
+        trace = self.extract([outgoing(543, 0), incoming(1448, 0)])
+        self.assertEqual(list(trace.length), [543, -1448])
+        self.assertEqual(list(trace.cells), [2, 3])
+        self.assertAlmostEqual(trace.time[1] - trace.time[0], 0.001,
+                               places=5)
+
+    def test_acks_are_removed(self):
+        trace = self.extract([outgoing(0, 0), incoming(543, 0),
+                              outgoing(0, 1)])
+        self.assertEqual(list(trace.length), [-543])
+
+    def test_retransmissions_are_removed(self):
+        trace = self.extract([incoming(543, 0), incoming(543, 543),
+                              incoming(543, 0), outgoing(543, 0),
+                              incoming(543, 1086)])
+        self.assertEqual(list(trace.length), [-543, -543, 543, -543])
+
+    def test_sequence_wraparound(self):
+        seq = 2 ** 32 - 100
+        trace = self.extract([incoming(543, seq),
+                              incoming(543, (seq + 543) % 2 ** 32)])
+        self.assertEqual(len(trace.length), 2)
+
+    def test_non_guard_packets_are_removed(self):
+        n_guard = write_synthetic_pcap(self.pcap_path, 300, GUARD_IPS,
+                                       OTHER_IPS, guard_ratio=0)
+        self.assertEqual(n_guard, 0)
+        trace = tr.extract_trace(self.pcap_path, GUARD_IPS)
+        self.assertEqual(len(trace.time), 0)
+
+
+class TraceFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pcap_path = join(self.tempdir, "capture.pcap")
+        write_synthetic_pcap(self.pcap_path, 500, GUARD_IPS, OTHER_IPS)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_write_and_load(self):
+        trace = tr.extract_trace(self.pcap_path, GUARD_IPS)
+        trace_path = join(self.tempdir, "capture.trace")
+        tr.write_trace(trace, trace_path)
+        loaded = tr.load_trace(trace_path)
+        for column, loaded_column in zip(trace, loaded):
+            self.assertEqual(list(column), list(loaded_column))
+        self.assertEqual(loaded.length.dtype.str, '<i4')
+
+    def test_truncated_trace(self):
+        trace_path = join(self.tempdir, "capture.trace")
+        tr.write_trace(([1.0, 2.0], [543, -543], [2, 2]), trace_path)
+        with open(trace_path, 'rb+') as f:
+            f.truncate(tr.TRACE_HEADER.size + 20)
+        self.assertRaises(tr.TraceFormatError, tr.load_trace, trace_path)
+
+    def test_not_a_trace(self):
+        self.assertRaises(tr.TraceFormatError, tr.load_trace, self.pcap_path)
+
+    def test_pcap_to_trace(self):
+        n_packets = tr.pcap_to_trace(self.pcap_path, GUARD_IPS)
+        trace_path, tao_path = tr.trace_paths(self.pcap_path)
+        self.assertEqual(trace_path, join(self.tempdir,
+                                          "capture" + cm.TRACE_EXT))
+        self.assertTrue(isfile(trace_path))
+        trace = tr.load_trace(trace_path)
+        with open(tao_path) as f:
+            lines = [line.split('\t') for line in f]
+        self.assertEqual(len(lines), n_packets)
+        self.assertEqual([int(length) for _, length in lines],
+                         list(trace.length))
+        self.assertAlmostEqual(float(lines[0][0]), trace.time[0], places=5)
+
+
+class TsharkToTraceTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.tshark_path = join(self.tempdir, "capture.tshark")
+        self.out_path = join(self.tempdir, "filtered.tshark")
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_filters(self):
+        with open(self.tshark_path, 'w') as f:
+            f.write(tshark_line(1.0, LOCAL_IP, GUARD, 543))
+            f.write(tshark_line(2.0, GUARD, LOCAL_IP, 1448))
+            f.write(tshark_line(3.0, GUARD, LOCAL_IP, 0))  # ACK
+            f.write(tshark_line(4.0, GUARD, LOCAL_IP, 40, proto='17'))
+            f.write(tshark_line(5.0, LOCAL_IP, OTHER_IPS[0], 543))
+            f.write(tshark_line(6.0, GUARD, LOCAL_IP, 543,
+                                info='[TCP Retransmission] 443 > 40000'))
+            f.write("7.0,%s,%s,malformed\n" % (GUARD, LOCAL_IP))
+        kept, total = tr.tshark_to_trace(self.tshark_path, self.out_path,
+                                         GUARD_IPS)
+        self.assertEqual((kept, total), (3, 7))
+        self.assertEqual([line.split(',')[0] for line in
+                          self.read(self.out_path).splitlines()],
+                         ['1.000000', '2.000000', '6.000000'])
+        trace_path, tao_path = tr.trace_paths(self.out_path)
+        self.assertEqual(self.read(tao_path),
+                         "1.000000\t543\n2.000000\t-1448\n")
+        trace = tr.load_trace(trace_path)
+        self.assertEqual(list(trace.time), [1.0, 2.0])
+        self.assertEqual(list(trace.cells), [2, 3])
+
+    def test_matches_former_loop(self):
+        write_synthetic_tshark(self.tshark_path, 3000, GUARD_IPS, OTHER_IPS,
+                               retransmit_ratio=0.1)
+        loop_path = join(self.tempdir, "loop.tshark")
+        loop_filter_tshark(self.tshark_path, loop_path, GUARD_IPS)
+        tr.tshark_to_trace(self.tshark_path, self.out_path, GUARD_IPS)
+        self.assertEqual(self.read(self.out_path), self.read(loop_path))
+        self.assertEqual(self.read(tr.trace_paths(self.out_path)[1]),
+                         self.read(join(self.tempdir, "loop.tao")))
+
+    def test_utils_filter_tshark_keeps_original(self):
+        n_guard = write_synthetic_tshark(self.tshark_path, 500, GUARD_IPS,
+                                         OTHER_IPS)
+        original = self.read(self.tshark_path)
+        kept, total = ut.filter_tshark(self.tshark_path, GUARD_IPS)
+        self.assertEqual((kept, total), (n_guard, 500))
+        self.assertEqual(self.read(self.tshark_path + ".original"), original)
+        self.assertTrue(isfile(join(self.tempdir, "capture.tao")))
+
+
+if __name__ == "__main__":
+    unittest.main()
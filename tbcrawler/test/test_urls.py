@@ -0,0 +1,83 @@
+import tempfile
+import unittest
+from os.path import join
+from shutil import rmtree
+
+from tbcrawler import urls
+
+
+class NormalizeUrlTest(unittest.TestCase):
+    def test_normalize(self):
+        for line, url in [
+                ("http://www.google.de\n", "http://www.google.de"),
+                ("  Example.COM/Path?q=A#top ", "http://example.com/Path?q=A"),
+                ("HTTPS://example.com:443/", "https://example.com/"),
+                ("http://example.com:8080", "http://example.com:8080"),
+                ("http://[2001:DB8::1]:80/", "http://[2001:db8::1]/"),
+                ("http://[2001:db8::1]/", "http://[2001:db8::1]/"),
+                ("17,wikipedia.org", "http://wikipedia.org")]:
+            self.assertEqual(urls.normalize_url(line), url)
+
+    def test_skipped_lines(self):
+        for line in ("", "   \n", "# comment"):
+            self.assertIsNone(urls.normalize_url(line))
+
+    def test_parse_shard(self):
+        self.assertEqual(urls.parse_shard("2/5"), (2, 5))
+        for shard in ("0/5", "6/5", "1", "a/b"):
+            self.assertRaises(ValueError, urls.parse_shard, shard)
+
+
+class LoadShardTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.url_file = join(self.tempdir, "urls.csv")
+        with open(self.url_file, 'w') as f:
+            f.write("# top sites\n")
+            for i in xrange(1000):
+                f.write("http://site%s.example\n" % i)
+                if i % 10 == 0:  # duplicates and blank lines
+                    f.write("SITE%s.example\n\n" % i)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def test_whole_list(self):
+        url_list = urls.load_shard(self.url_file)
+        self.assertEqual(len(url_list), 1000)
+        self.assertEqual(list(url_list), range(1000))
+        self.assertEqual(url_list[999], "http://site999.example")
+
+    def test_start_stop(self):
+        url_list = urls.load_shard(self.url_file, start=2, stop=5)
+        self.assertEqual(url_list.items(),
+                         [(0, "http://site0.example"),
+                          (1, "http://site1.example")])
+
+    def check_partition(self, method):
+        shards = [urls.load_shard(self.url_file, (i, 4), method)
+                  for i in xrange(1, 5)]
+        sites = sorted(site for shard in shards for site in shard)
+        self.assertEqual(sites, range(1000))
+        merged = {}
+        for shard in shards:
+            merged.update(shard)
+        self.assertEqual(merged, urls.load_shard(self.url_file))
+        # every node computes the same partition
+        self.assertEqual(shards[2],
+                         urls.load_shard(self.url_file, (3, 4), method))
+        return shards
+
+    def test_hash_shards(self):
+        shards = self.check_partition('hash')
+        for shard in shards:
+            self.assertTrue(200 < len(shard) < 300)
+
+    def test_range_shards(self):
+        shards = self.check_partition('range')
+        self.assertEqual([len(shard) for shard in shards], [250] * 4)
+        self.assertEqual(list(shards[1])[:2], [250, 251])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,14 @@
+import os
 import subprocess
 import tempfile
 import unittest
 from ConfigParser import RawConfigParser
-from os.path import isdir
+from os.path import isdir, join
 from shutil import rmtree
 from time import sleep
 
 from tbcrawler import utils as ut
-from tbcrawler.common import CONFIG_FILE
+from tbcrawler.common import CONFIG_FILE, TMP_DIR_PREFIX
 
 
 class TimeoutTest(unittest.TestCase):
@@ -58,6 +59,52 @@ class DirectoryUtilsTests(unittest.TestCase):
         self.assertTrue(isdir(tmpdir))
 
 
+class LinkedCloneTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.mkdir(join(self.tempdir, "keys"))
+        for name in ("cached-microdescs", "cached-microdescs.new", "state",
+                     join("keys", "secret_id_key")):
+            with open(join(self.tempdir, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        ut.remove_dir_templates()
+        rmtree(self.tempdir)
+
+    def test_clone_dir_linked(self):
+        clone = ut.clone_dir_linked(self.tempdir)
+        template = ut.get_dir_template(self.tempdir)
+        try:
+            for name in ("cached-microdescs", join("keys", "secret_id_key")):
+                self.assertTrue(os.path.samefile(join(clone, name),
+                                                 join(template, name)))
+            for name in ("cached-microdescs.new", "state"):
+                self.assertFalse(os.path.samefile(join(clone, name),
+                                                  join(template, name)))
+                with open(join(clone, name)) as f:
+                    self.assertEqual(f.read(), name)
+        finally:
+            rmtree(clone)
+
+    def test_template_is_made_once(self):
+        template = ut.get_dir_template(self.tempdir)
+        with open(join(self.tempdir, "state"), 'w') as f:
+            f.write("changed")
+        self.assertEqual(ut.get_dir_template(self.tempdir), template)
+
+    def test_remove_stale_tmp_dirs(self):
+        dead = subprocess.Popen(['/bin/true'])
+        dead.wait()
+        stale_dir = tempfile.mkdtemp(prefix="%sclone-%s-"
+                                     % (TMP_DIR_PREFIX, dead.pid))
+        live_dir = tempfile.mkdtemp(prefix=ut.tmp_dir_prefix("clone"))
+        ut.remove_stale_tmp_dirs()
+        self.assertFalse(isdir(stale_dir))
+        self.assertTrue(isdir(live_dir))
+        rmtree(live_dir)
+
+
 class ProcessUtilsTests(unittest.TestCase):
     # only linux!
     def test_gen_all_children_procs_of_non_shell_parent(self):
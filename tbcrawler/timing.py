@@ -0,0 +1,223 @@
+"""Per-phase timing of the crawl.
+
+The crawler opens a record per batch and per visit, and the phases timed
+while a record is open, from anywhere in the same thread, are added to
+it. Records are written as JSON lines when they are closed:
+
+    {"type": "visit", "batch": 0, "site": 3, "instance": 1,
+     "start": 1467288000.1, "total": 14.2,
+     "phases": {"browser_launch": 3.1, "dumpcap_start": 0.4, ...}}
+
+Durations come from a monotonic clock, so they are not affected by NTP
+adjustments during a long crawl.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from glob import glob
+from os.path import isdir, join
+
+import numpy as np
+
+import common as cm
+
+CLOCK_MONOTONIC = 1  # from linux/time.h
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _get_monotonic():
+    """Return a monotonic clock function, or time.time if there is none."""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    for lib in ('rt', 'c'):
+        try:
+            clock_gettime = ctypes.CDLL(ctypes.util.find_library(lib),
+                                        use_errno=True).clock_gettime
+            break
+        except (OSError, AttributeError):
+            continue
+    else:
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def monotonic():
+        ts = _Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+monotonic = _get_monotonic()
+
+
+class TimingRecorder(object):
+    """Collect phase durations into nested records and write them out."""
+
+    def __init__(self):
+        self.fd = None
+        self.records = []  # (record, start time, fields) of open records
+        self.phases = []  # names of the open phases
+        self.thread = None
+
+    def open(self, path):
+        self.close()
+        self.fd = open(path, 'a')
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def _current_thread(self):
+        return self.thread == threading.current_thread().ident
+
+    def start(self, kind, **fields):
+        """Open a record, nested in the currently open one if any.
+
+        Return the record, fields added to it are written out too.
+        """
+        record = dict(fields, type=kind, start=time.time(), phases={})
+        if self.records and not self._current_thread():
+            return record  # not recorded
+        self.thread = threading.current_thread().ident
+        self.records.append((record, monotonic(), fields))
+        return record
+
+    def end(self):
+        """Close the innermost record and write it."""
+        if not self.records or not self._current_thread():
+            return
+        record, started, _ = self.records.pop()
+        record['total'] = monotonic() - started
+        if self.fd is not None:
+            self.fd.write(json.dumps(record) + "\n")
+            self.fd.flush()
+
+    @contextmanager
+    def record(self, kind, **fields):
+        record = self.start(kind, **fields)
+        try:
+            yield record
+        finally:
+            self.end()
+
+    def add(self, name, duration):
+        """Add a duration to a phase of the innermost record."""
+        if self.records and self._current_thread():
+            phases = self.records[-1][0]['phases']
+            phases[name] = phases.get(name, 0.0) + duration
+
+    @contextmanager
+    def phase(self, name):
+        start = monotonic()
+        recording = bool(self.records) and self._current_thread()
+        if recording:
+            self.phases.append(name)
+        try:
+            yield
+        finally:
+            if recording:
+                self.phases.pop()
+            self.add(name, monotonic() - start)
+
+    def context(self):
+        """Return the fields of the open records and the current phase,
+        e.g. batch, site and instance, in the recording thread."""
+        if not self.records or not self._current_thread():
+            return {}
+        context = {}
+        for _, _, fields in self.records:
+            context.update(fields)
+        if self.phases:
+            context['phase'] = self.phases[-1]
+        return context
+
+
+# the recorder of this process
+recorder = TimingRecorder()
+phase = recorder.phase
+
+
+def load_records(crawl_dir):
+    """Load the timing records of all the workers of a crawl."""
+    records = []
+    for path in sorted(glob(join(crawl_dir, 'logs', cm.TIMINGS_PATTERN))):
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def summarize(records, percentiles=cm.TIMING_PERCENTILES):
+    """Return {record type: {phase: stats}} over the given records.
+
+    Stats are the count, mean, given percentiles and the share of the
+    total time of the records spent in the phase.
+    """
+    durations = defaultdict(lambda: defaultdict(list))
+    totals = defaultdict(float)
+    for record in records:
+        kind = record['type']
+        totals[kind] += record['total']
+        durations[kind]['total'].append(record['total'])
+        for name, duration in record['phases'].items():
+            durations[kind][name].append(duration)
+    summary = {}
+    for kind, phases in durations.items():
+        summary[kind] = {}
+        for name, values in phases.items():
+            values = np.array(values)
+            stats = {'count': len(values), 'mean': values.mean(),
+                     'share': values.sum() / totals[kind]
+                     if totals[kind] else 0.0}
+            for p, value in zip(percentiles,
+                                np.percentile(values, percentiles)):
+                stats['p%s' % p] = value
+            summary[kind][name] = stats
+    return summary
+
+
+def format_summary(summary, percentiles=cm.TIMING_PERCENTILES):
+    columns = ['count', 'mean'] + ['p%s' % p for p in percentiles] + \
+        ['share']
+    lines = []
+    for kind in sorted(summary):
+        lines.append("%-20s" % kind + "".join("%10s" % c for c in columns))
+        phases = summary[kind]
+        # most expensive phases first, the total last
+        for name in sorted(phases, key=lambda n: (n == 'total',
+                                                  -phases[n]['share'])):
+            stats = phases[name]
+            lines.append("  %-18s%10d" % (name, stats['count']) +
+                         "".join("%10.3f" % stats[c] for c in columns[1:-1]) +
+                         "%9.1f%%" % (100 * stats['share']))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Summarize the phase timings of a crawl.')
+    parser.add_argument('crawl_dir', help='Crawl directory.')
+    args = parser.parse_args()
+    if not isdir(args.crawl_dir):
+        parser.error("%s is not a directory" % args.crawl_dir)
+    records = load_records(args.crawl_dir)
+    if not records:
+        parser.error("No timing records in %s" % args.crawl_dir)
+    print(format_summary(summarize(records)))
+
+
+if __name__ == '__main__':
+    main()
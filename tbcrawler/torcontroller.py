@@ -2,13 +2,18 @@ import shutil
 from contextlib import contextmanager
 from os import environ
 from os.path import join, isfile, isdir, dirname
+from threading import Event, Thread
+from time import sleep, time
 
 import stem.process
-from stem.control import Controller
-from stem.util import term
+from stem import CircStatus, ControllerError, Signal
+from stem.control import Controller, EventType
 from tbselenium.common import DEFAULT_TOR_DATA_PATH, DEFAULT_TOR_BINARY_PATH
 
 import common as cm
+import timing
+from events import EVENT_TYPES
+from log import wl_log
 import utils as ut
 
 
@@ -18,7 +23,11 @@ class TorController(object):
                  tor_binary_path=None,
                  tor_data_path=None,
                  torrc_dict={'controlport': '9051', 'socksport': '9050'},
-                 pollute=True):
+                 pollute=True,
+                 standby=False,
+                 traffic_monitor=None,
+                 event_recorder=None,
+                 reset_strategy=cm.RESET_RESTART):
         assert (tbb_path or tor_binary_path and tor_data_path)
         if tbb_path:
             tbb_path = tbb_path.rstrip('/')
@@ -33,29 +42,104 @@ class TorController(object):
         self.controller = None
         self.tmp_tor_data_dir = None
         self.tor_process = None
+        self.clone_time = None
+        self.launch_time = None
         self.pollute = pollute
+        # consensus index, refreshed on NEWCONSENSUS events
+        self.relay_ips = {}
+        self.guard_ips = frozenset()
         self.control_port = int(self.torrc_dict['controlport'])
         self.socks_port = int(self.torrc_dict['socksport'])
+        # bootstrap the next Tor process while the current one is in use
+        self.standby = standby
+        self.standby_controller = None
+        self.standby_thread = None
+        self.base_ports = (self.control_port, self.socks_port)
+        self.bootstraps = []  # duration and error of every Tor launch
+        # quiescence.TrafficMonitor fed with the BW events of Tor
+        self.traffic_monitor = traffic_monitor
+        # events.EventRecorder logging the Tor events of each visit
+        self.event_recorder = event_recorder
+        # called with the guard IP of every new circuit, None if the guard
+        # is not in the consensus index
+        self.guard_listeners = []
+        # how visits get fresh circuits, see reset()
+        self.reset_strategy = reset_strategy
+        self.circuit_built = Event()
         self.export_lib_path()
 
+    def get_circuits(self):
+        """Return the open circuits, as stem CIRC events."""
+        return self.controller.get_circuits()
+
     def get_guard_ips(self):
         ips = []
         for circ in self.controller.get_circuits():
             # filter empty circuits out
             if len(circ.path) == 0:
                 continue
-            ip = self.controller.get_network_status(circ.path[0][0]).address
+            fingerprint = circ.path[0][0]
+            ip = self.relay_ips.get(fingerprint)
+            if ip is None:  # relay is not in our copy of the consensus
+                ip = self.controller.get_network_status(fingerprint).address
             if ip not in ips:
                 ips.append(ip)
         return ips
 
     def get_all_guard_ips(self):
-        for router_status in self.controller.get_network_statuses():
+        """Return the addresses of the relays with the Guard flag."""
+        return self.guard_ips
+
+    def build_guard_index(self, router_statuses=None):
+        """Index relay addresses by fingerprint and collect guard addresses.
+
+        Fetch the current consensus if no router statuses are given.
+        """
+        if router_statuses is None:
+            router_statuses = self.controller.get_network_statuses()
+        relay_ips = {}
+        guard_ips = set()
+        for router_status in router_statuses:
+            relay_ips[router_status.fingerprint] = router_status.address
             if 'Guard' in router_status.flags:
-                yield router_status.address
+                guard_ips.add(router_status.address)
+        # swap the references so that readers never see a partial index
+        self.relay_ips, self.guard_ips = relay_ips, frozenset(guard_ips)
+
+    def new_consensus_handler(self, event):
+        self.build_guard_index(event.desc)
+
+    def circuit_handler(self, event):
+        if event.status != CircStatus.BUILT or not event.path:
+            return
+        self.circuit_built.set()
+        ip = self.relay_ips.get(event.path[0][0])
+        for listener in self.guard_listeners:
+            listener(ip)
+
+    def add_event_listeners(self):
+        self.controller.add_event_listener(self.circuit_handler,
+                                           EventType.CIRC)
+        self.controller.add_event_listener(self.new_consensus_handler,
+                                           EventType.NEWCONSENSUS)
+        if self.traffic_monitor is not None:
+            self.controller.add_event_listener(
+                self.traffic_monitor.bw_handler, EventType.BW)
+        if self.event_recorder is not None:
+            self.controller.add_event_listener(self.event_recorder.handler,
+                                               *EVENT_TYPES)
+
+    def remove_event_listeners(self):
+        self.controller.remove_event_listener(self.circuit_handler)
+        self.controller.remove_event_listener(self.new_consensus_handler)
+        if self.traffic_monitor is not None:
+            self.controller.remove_event_listener(
+                self.traffic_monitor.bw_handler)
+        if self.event_recorder is not None:
+            self.controller.remove_event_listener(self.event_recorder.handler)
 
     def tor_log_handler(self, line):
-        print(term.format(line))
+        wl_log.info(line)
 
     def restart_tor(self):
         """Kill current Tor process and run a new one."""
@@ -66,52 +150,236 @@ class TorController(object):
         """Add the Tor Browser binary to the library path."""
         environ["LD_LIBRARY_PATH"] = dirname(self.tor_binary_path)
 
+    def is_tor_alive(self):
+        """Return True if the Tor process is running."""
+        return self.tor_process is not None and self.tor_process.poll() is None
+
     def quit(self):
         """Kill Tor process."""
+        if self.controller:
+            self.controller.close()
+            self.controller = None
         if self.tor_process:
-            print("Killing tor process")
+            wl_log.info("Killing tor process")
             self.tor_process.kill()
+            self.tor_process = None
         if self.tmp_tor_data_dir and isdir(self.tmp_tor_data_dir):
-            print("Removing tmp tor data dir")
+            wl_log.info("Removing tmp tor data dir")
             shutil.rmtree(self.tmp_tor_data_dir)
+            self.torrc_dict.pop('DataDirectory', None)
+            self.tmp_tor_data_dir = None
+
+    def launch_tor_service(self, timeout=cm.TOR_LAUNCH_TIMEOUT):
+        """Launch Tor service and return the process.
 
-    def launch_tor_service(self):
-        """Launch Tor service and return the process."""
+        stem can only enforce the launch timeout in the main thread, pass
+        None to launch Tor from another thread.
+        """
+        start = time()
         if self.pollute:
-            self.tmp_tor_data_dir = ut.clone_dir_temporary(self.tor_data_path)
+            self.tmp_tor_data_dir = ut.clone_dir_linked(self.tor_data_path)
             self.torrc_dict.update({'DataDirectory': self.tmp_tor_data_dir})
+            self.clone_time = time() - start
+            wl_log.info("Tor data dir cloned in %.3f s", self.clone_time)
 
-        print("Tor config: %s" % self.torrc_dict)
+        wl_log.info("Tor config: %s", self.torrc_dict)
         # the following may raise, make sure it's handled
         self.tor_process = stem.process.launch_tor_with_config(
             config=self.torrc_dict,
             init_msg_handler=self.tor_log_handler,
             tor_cmd=self.tor_binary_path,
-            timeout=270
+            timeout=timeout
         )
         self.controller = Controller.from_port(port=self.control_port)
         self.controller.authenticate()
+        self.add_event_listeners()
+        self.build_guard_index()
+        self.launch_time = time() - start
+        wl_log.info("Tor launched in %.3f s", self.launch_time)
         return self.tor_process
 
     def close_all_streams(self):
         """Close all streams of a controller."""
-        print("Closing all streams")
+        wl_log.info("Closing all streams")
         try:
-            with ut.timeout(cm.STREAM_CLOSE_TIMEOUT):
+            with ut.timeout(cm.STREAM_CLOSE_TIMEOUT) as deadline:
                 for stream in self.controller.get_streams():
-                    print("Closing stream %s %s %s " %
-                          (stream.id, stream.purpose, stream.target_address))
+                    wl_log.debug("Closing stream %s %s %s", stream.id,
+                                 stream.purpose, stream.target_address)
                     self.controller.close_stream(stream.id)  # MISC reason
-        except ut.TimeoutException:
-            print("Closing streams timed out!")
+        except ut.TimeoutException as exc:
+            if not deadline.owns(exc):
+                raise  # the timeout of an enclosing block
+            wl_log.error("Closing streams timed out!")
         except:
-            print("Exception closing stream")
+            wl_log.error("Exception closing stream")
+
+    def close_all_circuits(self):
+        """Close all circuits, and the streams on them, in one pass.
+
+        Return the number of circuits closed.
+        """
+        closed = 0
+        try:
+            with ut.timeout(cm.STREAM_CLOSE_TIMEOUT) as deadline:
+                for circ in self.controller.get_circuits():
+                    try:
+                        self.controller.close_circuit(circ.id)
+                        closed += 1
+                    except ControllerError:
+                        pass  # closed since we listed it
+        except ut.TimeoutException as exc:
+            if not deadline.owns(exc):
+                raise
+            wl_log.error("Closing circuits timed out!")
+        return closed
+
+    def reset(self):
+        """Give the next visit fresh circuits without restarting Tor.
+
+        `newnym` sends the NEWNYM signal, new streams then use new
+        circuits. `circuits` closes all circuits and their streams. Both
+        wait for a new circuit to be built, for at most
+        TOR_RESET_CIRCUIT_TIMEOUT seconds: past that the visit builds its
+        own. With `restart`, fresh circuits come from a new Tor process
+        per batch and this does nothing.
+        """
+        if self.reset_strategy == cm.RESET_RESTART:
+            return
+        with timing.phase('tor_reset_%s' % self.reset_strategy):
+            self.circuit_built.clear()
+            if self.reset_strategy == cm.RESET_NEWNYM:
+                # Tor rate limits NEWNYM signals
+                sleep(self.controller.get_newnym_wait())
+                self.controller.signal(Signal.NEWNYM)
+            else:
+                self.close_all_circuits()
+            if not self.circuit_built.wait(cm.TOR_RESET_CIRCUIT_TIMEOUT):
+                wl_log.warning("No new circuit %s s after the reset, the "
+                               "visit will build one",
+                               cm.TOR_RESET_CIRCUIT_TIMEOUT)
 
+    def get_standby_torrc(self):
+        """Return the torrc config of the next standby Tor process.
+
+        Standby processes alternate between the configured ports and the
+        configured ports plus an offset, so that the standby never clashes
+        with the process in use.
+        """
+        offset = 0
+        if (self.control_port, self.socks_port) == self.base_ports:
+            offset = cm.TOR_STANDBY_PORT_OFFSET
+        torrc_dict = dict(self.torrc_dict)
+        torrc_dict.pop('DataDirectory', None)
+        torrc_dict['controlport'] = str(self.base_ports[0] + offset)
+        torrc_dict['socksport'] = str(self.base_ports[1] + offset)
+        return torrc_dict
+
+    def new_standby(self):
+        """Return the controller of the next standby Tor process.
+
+        The standby always runs on a clone of the data dir, since it runs
+        alongside the current Tor process.
+        """
+        return self.__class__(tor_binary_path=self.tor_binary_path,
+                              tor_data_path=self.tor_data_path,
+                              torrc_dict=self.get_standby_torrc(),
+                              pollute=True)
+
+    def start_standby(self):
+        """Bootstrap a Tor process in the background for the next launch."""
+        standby = self.new_standby()
+        self.standby_controller = standby
+        self.standby_thread = Thread(target=self.bootstrap_standby,
+                                     args=(standby,))
+        self.standby_thread.daemon = True
+        self.standby_thread.start()
+
+    def bootstrap_standby(self, standby):
+        start = time()
+        error = None
+        try:
+            standby.launch_tor_service(timeout=None)
+        except Exception as exc:
+            error = str(exc)
+            standby.quit()
+        self.record_bootstrap(standby, time() - start, error, True)
+        if self.standby_controller is not standby:
+            standby.quit()  # abandoned while bootstrapping
+
+    def record_bootstrap(self, controller, duration, error, standby):
+        self.bootstraps.append({'control_port': controller.control_port,
+                                'socks_port': controller.socks_port,
+                                'duration': duration,
+                                'error': error,
+                                'standby': standby})
+        if error:
+            wl_log.error("Tor bootstrap failed after %.3f s: %s", duration,
+                         error)
+
+    def adopt_standby(self):
+        """Switch over to the standby Tor process.
+
+        Return False if there is no standby, or it failed to bootstrap in
+        time or died since, in which case the standby is discarded.
+        """
+        standby, thread = self.standby_controller, self.standby_thread
+        if standby is None:
+            return False
+        thread.join(cm.TOR_LAUNCH_TIMEOUT)
+        self.standby_controller = self.standby_thread = None
+        if thread.is_alive():
+            wl_log.error("Standby Tor process did not bootstrap in time")
+            return False
+        if standby.controller is None:
+            return False
+        if not standby.is_tor_alive():
+            wl_log.error("Standby Tor process died after its bootstrap")
+            standby.quit()
+            return False
+        standby.remove_event_listeners()
+        for attr in ('controller', 'tor_process', 'tmp_tor_data_dir',
+                     'torrc_dict', 'control_port', 'socks_port',
+                     'relay_ips', 'guard_ips', 'clone_time', 'launch_time'):
+            setattr(self, attr, getattr(standby, attr))
+        self.add_event_listeners()
+        wl_log.info("Switched to standby Tor process on port %s",
+                    self.socks_port)
+        return True
+
+    def quit_standby(self):
+        """Kill the standby Tor process, if any."""
+        standby, thread = self.standby_controller, self.standby_thread
+        self.standby_controller = self.standby_thread = None
+        if standby is not None and not thread.is_alive():
+            standby.quit()
 
     @contextmanager
-    def launch(self):
-        self.launch_tor_service()
-        yield
-        self.quit()
+    def launch(self, prepare_next=False):
+        """Run a Tor process for the duration of the block.
+
+        With standby enabled, the process bootstrapped during the previous
+        block is used if there is one, and if `prepare_next` is set the
+        process for the next block starts bootstrapping right away.
+        """
+        with timing.phase('tor_standby_wait'):
+            adopted = self.adopt_standby()
+        if not adopted:
+            start = time()
+            error = None
+            try:
+                with timing.phase('tor_launch'):
+                    self.launch_tor_service()
+            except Exception as exc:
+                error = str(exc)
+                raise
+            finally:
+                self.record_bootstrap(self, time() - start, error, False)
+        if self.standby and prepare_next:
+            self.start_standby()
+        try:
+            yield
+        finally:
+            self.quit()
 
 
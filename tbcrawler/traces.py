@@ -0,0 +1,200 @@
+"""Compact per-visit packet traces.
+
+A trace keeps, for every TCP packet with payload exchanged with a guard,
+its timestamp, its payload length signed by direction (positive outgoing,
+negative incoming) and the number of Tor cells it carries. ACKs without
+payload and retransmissions are left out.
+
+Trace files are columnar: a fixed header followed by one little-endian
+array per column, so they load into NumPy arrays without any parsing::
+
+    magic "TBTR" | version (u2) | reserved (u2) | n_packets (u8)
+    time   float64[n_packets]  capture timestamps in seconds
+    length int32[n_packets]    signed payload lengths
+    cells  uint16[n_packets]   Tor cells per packet
+
+Traces are extracted from pcaps, or from tshark CSV field exports.
+"""
+import struct
+from array import array
+from collections import namedtuple
+from os.path import splitext
+
+import numpy as np
+
+import common as cm
+from pcaputils import IPPROTO_TCP, PcapReader, pack_ips
+
+TRACE_MAGIC = b'TBTR'
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct('<4sHHQ')
+# column name, array typecode, numpy dtype
+TRACE_COLUMNS = (('time', 'd', '<f8'),
+                 ('length', 'i', '<i4'),
+                 ('cells', 'H', '<u2'))
+
+SEQ_HALF_SPACE = 2 ** 31
+
+# columns of the tshark CSV field export
+TSHARK_TS, TSHARK_SRC, TSHARK_DST = 0, 1, 2
+TSHARK_PROTO, TSHARK_IP_LEN, TSHARK_IP_HDR_LEN, TSHARK_TCP_HDR_LEN = 5, 6, 7, 8
+TSHARK_INFO = 14
+
+Trace = namedtuple('Trace', [name for name, _, _ in TRACE_COLUMNS])
+
+
+class TraceFormatError(Exception):
+    pass
+
+
+def trace_paths(pcap_path):
+    """Return the trace and .tao paths of a visit capture."""
+    base = splitext(pcap_path)[0]
+    return base + cm.TRACE_EXT, base + cm.TAO_EXT
+
+
+def n_cells(payload_len):
+    """Estimate the number of Tor cells in a TLS payload."""
+    return -(-payload_len // cm.TOR_CELL_SIZE)
+
+
+def extract_trace(pcap_path, guard_ips):
+    """Return the trace columns of a capture as arrays.
+
+    A segment is a retransmission if it does not extend the highest
+    sequence number seen so far in its direction of the connection.
+    """
+    packed_ips = pack_ips(guard_ips)
+    columns = Trace(*[array(typecode) for _, typecode, _ in TRACE_COLUMNS])
+    seq_end = {}  # sequence number following the last new segment per flow
+    with open(pcap_path, 'rb') as f:
+        reader = PcapReader(f)
+        timestamp, ip_offset = reader.timestamp, reader.ip_offset
+        for header, data in reader:
+            off = ip_offset(data)
+            if off is None or data[off + 9:off + 10] != IPPROTO_TCP:
+                continue
+            src, dst = data[off + 12:off + 16], data[off + 16:off + 20]
+            if src in packed_ips:
+                sign = -1
+            elif dst in packed_ips:
+                sign = 1
+            else:
+                continue
+            ip_len, = struct.unpack('>H', data[off + 2:off + 4])
+            tcp_off = off + (ord(data[off:off + 1]) & 0x0f) * 4
+            if len(data) < tcp_off + 20:
+                continue  # TCP header cut by the snaplen
+            tcp_hdr_len = (ord(data[tcp_off + 12:tcp_off + 13]) >> 4) * 4
+            payload_len = ip_len - (tcp_off - off) - tcp_hdr_len
+            if payload_len <= 0:
+                continue  # pure ACK
+            flow = src + dst + data[tcp_off:tcp_off + 4]
+            seq, = struct.unpack('>I', data[tcp_off + 4:tcp_off + 8])
+            end = (seq + payload_len) & 0xffffffff
+            if flow in seq_end:
+                # sequence numbers wrap around, compare modulo 2**32
+                advance = (end - seq_end[flow]) & 0xffffffff
+                if advance == 0 or advance >= SEQ_HALF_SPACE:
+                    continue  # retransmission
+            seq_end[flow] = end
+            columns.time.append(timestamp(header))
+            columns.length.append(sign * payload_len)
+            columns.cells.append(n_cells(payload_len))
+    return columns
+
+
+def write_trace(columns, path):
+    """Write trace columns (arrays or sequences) to a trace file."""
+    n_packets = len(columns[0])
+    with open(path, 'wb') as f:
+        f.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, 0, n_packets))
+        for (_, _, dtype), column in zip(TRACE_COLUMNS, columns):
+            np.asarray(column, dtype=dtype).tofile(f)
+
+
+def load_trace(path):
+    """Load a trace file as a Trace of NumPy arrays."""
+    with open(path, 'rb') as f:
+        header = f.read(TRACE_HEADER.size)
+        if len(header) < TRACE_HEADER.size:
+            raise TraceFormatError("Truncated trace header: %s" % path)
+        magic, version, _, n_packets = TRACE_HEADER.unpack(header)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise TraceFormatError("Not a version %s trace: %s"
+                                   % (TRACE_VERSION, path))
+        columns = []
+        for _, _, dtype in TRACE_COLUMNS:
+            column = np.fromfile(f, dtype=dtype, count=n_packets)
+            if len(column) < n_packets:
+                raise TraceFormatError("Truncated trace: %s" % path)
+            columns.append(column)
+    return Trace(*columns)
+
+
+def write_tao(columns, path):
+    """Export a trace as tab-separated timestamp and signed length lines."""
+    with open(path, 'w') as f:
+        for ts, length in zip(columns.time, columns.length):
+            f.write("%.6f\t%d\n" % (ts, length))
+
+
+def pcap_to_trace(pcap_path, guard_ips, tao=True):
+    """Extract the trace of a visit capture next to it.
+
+    Return the number of packets in the trace.
+    """
+    trace_path, tao_path = trace_paths(pcap_path)
+    columns = extract_trace(pcap_path, guard_ips)
+    write_trace(columns, trace_path)
+    if tao:
+        write_tao(columns, tao_path)
+    return len(columns.time)
+
+
+def tshark_to_trace(in_path, out_path, guard_ips):
+    """Filter a tshark CSV field export and extract its trace.
+
+    `out_path` gets the lines of TCP packets with payload exchanged with a
+    guard. The trace and .tao export of these packets, retransmissions
+    excluded, are written next to it. Return the number of lines kept and
+    the total number of lines.
+    """
+    guard_ips = frozenset(guard_ips)
+    trace_path, tao_path = trace_paths(out_path)
+    times, lengths = [], array('i')
+    kept = total = 0
+    with open(in_path, 'rb') as fi, open(out_path, 'wb') as fo, \
+            open(tao_path, 'wb') as ft:
+        for line in fi:
+            total += 1
+            # the last field may have commas
+            fields = line.split(b',', TSHARK_INFO)
+            if len(fields) <= TSHARK_INFO or fields[TSHARK_PROTO] != b'6':
+                continue  # malformed, or not TCP
+            if fields[TSHARK_SRC] in guard_ips:
+                sign = -1
+            elif fields[TSHARK_DST] in guard_ips:
+                sign = 1
+            else:
+                continue
+            payload_len = int(fields[TSHARK_IP_LEN]) - (
+                int(fields[TSHARK_IP_HDR_LEN]) +
+                int(fields[TSHARK_TCP_HDR_LEN]))
+            if payload_len == 0:
+                continue  # pure ACK
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            fo.write(line)
+            kept += 1
+            # "[TCP Retransmission]", "[TCP Fast Retransmission]", ...
+            if b'etransmission' in fields[TSHARK_INFO]:
+                continue
+            payload_len *= sign
+            ft.write(b'%s\t%d\n' % (fields[TSHARK_TS], payload_len))
+            times.append(fields[TSHARK_TS])
+            lengths.append(payload_len)
+    lengths = np.frombuffer(lengths, dtype=np.int32)
+    write_trace([np.array(times, dtype=float), lengths,
+                 n_cells(np.abs(lengths))], trace_path)
+    return kept, total
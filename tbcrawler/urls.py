@@ -0,0 +1,100 @@
+"""Read URL lists in a single streaming pass and split them into shards.
+
+URLs are normalized and deduplicated as they are read. Site indices are
+positions in the deduplicated list, so every node of a multi-node crawl
+computes the same indices and the same partition from the same file,
+and only keeps the URLs of its own shard in memory.
+"""
+import re
+from collections import OrderedDict
+from hashlib import md5
+from itertools import islice
+from struct import Struct
+from sys import maxsize
+
+SHARD_METHODS = ('hash', 'range')
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
+# optional rank of top sites lists ("rank,domain"), scheme, host[:port],
+# path and query, fragment
+URL_RE = re.compile(r'(?:\d+,)?(?:([A-Za-z][A-Za-z0-9+.-]*)://)?([^/?#]*)'
+                    r'([^#]*)')
+DIGEST_HALVES = Struct('<QQ')
+
+
+def normalize_url(line):
+    """Return the normalized URL on a line, None for blank and # lines.
+
+    The scheme (http if missing) and host are lowercased, default ports
+    and fragments are dropped.
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    scheme, netloc, rest = URL_RE.match(line).groups()
+    scheme = scheme.lower() if scheme else 'http'
+    userinfo, _, hostport = netloc.rpartition('@')
+    host, port = hostport, ''
+    if ':' in hostport.rsplit(']', 1)[-1]:  # not inside an IPv6 address
+        host, port = hostport.rsplit(':', 1)
+    netloc = host.lower()
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc += ':' + port
+    if userinfo:
+        netloc = userinfo + '@' + netloc
+    return "%s://%s%s" % (scheme, netloc, rest)
+
+
+def read_urls(file_path, start=1, stop=maxsize):
+    """Yield (url, digest) for the distinct URLs on lines `start`-`stop`.
+
+    Only a 64-bit hash of each URL is kept to detect duplicates.
+    """
+    seen = set()
+    with open(file_path) as f:
+        for line in islice(f, start - 1, stop):
+            url = normalize_url(line)
+            if url is None:
+                continue
+            digest = DIGEST_HALVES.unpack(md5(url).digest())
+            if digest[0] in seen:
+                continue
+            seen.add(digest[0])
+            yield url, digest
+
+
+def parse_shard(shard):
+    """Parse an "i/N" shard spec into (i, N), 1 <= i <= N."""
+    try:
+        index, n_shards = map(int, shard.split('/'))
+    except ValueError:
+        raise ValueError("Shard must be i/N, got %r" % shard)
+    if not 1 <= index <= n_shards:
+        raise ValueError("Shard index must be between 1 and %s" % n_shards)
+    return index, n_shards
+
+
+def load_shard(file_path, shard=(1, 1), method='hash', start=1,
+               stop=maxsize):
+    """Return {site index: url} for the URLs of `shard` of a list.
+
+    `hash` deals URLs to shards by their hash, which balances shards
+    when neighbouring sites have similar load times. `range` gives each
+    shard a contiguous slice, it reads the list twice to count the URLs.
+    """
+    index, n_shards = shard
+    if method not in SHARD_METHODS:
+        raise ValueError("Unknown shard method: %s" % method)
+    if method == 'range':
+        total = sum(1 for _ in read_urls(file_path, start, stop))
+        first = (index - 1) * total // n_shards
+        last = index * total // n_shards
+    urls = OrderedDict()
+    for site, (url, digest) in enumerate(read_urls(file_path, start, stop)):
+        if method == 'hash':
+            if digest[1] % n_shards == index - 1:
+                urls[site] = url
+        elif site >= last:
+            break
+        elif site >= first:
+            urls[site] = url
+    return urls
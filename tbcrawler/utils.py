@@ -1,16 +1,21 @@
-import signal
+import os
+import tempfile
 from contextlib import contextmanager
 from distutils.dir_util import copy_tree
-from shutil import copyfile
+from fnmatch import fnmatch
+from glob import glob
+from shutil import copy2, move, rmtree
 from os import makedirs
-from os.path import exists
-from scapy.all import PcapReader, wrpcap
+from os.path import basename, exists, join, relpath
 
 import psutil
 from pyvirtualdisplay import Display
 
 from common import TimeoutException
+from deadline import scheduler
 from tbcrawler import common as cm
+from tbcrawler import pcaputils as pu
+from tbcrawler import traces
 
 
 def create_dir(dir_path):
@@ -22,12 +27,72 @@ def create_dir(dir_path):
 
 def clone_dir_temporary(dir_path):
     """Makes a temporary copy of a directory."""
-    import tempfile
     tempdir = tempfile.mkdtemp()
     copy_tree(dir_path, tempdir)
     return tempdir
 
 
+# snapshots of the directories cloned with clone_dir_linked
+_dir_templates = {}
+
+
+def get_dir_template(dir_path):
+    """Return a private snapshot of a directory, made once per process."""
+    if dir_path not in _dir_templates:
+        remove_stale_tmp_dirs()
+        template = tempfile.mkdtemp(prefix=tmp_dir_prefix("template"))
+        copy_tree(dir_path, template)
+        _dir_templates[dir_path] = template
+    return _dir_templates[dir_path]
+
+
+def remove_dir_templates():
+    for template in _dir_templates.values():
+        rmtree(template, ignore_errors=True)
+    _dir_templates.clear()
+
+
+def tmp_dir_prefix(kind):
+    return "%s%s-%s-" % (cm.TMP_DIR_PREFIX, kind, os.getpid())
+
+
+def remove_stale_tmp_dirs():
+    """Remove the temporary dirs left behind by dead crawler processes."""
+    for tmp_dir in glob(join(tempfile.gettempdir(), cm.TMP_DIR_PREFIX + "*")):
+        try:
+            pid = int(basename(tmp_dir).split("-")[2])
+        except (IndexError, ValueError):
+            continue
+        if not psutil.pid_exists(pid):
+            rmtree(tmp_dir, ignore_errors=True)
+
+
+def clone_dir_linked(dir_path, copied_files=cm.TOR_MUTABLE_FILES):
+    """Make a temporary copy-on-write view of a directory.
+
+    Files are hard linked to a template of the directory. This is only
+    safe for programs that replace files (write and rename) rather than
+    modify them: files matching any pattern in `copied_files` are copied
+    instead. Files are copied, too, if hard links are not possible.
+    """
+    template = get_dir_template(dir_path)
+    tempdir = tempfile.mkdtemp(prefix=tmp_dir_prefix("clone"))
+    for root, dirs, files in os.walk(template):
+        dest_root = join(tempdir, relpath(root, template))
+        for dir_name in dirs:
+            os.mkdir(join(dest_root, dir_name))
+        for file_name in files:
+            src, dest = join(root, file_name), join(dest_root, file_name)
+            if any(fnmatch(file_name, pattern) for pattern in copied_files):
+                copy2(src, dest)
+                continue
+            try:
+                os.link(src, dest)
+            except OSError:  # e.g. different file systems
+                copy2(src, dest)
+    return tempdir
+
+
 def gen_all_children_procs(parent_pid):
     """Iterator over the children of a process."""
     parent = psutil.Process(parent_pid)
@@ -47,64 +112,32 @@ def get_dict_subconfig(config, section, prefix):
             for option in config.options(section) if option.startswith(prefix)}
 
 
-@contextmanager
-def timeout(seconds):
-    """From: http://stackoverflow.com/a/601168/1336939"""
-    def signal_handler(signum, frame):
-        raise TimeoutException("Timed out!")
-
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(seconds)
-    try:
-        yield
-    finally:
-        signal.alarm(0)
-
-
-def filter_tshark(tshark_path, iplist):                                          
-    # Remove lines in log for IPs that are not in iplist                         
-    orig_tshark = tshark_path + ".original"                                      
-    move(tshark_path, orig_tshark)                                               
-    tao_trace = tshark_path[:-6] + 'tao'                                         
-    with open(tshark_path, 'wb') as fo, open(tao_trace, 'wb') as ft:             
-        for line in open(orig_tshark):                                           
-            s_line = line.strip().split(',')                                     
-            ts = s_line[0]                                                       
-            src, dst = s_line[1:3]                                               
-            proto, ip_len, ip_hdr_len, tcp_hdr_len = s_line[5:9]                 
-            msg = s_line[14]                                                     
-            if proto != '6':                                                     
-                continue                                                         
-            datalen = int(ip_len) - (int(ip_hdr_len) + int(tcp_hdr_len))         
-            if datalen == 0:                                                     
-                continue                                                         
-            if src not in iplist and dst not in iplist:                          
-                continue                                                         
-            fo.write(line)                                                       
-            if src != cm.LOCAL_IP:                                               
-                datalen = -datalen                                               
-            if 'retransmission' in msg.lower():                                  
-                continue                                                         
-            ft.write('\t'.join([ts, str(datalen)]) + '\n')                       
-                                                                                 
-                                                                                 
-def filter_pcap(pcap_path, iplist):                                              
-    # TODO: parse pcap into a CSV with the following fields:                     
-    # length, timestamp, src_ip. dst_ip, direction, n_cells                      
-    # remove ACKs, retransmissions                                               
-    # Remove sendme's and store that in a separate CSV                           
-    # for the moment, keep the original .pcap                                    
-    # we don't need the payload stripping                                        
-    pcap_filtered = []                                                           
-    orig_pcap = pcap_path + ".original"                                          
-    copyfile(pcap_path, orig_pcap)                                               
-    with PcapReader(orig_pcap) as preader:                                       
-        for p in preader:                                                        
-            if 'TCP' in p:                                                       
-                ip = p.payload                                                   
-                if ip.dst in iplist or ip.src in iplist:                         
-                    pcap_filtered.append(p)                                      
-    wrpcap(pcap_path, pcap_filtered)
+def timeout(seconds, on_expire=None):
+    """Raise TimeoutException in the block after `seconds`.
+
+    Works in any thread and with fractional and nested timeouts, see
+    deadline.py. `on_expire` is called to cancel a blocked operation.
+    """
+    return scheduler.deadline(seconds, on_expire)
+
+
+def filter_tshark(tshark_path, iplist):
+    # Remove lines in log for IPs that are not in iplist, keep the original
+    # and extract the trace (.trace and .tao) of the remaining packets
+    orig_tshark = tshark_path + ".original"
+    move(tshark_path, orig_tshark)
+    return traces.tshark_to_trace(orig_tshark, tshark_path, iplist)
+
+
+def filter_pcap(pcap_path, iplist):
+    # timestamp, direction, length and n_cells of the packets, without ACKs
+    # and retransmissions, are extracted by traces.pcap_to_trace
+    # TODO: Remove sendme's and store that in a separate CSV
+    # for the moment, keep the original .pcap
+    # we don't need the payload stripping
+    orig_pcap = pcap_path + ".original"
+    move(pcap_path, orig_pcap)
+    return pu.filter_pcap(orig_pcap, pcap_path, iplist)
 
 
 def start_xvfb(win_width=cm.DEFAULT_XVFB_WIN_W,